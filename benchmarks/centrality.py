@@ -0,0 +1,44 @@
+import sys
+import tracemalloc
+
+import networkx as nx
+import numpy as np
+
+from benchmarks.graph_load import synthetic_edges, timed
+from src.analysis import sparse_centrality
+from src.analysis.network_analysis import load_graph
+
+
+def measured(function, *args, **kwargs):
+    """ Run a function, returning its result, wall time and peak traced memory in MB.
+        Memory is traced in a second run, as tracing slows down allocation heavy code """
+    result, elapsed = timed(function, *args, **kwargs)
+
+    tracemalloc.start()
+    function(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def networkx_centralities(edges_df):
+    DG = load_graph(edges_df)
+    return DG, nx.in_degree_centrality(DG), nx.out_degree_centrality(DG), nx.eigenvector_centrality(DG, max_iter=1000)
+
+
+if __name__ == "__main__":
+    edges = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    edges_df = synthetic_edges(edges)[['source', 'target']]
+
+    (DG, in_degree, out_degree, eigen), nx_time, nx_peak = measured(networkx_centralities, edges_df)
+    sparse_df, sparse_time, sparse_peak = measured(sparse_centrality.compute_centralities, edges_df)
+
+    labels = sparse_df['label'].tolist()
+    for column, expected in [('in_degree_centrality', in_degree), ('out_degree_centrality', out_degree),
+                             ('eigenvector_centrality', eigen)]:
+        error = np.abs(sparse_df[column].to_numpy() - np.array([expected[label] for label in labels])).max()
+        print(f'{column} max abs difference: {error:.2e}')
+
+    print(f'{edges} edges, {DG.number_of_nodes()} nodes')
+    print(f'networkx: {nx_time:.2f}s, peak {nx_peak:.0f}MB')
+    print(f'sparse:   {sparse_time:.2f}s, peak {sparse_peak:.0f}MB')
@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.streaming_clusters import TOPICS, synthetic_comments
+from src.analysis.text_cluster import TextPreprocessor, fit_cluster_count, sweep_cluster_counts, vectorize_texts
+
+
+def rerun_sweep(texts, cluster_counts, preprocessor):
+    """ Choosing the number of clusters by rerunning the whole clustering for each, as before sweep_cluster_counts """
+    results = []
+    for clusters in cluster_counts:
+        _, tfidf_model = vectorize_texts(texts, preprocessor)
+        results.append(fit_cluster_count(tfidf_model, clusters))
+    return results
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    cluster_counts = range(2, 2 * len(TOPICS) + 1)
+    texts, _ = synthetic_comments(count)
+    preprocessor = TextPreprocessor(tokenizer=TextPreprocessor.Tokenizer.REGEX)
+
+    start = time.perf_counter()
+    reruns = rerun_sweep(texts, cluster_counts, preprocessor)
+    rerun_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        results = sweep_cluster_counts(texts, cluster_counts, preprocessor, workers=workers, cache_dir=cache_dir)
+        sweep_time = time.perf_counter() - start
+
+        # a later sweep over the same corpus loads the matrix instead of vectorizing it
+        start = time.perf_counter()
+        sweep_cluster_counts(texts, cluster_counts, preprocessor, workers=workers, cache_dir=cache_dir)
+        cached_time = time.perf_counter() - start
+
+    assert [result['inertia'] for result in results] == [result['inertia'] for result in reruns]
+
+    print(f'{count} comments, {len(cluster_counts)} cluster counts, {workers} workers')
+    print(f'reruns:       {rerun_time:.2f}s')
+    print(f'sweep:        {sweep_time:.2f}s ({rerun_time / sweep_time:.1f}x)')
+    print(f'cached sweep: {cached_time:.2f}s ({rerun_time / cached_time:.1f}x)')
+    for result in results:
+        print(f"{result['clusters']:>3} clusters: inertia {result['inertia']:.1f}, silhouette {result['silhouette']:.3f}")
@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import CorpusGenerator
+
+HEAVY_MODULES = ['pandas', 'scipy', 'networkx', 'nltk', 'sklearn']
+
+# the heavy modules a command has loaded once it is done, printed from the exiting interpreter
+REPORT = ("import atexit, sys; atexit.register(lambda: print('loaded:', "
+          f"' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules) or '-', file=sys.stderr))")
+
+
+def cold_start(code, repeat=5):
+    """ Best wall time of running code in a new interpreter, and the heavy modules it loaded """
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', f'{REPORT}\n{code}'], env=env, capture_output=True, text=True,
+                                check=True)
+        times.append(time.perf_counter() - start)
+    loaded = [line for line in result.stderr.splitlines() if line.startswith('loaded:')][-1]
+    return min(times), loaded[len('loaded: '):]
+
+
+def cli(*args):
+    return f'from src.cli import main; main({list(args)!r})'
+
+
+if __name__ == "__main__":
+    comments = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        CorpusGenerator(comments).write(data_dir + '/raw')
+        commands = [
+            ('python', 'pass'),
+            ('tia --help', cli('--help')),
+            ('tia crawl --help', cli('crawl', '--help')),
+            (f'tia munge ({comments} comments)', cli('munge', data_dir)),
+            ('tia pack', cli('pack', data_dir + '/raw/posts', '--keep')),
+            ('import TiaCrawler', 'from src.pipeline.crawler import TiaCrawler'),
+            ('import process_text', 'from src.analysis.text_cluster import process_text'),
+            ('import orchestrator', 'import src.pipeline.orchestrator'),
+            ('import network_analysis', 'import src.analysis.network_analysis'),
+            ('tia network-analysis --help', cli('network-analysis', '--help')),
+            # the heavy commands, for comparison
+            ('tia network-prep', cli('network-prep', data_dir)),
+            ('stem a text', 'from src.analysis.text_cluster import TextPreprocessor as T; '
+                            'T(tokenizer=T.Tokenizer.REGEX)("a text")'),
+        ]
+        for name, code in commands:
+            elapsed, loaded = cold_start(code)
+            print(f'{name:<32} {elapsed:.3f}s  {loaded}')
@@ -0,0 +1,108 @@
+import json
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import CorpusGenerator
+from src.pipeline.munger import CommentsJsonToCsv
+from src.pipeline.raw_store import PageRef, load_page
+
+
+class RecursiveCommentsJsonToCsv(CommentsJsonToCsv):
+    """ The recursive flattening CommentsJsonToCsv used before the stack based one, without the thread columns """
+
+    def _flatten(self, batches, item):
+        self._write(batches[0], item)
+        self._extract_children_and_replies(item, batches[0])
+
+    def _extract_children_and_replies(self, obj, rows):
+        if 'children' in obj:
+            for object in obj['children']:
+                self._write(rows, object)
+                self._extract_children_and_replies(object, rows)
+        if 'replies' in obj:
+            for object in obj['replies']:
+                self._write(rows, object)
+                self._extract_children_and_replies(object, rows)
+
+    def _write(self, rows, object):
+        standard_values = self._json_to_arr(object, self.key_list)
+        author_values = self._json_to_arr(object.get('author', None), self.author_key_list)
+        rows.append(standard_values + author_values)
+
+
+def flatten_pages(munger, pages, keep=True):
+    """ Rows of every page, each flattened into batches of its own as _flatten_file does.
+        Without keep the batches are dropped as they would be once written, and only the number of rows is returned """
+    rows = []
+    count = 0
+    for items in pages:
+        batches = [[]]
+        for item in items:
+            munger._flatten(batches, item)
+        count += len(batches[0])
+        if keep:
+            rows.extend(batches[0])
+    return rows if keep else count
+
+
+def deep_thread_page(item, depth):
+    """ json text of a comments page holding a copy of item with a chain of depth replies under it, each the only child
+        of the one before. Built as text, as json.dumps cannot encode a thread this deep """
+    comment = {key: value for key, value in item.items() if key not in ('children', 'replies')}
+    comments = []
+    for i in range(depth + 1):
+        text = json.dumps(dict(comment, id=item['id'] + i, parent=item['id'] + i - 1 if i else item['parent'],
+                               replies=[], children=None))
+        comments.append(text[:-len('null}')] + '[')
+    return '{"total_pages": 1, "comments": [' + ''.join(comments) + ']}' * (depth + 1) + ']}'
+
+
+def timed(function, *args, repeat=3):
+    """ Result and best time of repeat calls """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+if __name__ == "__main__":
+    comments = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        CorpusGenerator(comments).write(data_dir + '/raw')
+        exclude = ['children', 'replies', 'author']
+        old_munger = RecursiveCommentsJsonToCsv(data_dir + '/raw/comments/', data_dir + '/comments.csv', exclude=exclude)
+        new_munger = CommentsJsonToCsv(data_dir + '/raw/comments/', data_dir + '/comments.csv', exclude=exclude)
+        pages = [load_page(page)['comments'] for page in new_munger._input_pages()]
+
+    old_rows = flatten_pages(old_munger, pages)
+    new_rows = flatten_pages(new_munger, pages)
+    assert [tuple(row) for row in old_rows] == [row[:-2] for row in new_rows]
+    rows = len(new_rows)
+    del old_rows, new_rows
+
+    _, old_time = timed(flatten_pages, old_munger, pages, False)
+    _, new_time = timed(flatten_pages, new_munger, pages, False)
+
+    print(f'{rows} rows, {sum(len(items) for items in pages)} threads')
+    print(f'recursive: {old_time:.2f}s, {old_time / rows * 1e9:.0f}ns per row')
+    print(f'stack:     {new_time:.2f}s, {new_time / rows * 1e9:.0f}ns per row ({old_time / new_time:.1f}x)')
+
+    # the deep thread is read from disk as munging reads it, so that decoding it is covered too
+    with tempfile.TemporaryDirectory() as data_dir:
+        page = PageRef('deep_thread', data_dir + '/deep_thread', None, None)
+        with open(page.path, 'w') as f:
+            f.write(deep_thread_page(pages[0][0], depth))
+
+        try:
+            old_munger._flatten_file(page)
+            print(f'recursive: flattened a thread {depth} replies deep')
+        except RecursionError:
+            print(f'recursive: recursion limit hit on a thread {depth} replies deep')
+        ((deep_rows, ), _), deep_time = timed(new_munger._flatten_file, page, repeat=1)
+    assert deep_rows[-1][-2] == depth
+    print(f'stack:     decoded and flattened a thread {depth} replies deep in {deep_time:.2f}s')
@@ -0,0 +1,151 @@
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+from benchmarks.streaming_clusters import COMMON, TOPICS
+
+POSTS_PER_PAGE = 20
+ROOT_COMMENTS_PER_PAGE = 20
+COMMENTS_PER_POST = 25
+
+
+class CorpusGenerator:
+    """ Raw post and comment pages shaped like the TechInAsia API responses the crawler writes.
+        Comments form reply trees nested under children, and some comments repeat their children under replies,
+        as the API does, so that the munger has duplicates to suppress """
+
+    def __init__(self, comments, seed=0, duplicate_fraction=0.3, max_depth=4):
+        self.comments = comments
+        self.rng = random.Random(seed)
+        self.duplicate_fraction = duplicate_fraction
+        self.max_depth = max_depth
+        self.posts = max(1, comments // COMMENTS_PER_POST)
+        self.authors = max(2, comments // 10)
+        self.companies = max(1, comments // 200)
+        # each topic's words are drawn 70% of the time and the common words otherwise
+        common = COMMON.split()
+        self.vocabularies = []
+        for topic in TOPICS:
+            words = topic.split()
+            self.vocabularies.append((words + common, [0.7 / len(words)] * len(words) + [0.3 / len(common)] * len(common)))
+        self.start = datetime(2015, 1, 1)
+        self.next_comment_id = 1
+
+    def write(self, raw_dir):
+        os.makedirs(raw_dir + '/posts', exist_ok=True)
+        os.makedirs(raw_dir + '/comments', exist_ok=True)
+        total_pages = (self.posts + POSTS_PER_PAGE - 1) // POSTS_PER_PAGE
+        remaining = self.comments
+
+        for page in range(1, total_pages + 1):
+            posts = []
+            for post_id in range((page - 1) * POSTS_PER_PAGE + 1, min(page * POSTS_PER_PAGE, self.posts) + 1):
+                # the last post takes whatever is left, so that the corpus has exactly the requested comments
+                posts_left = self.posts - post_id + 1
+                count = remaining if posts_left == 1 else min(remaining, round(2 * self.rng.random() * remaining / posts_left))
+                remaining -= count
+                post = self._post(post_id, count)
+                posts.append(post)
+                self._write_comments(raw_dir + '/comments', post, count)
+            self._write_page(f'{raw_dir}/posts/{page}', {'total_pages': total_pages, 'posts': posts})
+
+    def _post(self, post_id, comments_count):
+        sponsored = self.rng.random() < 0.05
+        return {
+            'id': post_id,
+            'date_gmt': self._date(post_id * 6),
+            'title': self._text(self.rng.randint(4, 12)),
+            'excerpt': self._text(self.rng.randint(15, 40)),
+            'comments_count': comments_count,
+            'is_sponsored': sponsored,
+            'read_time': self.rng.randint(1, 15),
+            'type': 'post',
+            'author': self._author(self.rng.randrange(self.authors // 20 + 1)),
+            'seo': {'title': self._text(6), 'description': self._text(20)},
+            'sponsor': {'name': 'sponsor', 'url': 'https://example.com'} if sponsored else {},
+            'categories': [{'id': category, 'name': f'category {category}', 'slug': f'category-{category}'}
+                           for category in self.rng.sample(range(30), self.rng.randint(1, 3))],
+            'companies': [{'id': company, 'name': f'company {company}', 'date_founded': str(2000 + company % 20)}
+                          for company in {self._skewed(self.companies) for _ in range(self.rng.randint(0, 3))}],
+            'tags': [{'id': tag, 'name': f'tag {tag}'} for tag in self.rng.sample(range(500), self.rng.randint(0, 5))]
+        }
+
+    def _write_comments(self, comments_dir, post, count):
+        roots = []
+        comments = []
+        for _ in range(count):
+            parent = self.rng.choice(comments) if comments and self.rng.random() < 0.5 else None
+            if parent is not None and parent['depth'] >= self.max_depth:
+                parent = None
+            comment = self._comment(post, parent)
+            comments.append(comment)
+            (parent['children'] if parent is not None else roots).append(comment)
+
+        for comment in comments:
+            del comment['depth']
+            if comment['children'] and self.rng.random() < self.duplicate_fraction:
+                comment['replies'] = list(comment['children'])
+
+        total_pages = max(1, (len(roots) + ROOT_COMMENTS_PER_PAGE - 1) // ROOT_COMMENTS_PER_PAGE)
+        for page in range(1, total_pages + 1):
+            page_roots = roots[(page - 1) * ROOT_COMMENTS_PER_PAGE:page * ROOT_COMMENTS_PER_PAGE]
+            self._write_page(f"{comments_dir}/{post['id']}_{page}", {'total_pages': total_pages, 'comments': page_roots})
+
+    def _comment(self, post, parent):
+        comment_id = self.next_comment_id
+        self.next_comment_id += 1
+        return {
+            'id': comment_id,
+            'post': post['id'],
+            'parent': parent['id'] if parent is not None else 0,
+            'date_gmt': self._date(post['id'] * 6 + self.rng.randint(1, 24 * 30)),
+            'excerpt': self._text(self.rng.randint(5, 40)),
+            'likes': self.rng.randint(0, 20),
+            'author': self._author(self._skewed(self.authors)),
+            'children': [],
+            'replies': [],
+            'depth': parent['depth'] + 1 if parent is not None else 0
+        }
+
+    def _author(self, author_id):
+        return {'id': author_id, 'display_name': f'author {author_id}', 'roles': ['subscriber'],
+                'avatar_url': f'https://example.com/{author_id}.png'}
+
+    def _text(self, words):
+        vocabulary, weights = self.vocabularies[self.rng.randrange(len(self.vocabularies))]
+        return ' '.join(self.rng.choices(vocabulary, weights, k=words)) + '.'
+
+    def _date(self, hours):
+        return (self.start + timedelta(hours=hours)).strftime('%Y-%m-%dT%H:%M:%S')
+
+    def _skewed(self, count):
+        # a few authors and companies account for most of the activity, as on the real site
+        return int(count ** self.rng.random()) - 1
+
+    @staticmethod
+    def _write_page(file_name, page):
+        # dumps uses the c encoder, which dump does not
+        with open(file_name, 'w') as f:
+            f.write(json.dumps(page))
+
+
+def write_corpus(data_dir, comments, seed=0):
+    """ Write a corpus of the given number of comments under data_dir/raw, unless the same one is already there """
+    marker_file = data_dir + '/corpus.json'
+    corpus = {'comments': comments, 'seed': seed}
+
+    if os.path.exists(marker_file):
+        with open(marker_file) as f:
+            if json.load(f) == corpus:
+                return
+        raise FileExistsError(f'{data_dir} holds a different corpus, remove it or use another directory')
+
+    CorpusGenerator(comments, seed=seed).write(data_dir + '/raw')
+    with open(marker_file, 'w') as f:
+        json.dump(corpus, f)
+
+
+if __name__ == "__main__":
+    write_corpus(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
@@ -0,0 +1,57 @@
+import sys
+import time
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from src.analysis.network_analysis import EDGE_ATTRIBUTES, load_graph
+
+
+def synthetic_edges(edges, authors=200000, companies=20000, seed=0):
+    """ Author -> company and author -> author edges shaped like edges.csv """
+    rng = np.random.default_rng(seed)
+    to_company = rng.random(edges) < 0.6
+    targets = np.where(to_company, rng.integers(0, companies, edges), rng.integers(companies, companies + authors, edges))
+
+    return pd.DataFrame({
+        'source': rng.integers(companies, companies + authors, edges),
+        'target': targets,
+        'source_type': 'author',
+        'target_type': np.where(to_company, 'company', 'author'),
+        'edge_type': np.where(rng.random(edges) < 0.2, 'post', 'comment'),
+        'label': 'excerpt'
+    })
+
+
+def load_graph_iterrows(edges_df):
+    """ The row by row loader network_analysis used before load_graph """
+    DG = nx.DiGraph()
+    for index, row in edges_df.iterrows():
+        DG.add_edges_from([(str(row['source']), str(row['target']))])
+    return DG
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    edges = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    edges_df = synthetic_edges(edges)
+
+    old_graph, old_time = timed(load_graph_iterrows, edges_df[['source', 'target']])
+    new_graph, new_time = timed(load_graph, edges_df)
+    attributes_graph, attributes_time = timed(load_graph, edges_df, edge_attributes=EDGE_ATTRIBUTES)
+    weighted_graph, weighted_time = timed(load_graph, edges_df, weighted=True)
+
+    assert list(old_graph.edges) == list(new_graph.edges)
+    assert sum(weight for _, _, weight in weighted_graph.edges(data='weight')) == edges
+
+    print(f'{edges} edges, {new_graph.number_of_edges()} distinct')
+    print(f'iterrows:             {old_time:.2f}s')
+    print(f'bulk:                 {new_time:.2f}s ({old_time / new_time:.1f}x)')
+    print(f'bulk with attributes: {attributes_time:.2f}s ({old_time / attributes_time:.1f}x)')
+    print(f'bulk weighted:        {weighted_time:.2f}s ({old_time / weighted_time:.1f}x)')
@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from benchmarks.graph_load import synthetic_edges, timed
+from src.analysis import sparse_centrality
+from src.pipeline.formats import read_frame, write_frame
+
+
+def full_refresh(edges_file):
+    return sparse_centrality.compute_centralities(read_frame(edges_file, columns=['source', 'target']))
+
+
+def incremental_refresh(store_file, delta_file):
+    return sparse_centrality.update_centralities(store_file, read_frame(delta_file, columns=['source', 'target']))
+
+
+if __name__ == "__main__":
+    edges = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    new_fraction = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    edges_df = synthetic_edges(edges)
+    split = int(edges * (1 - new_fraction))
+
+    with tempfile.TemporaryDirectory() as directory:
+        edges_file = os.path.join(directory, 'edges.csv')
+        delta_file = os.path.join(directory, 'edges_delta.csv')
+        store_file = os.path.join(directory, 'centrality_store.npz')
+        write_frame(edges_df, edges_file)
+        write_frame(edges_df.iloc[split:], delta_file)
+        sparse_centrality.update_centralities(store_file, edges_df.iloc[:split])
+
+        # both refreshes read their edges from csv, as network_analysis does
+        full_df, full_time = timed(full_refresh, edges_file)
+        update_df, update_time = timed(incremental_refresh, store_file, delta_file)
+
+    for column in ['in_degree_centrality', 'out_degree_centrality', 'eigenvector_centrality']:
+        error = np.abs(update_df[column].to_numpy() - full_df[column].to_numpy()).max()
+        print(f'{column} max abs difference: {error:.2e}')
+
+    print(f'{edges} edges, {edges - split} new')
+    print(f'full:        {full_time:.2f}s')
+    print(f'incremental: {update_time:.2f}s ({full_time / update_time:.1f}x)')
@@ -0,0 +1,70 @@
+import random
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.streaming_clusters import synthetic_comments
+from src.pipeline.near_duplicates import MinHashIndex
+
+
+def with_reposts(texts, fraction=0.05, seed=0):
+    """ texts followed by reposts of a fraction of them, each with one word replaced and its case changed,
+        returned with the position of the text each repost copies """
+    rng = random.Random(seed)
+    originals = rng.sample(range(len(texts)), int(len(texts) * fraction))
+    reposts = []
+    for original in originals:
+        words = texts[original].split()
+        words[rng.randrange(len(words))] = 'spam'
+        reposts.append(' '.join(words).upper())
+    return texts + reposts, np.array(originals)
+
+
+def shingles(text, k=5):
+    text = ' '.join(text.lower().split())
+    return {text[i:i + k] for i in range(max(len(text) - k + 1, 1))}
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def all_pairs(texts, threshold=0.8):
+    """ Exact Jaccard similarity of every pair of texts, the quadratic comparison the index avoids """
+    sets = [shingles(text) for text in texts]
+    return [(i, j) for i in range(len(sets)) for j in range(i) if jaccard(sets[i], sets[j]) >= threshold]
+
+
+def indexed(texts, batch_size=100000):
+    index = MinHashIndex()
+    ids = np.arange(len(texts))
+    for start in range(0, len(texts), batch_size):
+        index.add(ids[start:start + batch_size], texts[start:start + batch_size])
+    return index.groups(ids)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    texts, originals = with_reposts(synthetic_comments(count)[0])
+
+    for size in [count // 4, count // 2, count]:
+        start = time.perf_counter()
+        indexed(texts[:size])
+        elapsed = time.perf_counter() - start
+        print(f'{size} comments indexed in {elapsed:.2f}s, {elapsed / size * 1e6:.1f}us per comment')
+
+    groups = indexed(texts)
+    reposts = count + np.arange(len(originals))
+    similar = np.array([jaccard(shingles(texts[original]), shingles(texts[repost])) >= 0.8
+                        for original, repost in zip(originals, reposts)])
+    found = groups[reposts] == groups[originals]
+    print(f'{similar.sum()} reposts with a Jaccard similarity of 0.8 or more, {found[similar].mean():.3f} found')
+    print(f'{(groups != np.arange(len(texts))).sum()} of {len(texts)} comments grouped as near duplicates')
+
+    sample = 2000
+    start = time.perf_counter()
+    all_pairs(texts[:sample])
+    elapsed = time.perf_counter() - start
+    print(f'all pairs of {sample} comments in {elapsed:.2f}s, '
+          f'about {elapsed * (len(texts) / sample) ** 2 / 3600:.0f}h for {len(texts)}')
@@ -0,0 +1,74 @@
+import sys
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.centrality import measured
+from src.pipeline.network_prep import prepare_edges
+
+
+def synthetic_staging(comments, seed=0):
+    """ Posts, companies and comments frames shaped like the staging files, after read_staging """
+    rng = np.random.default_rng(seed)
+    posts = max(comments // 20, 1)
+    companies = posts * 2
+    comment_ids = np.arange(1, comments + 1)
+    start = np.datetime64('2015-01-01T00:00:00')
+
+    posts_df = pd.DataFrame({
+        'post_id': np.arange(1, posts + 1),
+        'date_gmt': (start + np.arange(posts) * np.timedelta64(6, 'h')).astype(str),
+        'title': 'title',
+        'author_id': rng.integers(0, posts // 5 + 1, posts)
+    })
+    companies_df = pd.DataFrame({
+        'company_id': rng.integers(0, companies // 4 + 1, companies),
+        'post_id': rng.integers(1, posts + 1, companies)
+    })
+    comments_df = pd.DataFrame({
+        'comment_id': comment_ids,
+        'date_gmt': (start + np.sort(rng.integers(0, posts * 6, comments)) * np.timedelta64(1, 'h')).astype(str),
+        'post_id': rng.integers(1, posts + 1, comments),
+        'excerpt': 'excerpt',
+        'parent_id': np.where(rng.random(comments) < 0.5, 0, rng.choice(comment_ids, comments)),
+        'author_id': rng.integers(0, comments // 10 + 1, comments)
+    })
+    return posts_df, companies_df, comments_df
+
+
+def prepare_edges_merge(posts_df, companies_df, comments_df):
+    """ The merge based edge generation network_prep used before prepare_edges """
+    author_to_posts_df = pd.merge(posts_df, companies_df, on='post_id')
+    author_to_posts_df = author_to_posts_df[['post_id', 'company_id', 'author_id', 'title']]
+    author_to_company_df = author_to_posts_df[['company_id', 'author_id', 'title']]
+    author_to_company_df = author_to_company_df.rename(index=str, columns={'author_id': 'source', 'company_id': 'target', 'title': 'excerpt'})
+
+    comments_to_posts_df = pd.merge(author_to_posts_df[['post_id', 'company_id']], comments_df, on='post_id')
+    comments_on_posts_df = comments_to_posts_df.loc[comments_to_posts_df['parent_id'] == 0]
+    comments_on_posts_df = comments_on_posts_df[['company_id', 'author_id', 'excerpt']]
+    comments_on_posts_df = comments_on_posts_df.rename(index=str, columns={'author_id': 'source', 'company_id': 'target'})
+
+    comment_parents_df = comments_df[['comment_id', 'author_id']]
+    comment_parents_df = comment_parents_df.rename(index=str, columns={'comment_id': 'parent_id', 'author_id': 'parent_author_id'})
+    comments_on_comments_df = pd.merge(comments_df, comment_parents_df, on='parent_id')
+    comments_on_comments_df = comments_on_comments_df.loc[comments_on_comments_df['parent_id'] != 0]
+    comments_on_comments_df = comments_on_comments_df[['author_id', 'parent_author_id', 'excerpt']]
+    comments_on_comments_df = comments_on_comments_df.rename(index=str, columns={'author_id': 'source', 'parent_author_id': 'target'})
+
+    all_edges_df = pd.concat([author_to_company_df, comments_on_posts_df, comments_on_comments_df])
+    return all_edges_df.rename(index=str, columns={'excerpt': 'label'})
+
+
+if __name__ == "__main__":
+    comments = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    frames = synthetic_staging(comments)
+
+    old_df, old_time, old_peak = measured(prepare_edges_merge, *frames)
+    new_df, new_time, new_peak = measured(prepare_edges, *frames)
+
+    assert old_df.index.tolist() == new_df.index.astype(str).tolist()
+    assert (old_df[['source', 'target', 'label']].to_numpy() == new_df[['source', 'target', 'label']].to_numpy()).all()
+
+    print(f'{comments} comments, {len(new_df)} edges')
+    print(f'merge:   {old_time:.2f}s, peak {old_peak:.0f}MB')
+    print(f'indexed: {new_time:.2f}s, peak {new_peak:.0f}MB')
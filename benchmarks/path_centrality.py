@@ -0,0 +1,52 @@
+import os
+import sys
+
+import networkx as nx
+import numpy as np
+
+from benchmarks.graph_load import synthetic_edges, timed
+from src.analysis import sparse_centrality
+from src.analysis.network_analysis import load_graph
+
+
+def exact_path_centralities(edges_df):
+    DG = load_graph(edges_df)
+    return nx.betweenness_centrality(DG), nx.closeness_centrality(DG)
+
+
+def accuracy(estimate, error, exact):
+    """ Median relative error over the nodes in the top decile of the exact values,
+        and the fraction of those within two standard errors of their estimate """
+    top = exact > np.quantile(exact, 0.9)
+    relative = np.abs(estimate - exact)[top] / exact[top]
+    return np.median(relative), (np.abs(estimate - exact)[top] <= 2 * error[top]).mean()
+
+
+if __name__ == "__main__":
+    edges = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+
+    small_df = synthetic_edges(20000, authors=8000, companies=800)[['source', 'target']]
+    (betweenness, closeness), exact_time = timed(exact_path_centralities, small_df)
+    graph = sparse_centrality.SparseGraph.from_edges(small_df)
+    exact_betweenness = np.array([betweenness[label] for label in graph.labels])
+    exact_closeness = np.array([closeness[label] for label in graph.labels])
+    print(f'{len(small_df)} edges, {graph.node_count} nodes, networkx exact: {exact_time:.2f}s')
+
+    for samples in [50, 200, 800]:
+        paths, elapsed = timed(sparse_centrality.sampled_path_centralities, graph, samples, workers=workers)
+        betweenness_error, betweenness_cover = accuracy(paths[0], paths[1], exact_betweenness)
+        closeness_error, closeness_cover = accuracy(paths[2], paths[3], exact_closeness)
+        # dependencies are heavily skewed, so small samples understate the betweenness error
+        print(f'{samples:>4} sources: {elapsed:.2f}s, '
+              f'betweenness {betweenness_error:.3f} relative error, {betweenness_cover:.2f} within 2 errors, '
+              f'closeness {closeness_error:.3f} relative error, {closeness_cover:.2f} within 2 errors')
+
+    edges_df = synthetic_edges(edges)[['source', 'target']]
+    graph = sparse_centrality.SparseGraph.from_edges(edges_df)
+    samples = 64
+    _, serial_time = timed(sparse_centrality.sampled_path_centralities, graph, samples)
+    _, parallel_time = timed(sparse_centrality.sampled_path_centralities, graph, samples, workers=workers)
+    print(f'{edges} edges, {graph.node_count} nodes, {samples} sources')
+    print(f'1 worker:   {serial_time:.2f}s, about {serial_time / samples * graph.node_count / 3600:.1f}h for every source')
+    print(f'{workers} workers: {parallel_time:.2f}s ({serial_time / parallel_time:.1f}x)')
@@ -0,0 +1,67 @@
+import random
+import sys
+
+from sklearn.metrics import adjusted_rand_score, silhouette_score
+
+from benchmarks.centrality import measured
+from src.analysis.text_cluster import TextPreprocessor, cluster_texts, cluster_texts_streaming, vectorize_texts
+
+TOPICS = [
+    'startup funding round investors venture capital series seed valuation raise',
+    'ecommerce marketplace payments logistics delivery shoppers checkout retail',
+    'ride hailing drivers grab uber transport fares commuters motorbike',
+    'hiring engineers salary talent recruitment remote developers team',
+]
+COMMON = 'singapore indonesia company market growth users asia business'
+
+
+def synthetic_comments(count, seed=0):
+    """ Comments drawn mostly from one topic's vocabulary each, returned with the topic they were drawn from """
+    rng = random.Random(seed)
+    topics = [topic.split() for topic in TOPICS]
+    common = COMMON.split()
+
+    texts, truth = [], []
+    for _ in range(count):
+        topic = rng.randrange(len(topics))
+        words = [rng.choice(topics[topic]) if rng.random() < 0.7 else rng.choice(common) for _ in range(rng.randint(5, 30))]
+        texts.append(' '.join(words) + '.')
+        truth.append(topic)
+    return texts, truth
+
+
+def to_labels(clustering, count):
+    labels = [0] * count
+    for label, indices in clustering.items():
+        for idx in indices:
+            labels[idx] = label
+    return labels
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    chunk_size = 10000
+    texts, truth = synthetic_comments(count)
+    preprocessor = TextPreprocessor(tokenizer=TextPreprocessor.Tokenizer.REGEX)
+
+    def read_chunks():
+        return (texts[i:i + chunk_size] for i in range(0, count, chunk_size))
+
+    batch, batch_time, batch_peak = measured(cluster_texts, texts, len(TOPICS), preprocessor=preprocessor)
+    streaming, streaming_time, streaming_peak = measured(cluster_texts_streaming, read_chunks, len(TOPICS),
+                                                         preprocessor=preprocessor)
+    batch_labels = to_labels(batch, count)
+    streaming_labels = to_labels(streaming, count)
+
+    # silhouettes are both measured in the batch tf-idf space on the same sample
+    _, tfidf_model = vectorize_texts(texts, preprocessor)
+    sample = min(count, 10000)
+
+    print(f'{count} comments in chunks of {chunk_size}')
+    print(f'batch:     {batch_time:.2f}s, peak {batch_peak:.0f}MB, '
+          f'ARI vs topics {adjusted_rand_score(truth, batch_labels):.3f}, '
+          f'silhouette {silhouette_score(tfidf_model, batch_labels, sample_size=sample, random_state=0):.3f}')
+    print(f'streaming: {streaming_time:.2f}s, peak {streaming_peak:.0f}MB, '
+          f'ARI vs topics {adjusted_rand_score(truth, streaming_labels):.3f}, '
+          f'silhouette {silhouette_score(tfidf_model, streaming_labels, sample_size=sample, random_state=0):.3f}')
+    print(f'ARI between batch and streaming clusters {adjusted_rand_score(batch_labels, streaming_labels):.3f}')
@@ -0,0 +1,184 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.corpus import write_corpus
+from src.analysis.network_analysis import analyse_network, load_graph
+from src.analysis.text_cluster import TextPreprocessor, cluster_comments, read_excerpts, tokenize_texts
+from src.analysis.text_cluster import english_stop_words
+from src.pipeline import instrumentation
+from src.pipeline.formats import read_frame
+from src.pipeline.instrumentation import run_measured
+from src.pipeline.munger import CommentsJsonToCsv, munge_comments, munge_posts
+from src.pipeline.near_duplicates import find_near_duplicates
+from src.pipeline.network_prep import build_network
+
+# corpora above this many comments are clustered with the streaming mode, as the in memory one would not fit
+STREAMING_THRESHOLD = 1000000
+
+
+def munge_posts_stage(data_dir):
+    munge_posts(data_dir=data_dir)
+
+
+def munge_comments_stage(data_dir):
+    comment_munger = CommentsJsonToCsv(data_dir + '/raw/comments/', data_dir + '/staging/comments.csv',
+                                       exclude=['children', 'replies', 'author'])
+    comment_munger.write_data_to_csv()
+
+
+def dedup_stage(data_dir):
+    munge_comments(data_dir=data_dir)
+
+
+def near_duplicates_stage(data_dir):
+    # the index is built from scratch, as an index left by an earlier run would already hold every comment
+    index_file = data_dir + '/staging/minhash_index.npz'
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    find_near_duplicates(data_dir + '/staging/comments_dedup.csv', data_dir + '/staging/duplicate_groups.csv',
+                         index_file)
+
+
+def edges_stage(data_dir):
+    build_network(data_dir + '/staging', data_dir + '/network_input')
+
+
+def graph_load_stage(data_dir):
+    edges_df = read_frame(data_dir + '/network_input/edges.csv', columns=['source', 'target'])
+    DG = load_graph(edges_df)
+    instrumentation.count('edges', len(edges_df))
+    instrumentation.count('nodes', DG.number_of_nodes())
+
+
+def centralities_stage(data_dir):
+    analyse_network(data_dir + '/network_input', data_dir + '/network_output')
+
+
+def tokenize_stage(data_dir):
+    texts = [text for chunk in read_excerpts(data_dir + '/staging/comments_dedup.csv') for text in chunk]
+    preprocessor = TextPreprocessor(tokenizer=TextPreprocessor.Tokenizer.REGEX)
+    documents = tokenize_texts(texts, preprocessor, english_stop_words())
+    instrumentation.count('documents', len(documents))
+    instrumentation.count('tokens', sum(len(tokens) for tokens in documents))
+
+
+def cluster_stage(data_dir, streaming):
+    preprocessor = TextPreprocessor(tokenizer=TextPreprocessor.Tokenizer.REGEX)
+    cluster_comments(data_dir + '/staging/comments_dedup.csv', data_dir + '/analysis/clusters.csv', 7,
+                     streaming=streaming, preprocessor=preprocessor)
+
+
+STAGES = [
+    ('munge_posts', munge_posts_stage),
+    ('munge_comments', munge_comments_stage),
+    ('dedup', dedup_stage),
+    ('near_duplicates', near_duplicates_stage),
+    ('edges', edges_stage),
+    ('graph_load', graph_load_stage),
+    ('centralities', centralities_stage),
+    ('tokenize', tokenize_stage),
+    ('cluster', cluster_stage)
+]
+
+
+def version():
+    """ Commit of the working tree, marked dirty when it has uncommitted changes """
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', '-C', repository, 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', '-C', repository, 'status', '--porcelain', '--untracked-files=no'],
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def run_suite(data_dir, comments, seed=0, stages=None):
+    """ Time every stage over a synthetic corpus of the given size, returning one result record.
+        Each stage runs in a fresh process, so that its peak rss is its own """
+    write_corpus(data_dir, comments, seed=seed)
+    for directory in ['staging', 'network_input', 'network_output', 'analysis']:
+        os.makedirs(f'{data_dir}/{directory}', exist_ok=True)
+
+    result = {
+        'version': version(),
+        'timestamp': time.time(),
+        'comments': comments,
+        'seed': seed,
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'stages': {}
+    }
+    for name, function in STAGES:
+        if stages and name not in stages:
+            continue
+
+        # the munge stages would otherwise reuse the schema discovered by an earlier run or stage
+        for schema_file in glob.glob(data_dir + '/raw/*_schema.json'):
+            os.remove(schema_file)
+
+        params = {'data_dir': data_dir}
+        if name == 'cluster':
+            params['streaming'] = comments > STREAMING_THRESHOLD
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result['stages'][name] = executor.submit(run_measured, name, function, params).result()
+        print(f"{name}: {result['stages'][name]['wall_time']:.2f}s, peak {result['stages'][name]['peak_rss_mb']:.0f}MB")
+    return result
+
+
+def read_results(results_file):
+    with open(results_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(results, comments=None):
+    """ Print the wall time and peak rss of each stage across versions, for every corpus size """
+    sizes = sorted({result['comments'] for result in results if comments is None or result['comments'] == comments})
+
+    for size in sizes:
+        runs = [result for result in results if result['comments'] == size]
+        stages = [name for name, _ in STAGES if any(name in run['stages'] for run in runs)]
+        print(f'\n{size} comments')
+        print(f"{'stage':<16}" + ''.join(f"{run['version']:>24}" for run in runs))
+
+        for stage in stages:
+            cells = []
+            for run in runs:
+                metrics = run['stages'].get(stage)
+                cells.append(f"{metrics['wall_time']:>9.2f}s {metrics['peak_rss_mb']:>8.0f}MB" if metrics else '')
+            print(f'{stage:<16}' + ''.join(f'{cell:>24}' for cell in cells))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the pipeline stages over synthetic TechInAsia shaped corpora')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the suite and append the results')
+    run_parser.add_argument('comments', type=int, nargs='+', help='corpus sizes, in comments')
+    run_parser.add_argument('--data-dir', default='benchmark_data', help='where corpora are generated and kept')
+    run_parser.add_argument('--results', default='benchmark_data/benchmark_results.jsonl')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--stages', nargs='*', choices=[name for name, _ in STAGES])
+
+    compare_parser = subparsers.add_parser('compare', help='compare the stored results across versions')
+    compare_parser.add_argument('--results', default='benchmark_data/benchmark_results.jsonl')
+    compare_parser.add_argument('--comments', type=int)
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        for comments in args.comments:
+            result = run_suite(os.path.abspath(f'{args.data_dir}/{comments}'), comments, seed=args.seed,
+                               stages=args.stages)
+            os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+            with open(args.results, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+    else:
+        compare(read_results(args.results), comments=args.comments)
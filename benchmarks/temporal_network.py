@@ -0,0 +1,46 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.graph_load import synthetic_edges, timed
+from src.analysis import sparse_centrality
+from src.analysis.network_analysis import compute_centralities, load_graph
+from src.analysis.temporal_network import window_bounds, windowed_centralities
+
+
+def dated_edges(edges, years=5, seed=0):
+    """ synthetic_edges dated uniformly over a number of years, as date_gmt strings like network_prep writes """
+    edges_df = synthetic_edges(edges, seed=seed)[['source', 'target']]
+    hours = np.random.default_rng(seed).integers(0, years * 365 * 24, edges)
+    edges_df['date_gmt'] = (np.datetime64('2015-01-01T00:00:00') + hours * np.timedelta64(1, 'h')).astype(str)
+    return edges_df
+
+
+def rebuilt_windows(edges_df, frequency='MS', window=1, step=1):
+    """ Every window's centralities computed from scratch from its own edges """
+    dates = pd.to_datetime(edges_df['date_gmt'])
+    starts, ends = window_bounds(dates, frequency, window, step)
+    return [sparse_centrality.compute_centralities(edges_df[(dates >= start) & (dates < end)])
+            for start, end in zip(starts, ends)]
+
+
+if __name__ == "__main__":
+    edges = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    edges_df = dated_edges(edges)
+
+    _, networkx_time = timed(lambda: compute_centralities(load_graph(edges_df)))
+    _, full_time = timed(sparse_centrality.compute_centralities, edges_df)
+    print(f'{edges} edges over 5 years, full graph: networkx {networkx_time:.2f}s, sparse {full_time:.2f}s')
+
+    for name, window, step in [('monthly', 1, 1), ('3 month sliding', 3, 1)]:
+        _, rebuilt_time = timed(rebuilt_windows, edges_df, window=window, step=step)
+        _, serial_time = timed(windowed_centralities, edges_df, window=window, step=step)
+        windows_df, parallel_time = timed(windowed_centralities, edges_df, window=window, step=step, workers=workers)
+        print(f'{name}: {windows_df["window_start"].nunique()} windows, {len(windows_df)} rows')
+        print(f'  rebuilt:   {rebuilt_time:.2f}s')
+        print(f'  moved:     {serial_time:.2f}s ({rebuilt_time / serial_time:.1f}x)')
+        print(f'  {workers} workers: {parallel_time:.2f}s ({parallel_time / networkx_time:.2f}x the networkx and '
+              f'{parallel_time / full_time:.1f}x the sparse full graph)')
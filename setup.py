@@ -1,5 +1,27 @@
-import nltk
+from setuptools import find_packages, setup
 
-# download stopwords
-# download punkt
-nltk.download()
+# the nltk corpora text_cluster uses are not python packages, download them with: tia download-corpora
+setup(
+    name='tia_text_analytics',
+    version='0.1.0',
+    description='Crawl, munge and analyse TechInAsia posts and comments',
+    packages=find_packages(include=['src', 'src.*']),
+    python_requires='>=3.8',
+    install_requires=[
+        'requests',
+        'numpy',
+        'scipy',
+        'pandas>=2.0',
+        'networkx',
+        'nltk',
+        'scikit-learn',
+    ],
+    extras_require={
+        # parquet and feather staging files
+        'arrow': ['pyarrow'],
+        'plots': ['matplotlib'],
+    },
+    entry_points={
+        'console_scripts': ['tia = src.cli:main'],
+    },
+)
@@ -1,39 +1,54 @@
-import networkx as nx
-import pandas as pd
-import csv
+import os
+from enum import Enum
 
+from src.pipeline import instrumentation
+from src.pipeline.formats import OutputFormat, read_frame, write_frame, with_extension
 
-base_dir = '/home/timothy/Projects/assignments/tia_text_analytics/data'
 
-companies_node_csv = base_dir + '/network_input/companies_node.csv'
-authors_node_csv = base_dir + '/network_input/authors_node.csv'
-all_edges_csv = base_dir + '/network_input/edges.csv'
-centrality_csv = base_dir + '/network_output/centralities.csv'
+base_dir = '/home/timothy/Projects/assignments/tia_text_analytics/data'
+# format of the network input files read, and of the centralities written
+input_format = OutputFormat.CSV
+output_format = OutputFormat.CSV
 
-companies_node_df = pd.read_csv(companies_node_csv, quoting=csv.QUOTE_ALL)
-authors_node_df = pd.read_csv(authors_node_csv, quoting=csv.QUOTE_ALL)
-edges_df = pd.read_csv(all_edges_csv, quoting=csv.QUOTE_ALL)
+EDGE_ATTRIBUTES = ['source_type', 'target_type', 'edge_type', 'label']
 
 
+class CentralityBackend(Enum):
+    NETWORKX = "networkx"
+    SPARSE = "sparse"
 
-DG = nx.DiGraph()
 
+def load_graph(edges_df, edge_attributes=None, weighted=False):
+    """ Build a directed graph from whole edge columns in one bulk call.
+        Parallel edges keep the attributes of the last edge, and with weighted they are counted into a weight """
+    import networkx as nx
+    import numpy as np
 
-for index,row in edges_df.iterrows():  # edge_type|excerpt|from|from_type|to|to_type
-    from_node, to_node = str(row['source']), str(row['target'])
-    # edge_data = {
-    #     'source_type': row['source_type'],
-    #     'target_type': row['target_type'],
-    #     'edge_type':   row['edge_type'],
-    #     'label':       row['label']
-    # }
-    DG.add_edges_from([(from_node, to_node)])
+    edge_attributes = list(edge_attributes or [])
+    edges_df = edges_df[['source', 'target'] + edge_attributes]
 
+    if weighted:
+        grouped = edges_df.groupby(['source', 'target'], sort=False)
+        if edge_attributes:
+            # the whole row of the last of each group of parallel edges, in the order the groups first appear.
+            # grouped.last() would take the last non-null value of every column separately
+            last = (grouped.cumcount(ascending=False) == 0).to_numpy()
+            order = np.argsort(grouped.ngroup().to_numpy()[last], kind='stable')
+            edges_df = edges_df[last].iloc[order].assign(weight=grouped['source'].transform('size')[last].iloc[order])
+        else:
+            edges_df = grouped.size().to_frame('weight').reset_index()
+        edge_attributes.append('weight')
 
+    sources = list(map(str, edges_df['source'].tolist()))
+    targets = list(map(str, edges_df['target'].tolist()))
 
-in_degree = nx.in_degree_centrality(DG)
-out_degree = nx.out_degree_centrality(DG)
-eigen = nx.eigenvector_centrality_numpy(DG)
+    DG = nx.DiGraph()
+    if edge_attributes:
+        values = zip(*(edges_df[attribute].tolist() for attribute in edge_attributes))
+        DG.add_edges_from(zip(sources, targets, (dict(zip(edge_attributes, row)) for row in values)))
+    else:
+        DG.add_edges_from(zip(sources, targets))
+    return DG
 
 
 def transform_to_series(centrality):
@@ -46,37 +61,131 @@ def transform_to_series(centrality):
     return {'label': label, 'values': values}
 
 
-in_degree_series = transform_to_series(in_degree)
-out_degree_series = transform_to_series(out_degree)
-eigen_series = transform_to_series(eigen)
-
-in_df = pd.DataFrame(in_degree_series)
-out_df = pd.DataFrame(out_degree_series)
-eigen_df = pd.DataFrame(eigen_series)
-print(in_df.shape)
-print(out_df.shape)
-print(eigen_df.shape)
-
-
-# in_df = in_df.loc[in_df['values'] != 0]
-# out_df = out_df.loc[out_df['values'] != 0]
-# eigen_df = eigen_df.loc[eigen_df['values'] != 0]
-# print(in_df.shape)
-# print(out_df.shape)
-# print(eigen_df.shape)
-
-
-in_df = in_df.rename(index=str, columns={'values': 'in_degree_centrality'})
-out_df = out_df.rename(index=str, columns={'values': 'out_degree_centrality'})
-eigen_df = eigen_df.rename(index=str, columns={'values': 'eigenvector_centrality'})
-
-in_out_df = pd.merge(in_df, out_df, how='outer', on='label')
-all_df = pd.merge(in_out_df, eigen_df, how='outer', on='label')
-
-
-all_nodes_df = pd.concat([companies_node_df, authors_node_df])
-all_nodes_df = all_nodes_df.rename(index=str, columns={'label': 'name', 'id': 'label'})
-all_nodes_df['label'] = all_nodes_df['label'].apply(lambda x: str(x))
-full_df = pd.merge(all_df, all_nodes_df, on='label')
-
-full_df.to_csv(centrality_csv, quoting=csv.QUOTE_ALL)
+def compute_centralities(DG):
+    import networkx as nx
+    import pandas as pd
+
+    in_degree = nx.in_degree_centrality(DG)
+    out_degree = nx.out_degree_centrality(DG)
+    eigen = nx.eigenvector_centrality_numpy(DG)
+
+    in_degree_series = transform_to_series(in_degree)
+    out_degree_series = transform_to_series(out_degree)
+    eigen_series = transform_to_series(eigen)
+
+    in_df = pd.DataFrame(in_degree_series)
+    out_df = pd.DataFrame(out_degree_series)
+    eigen_df = pd.DataFrame(eigen_series)
+    print(in_df.shape)
+    print(out_df.shape)
+    print(eigen_df.shape)
+
+    # in_df = in_df.loc[in_df['values'] != 0]
+    # out_df = out_df.loc[out_df['values'] != 0]
+    # eigen_df = eigen_df.loc[eigen_df['values'] != 0]
+    # print(in_df.shape)
+    # print(out_df.shape)
+    # print(eigen_df.shape)
+
+    in_df = in_df.rename(index=str, columns={'values': 'in_degree_centrality'})
+    out_df = out_df.rename(index=str, columns={'values': 'out_degree_centrality'})
+    eigen_df = eigen_df.rename(index=str, columns={'values': 'eigenvector_centrality'})
+
+    in_out_df = pd.merge(in_df, out_df, how='outer', on='label')
+    return pd.merge(in_out_df, eigen_df, how='outer', on='label')
+
+
+def join_nodes(all_df, companies_node_df, authors_node_df):
+    import pandas as pd
+
+    all_nodes_df = pd.concat([companies_node_df, authors_node_df])
+    all_nodes_df = all_nodes_df.rename(index=str, columns={'label': 'name', 'id': 'label'})
+    all_nodes_df['label'] = all_nodes_df['label'].apply(lambda x: str(x))
+    return pd.merge(all_df, all_nodes_df, on='label')
+
+
+def read_new_edges(network_input_dir, store_file, input_format=OutputFormat.CSV):
+    """ The edges the centrality store has not been updated with yet, with the id of their network.
+        edges_delta only holds the edges of the last network_prep.update_network, so the new edges are read from
+        edges when the store has missed an update. The store is removed when it was kept for another network, such as
+        the one before the last network_prep.build_network, and every edge is returned """
+    from src.analysis import sparse_centrality
+    from src.pipeline.network_prep import read_state
+
+    network_id = read_state(network_input_dir).get('network_id')
+    consumed = sparse_centrality.consumed_edges(store_file, network_id)
+    columns = ['index_id', 'source', 'target']
+    delta_file = with_extension(network_input_dir + '/edges_delta.csv', input_format)
+
+    if consumed is None:
+        if os.path.exists(store_file):
+            os.remove(store_file)
+        return _read_edges(with_extension(network_input_dir + '/edges.csv', input_format), columns), network_id
+
+    if os.path.exists(delta_file):
+        edges_df = _read_edges(delta_file, columns)
+        if len(edges_df) and edges_df['index_id'].min() <= consumed:
+            return edges_df[edges_df['index_id'] >= consumed], network_id
+
+    edges_df = _read_edges(with_extension(network_input_dir + '/edges.csv', input_format), columns)
+    return edges_df[edges_df['index_id'] >= consumed], network_id
+
+
+def _read_edges(file_name, columns):
+    edges_df = read_frame(file_name, columns=columns)
+    # parquet files restore index_id as the index
+    return edges_df.reset_index() if edges_df.index.name == 'index_id' else edges_df
+
+
+def analyse_network(network_input_dir, network_output_dir, backend=CentralityBackend.SPARSE, edge_attributes=None,
+                    incremental=False, input_format=OutputFormat.CSV, output_format=OutputFormat.CSV, path_samples=None,
+                    workers=1):
+    """ Compute the centralities of the network written by network_prep and join them to the node attributes.
+        incremental only adds the edges the centrality store has not seen yet, see read_new_edges, and always uses
+        the sparse backend.
+        With path_samples, betweenness and closeness are estimated from that many source nodes across workers
+        processes and added with their standard errors """
+    import pandas as pd
+    from src.analysis import sparse_centrality
+
+    companies_node_df = read_frame(with_extension(network_input_dir + '/companies_node.csv', input_format))
+    authors_node_df = read_frame(with_extension(network_input_dir + '/authors_node.csv', input_format))
+    edges_file = with_extension(network_input_dir + '/edges.csv', input_format)
+    store_file = network_output_dir + '/centrality_store.npz'
+
+    if incremental:
+        # the first incremental run builds the store from every edge
+        edges_df, network_id = read_new_edges(network_input_dir, store_file, input_format)
+        all_df = sparse_centrality.update_centralities(store_file, edges_df, path_samples=path_samples,
+                                                       workers=workers, network_id=network_id)
+    elif backend == CentralityBackend.SPARSE:
+        edges_df = read_frame(edges_file, columns=['source', 'target'])
+        all_df = sparse_centrality.compute_centralities(edges_df, path_samples=path_samples, workers=workers)
+    else:
+        edges_df = read_frame(edges_file, columns=['source', 'target'] + (edge_attributes or []))
+        DG = load_graph(edges_df, edge_attributes=edge_attributes)
+        all_df = compute_centralities(DG)
+        if path_samples:
+            # exact networkx betweenness and closeness are O(nm), the sampled ones come from the sparse backend
+            paths_df = sparse_centrality.path_centralities(edges_df, path_samples, workers=workers)
+            all_df = pd.merge(all_df, paths_df, how='outer', on='label')
+    full_df = join_nodes(all_df, companies_node_df, authors_node_df)
+    instrumentation.count('edges', len(edges_df))
+    instrumentation.count('nodes', len(all_df))
+
+    write_frame(full_df, with_extension(network_output_dir + '/centralities.csv', output_format))
+
+
+if __name__ == "__main__":
+    backend = CentralityBackend.SPARSE
+    # set to EDGE_ATTRIBUTES to keep the edge attributes on the graph, only used by the networkx backend
+    edge_attributes = None
+    # set to only add the edges added by network_prep.update_network since the last run, always uses the sparse backend
+    incremental = False
+    # set to a number of source nodes to estimate betweenness and closeness from, split across workers processes
+    path_samples = None
+    workers = os.cpu_count()
+
+    analyse_network(base_dir + '/network_input', base_dir + '/network_output', backend=backend,
+                    edge_attributes=edge_attributes, incremental=incremental, input_format=input_format,
+                    output_format=output_format, path_samples=path_samples, workers=workers)
@@ -0,0 +1,345 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# columns added by the sampled path centralities, each estimate followed by its standard error
+PATH_COLUMNS = ['betweenness_centrality', 'betweenness_error', 'closeness_centrality', 'closeness_error']
+# the path searches are summed in this many chunks of sources whatever the number of workers, so that the floating
+# point sums, and so the results, do not depend on it
+PATH_CHUNKS = 64
+
+
+class SparseGraph:
+    """ Directed graph held as a binary CSR adjacency matrix over integer node indices.
+        labels maps each index back to its node id, in the order networkx would have inserted the nodes """
+
+    def __init__(self, adjacency, labels):
+        self.adjacency = adjacency
+        self.labels = labels
+
+    @property
+    def node_count(self):
+        return len(self.labels)
+
+    @staticmethod
+    def _edge_codes(edges_df):
+        """ Interleaved source and target codes, and the node ids they index in order of first appearance """
+        sources = edges_df['source'].to_numpy()
+        targets = edges_df['target'].to_numpy()
+
+        codes, labels = pd.factorize(np.column_stack([sources, targets]).ravel())
+        # node ids are compared as strings, like the networkx loader does
+        label_codes, labels = pd.factorize(np.asarray(list(map(str, labels)), dtype=object))
+        return label_codes[codes], np.asarray(labels, dtype=object)
+
+    @staticmethod
+    def _binary_adjacency(codes, node_count):
+        adjacency = sp.csr_matrix((np.ones(len(codes) // 2), (codes[0::2], codes[1::2])), shape=(node_count, node_count))
+        # parallel edges collapse into one, as they do in a DiGraph
+        adjacency.sum_duplicates()
+        adjacency.data[:] = 1
+        return adjacency
+
+    @classmethod
+    def from_edges(cls, edges_df):
+        codes, labels = cls._edge_codes(edges_df)
+        return cls(cls._binary_adjacency(codes, len(labels)), labels)
+
+    def add_edges(self, edges_df):
+        """ The graph with the given edges added, new nodes are numbered after the existing ones.
+            Also returns the adjacency of the edges that were not in the graph yet """
+        codes, labels = self._edge_codes(edges_df)
+        positions = pd.Index(self.labels).get_indexer(labels)
+        unseen = positions == -1
+        positions[unseen] = self.node_count + np.arange(unseen.sum())
+        labels = np.concatenate([self.labels, labels[unseen]])
+
+        adjacency = self.adjacency.copy()
+        adjacency.resize((len(labels), len(labels)))
+        added = self._binary_adjacency(positions[codes], len(labels))
+        added = added - added.multiply(adjacency)
+        added.eliminate_zeros()
+        return SparseGraph((adjacency + added).tocsr(), labels), added
+
+    def save(self, file_name, **arrays):
+        """ Store the graph and any extra arrays in an npz file """
+        np.savez(file_name, indices=self.adjacency.indices, indptr=self.adjacency.indptr,
+                 labels=self.labels.astype(str), **arrays)
+
+    @classmethod
+    def load(cls, file_name):
+        """ Load a graph stored with save, returning it with the extra arrays """
+        with np.load(file_name) as stored:
+            arrays = dict(stored)
+        labels = np.asarray(arrays.pop('labels').tolist(), dtype=object)
+        indices, indptr = arrays.pop('indices'), arrays.pop('indptr')
+        adjacency = sp.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(labels), len(labels)))
+        return cls(adjacency, labels), arrays
+
+
+def degree_centralities(graph):
+    """ In and out degree centralities, normalised by n - 1 like networkx """
+    scale = 1.0 / (graph.node_count - 1) if graph.node_count > 1 else 1.0
+    in_degree = np.asarray(graph.adjacency.sum(axis=0)).ravel() * scale
+    out_degree = np.asarray(graph.adjacency.sum(axis=1)).ravel() * scale
+    return in_degree, out_degree
+
+
+def _start_vector(graph, nstart):
+    if nstart is None:
+        return np.ones(graph.node_count)
+
+    # warm start from a previous result, nodes that are new to the graph start from the mean.
+    # an array is taken to be in node order, with the new nodes missing from its end
+    if isinstance(nstart, np.ndarray):
+        x = np.full(graph.node_count, np.nan)
+        x[:len(nstart)] = nstart
+    else:
+        x = pd.Series(nstart, dtype=float).reindex(graph.labels).to_numpy(copy=True)
+    x[np.isnan(x)] = np.nanmean(x) if np.isfinite(x).any() else 1.0
+    return x
+
+
+def eigenvector_centrality(graph, tol=1e-06, max_iter=1000, nstart=None):
+    """ Eigenvector centrality from incoming edges by power iteration on (A + I)^T, as networkx does.
+        nstart may be a previous result keyed by node label, or in node order, to warm start the iteration """
+    incoming = graph.adjacency.T.tocsr()
+    x = _start_vector(graph, nstart)
+    x = x / x.sum()
+
+    for _ in range(max_iter):
+        x_last = x
+        x = x_last + incoming @ x_last
+        x = x / (np.linalg.norm(x) or 1.0)
+
+        if np.abs(x - x_last).sum() < graph.node_count * tol:
+            return x
+
+    raise RuntimeError(f'Eigenvector centrality did not converge within {max_iter} iterations')
+
+
+def pagerank(graph, alpha=0.85, tol=1e-06, max_iter=100, nstart=None):
+    """ PageRank by sparse power iteration, dangling nodes spread their rank uniformly like networkx """
+    node_count = graph.node_count
+    out_degree = np.asarray(graph.adjacency.sum(axis=1)).ravel()
+    dangling = out_degree == 0
+    transition = sp.diags(np.divide(1.0, out_degree, out=np.zeros(node_count), where=~dangling)) @ graph.adjacency
+    incoming = transition.T.tocsr()
+
+    x = _start_vector(graph, nstart)
+    x = x / x.sum()
+
+    for _ in range(max_iter):
+        x_last = x
+        x = alpha * (incoming @ x_last + x_last[dangling].sum() / node_count) + (1 - alpha) / node_count
+
+        if np.abs(x - x_last).sum() < node_count * tol:
+            return x
+
+    raise RuntimeError(f'PageRank did not converge within {max_iter} iterations')
+
+
+def _successors(adjacency, nodes):
+    """ Every edge leaving the given nodes, as the position in nodes of its source and its target """
+    starts = adjacency.indptr[nodes]
+    counts = adjacency.indptr[nodes + 1] - starts
+    owners = np.repeat(np.arange(len(nodes)), counts)
+    offsets = np.arange(len(owners)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, adjacency.indices[np.repeat(starts, counts) + offsets]
+
+
+def _single_source_dependencies(adjacency, source):
+    """ Breadth first search from source counting shortest paths level by level, followed by Brandes' accumulation
+        of the dependency of source on every node. Returns the dependencies and the distances, -1 where unreached """
+    node_count = adjacency.shape[0]
+    distance = np.full(node_count, -1)
+    sigma = np.zeros(node_count)
+    distance[source] = 0
+    sigma[source] = 1.0
+    levels = [np.array([source])]
+
+    while True:
+        frontier = levels[-1]
+        owners, targets = _successors(adjacency, frontier)
+        unseen = distance[targets] == -1
+        reached, positions = np.unique(targets[unseen], return_inverse=True)
+        if not len(reached):
+            break
+        sigma[reached] = np.bincount(positions, weights=sigma[frontier][owners[unseen]])
+        distance[reached] = len(levels)
+        levels.append(reached)
+
+    dependency = np.zeros(node_count)
+    for depth in range(len(levels) - 2, -1, -1):
+        nodes = levels[depth]
+        owners, targets = _successors(adjacency, nodes)
+        # only edges one level further down lie on shortest paths
+        on_path = distance[targets] == depth + 1
+        targets = targets[on_path]
+        shares = np.bincount(owners[on_path], weights=(1.0 + dependency[targets]) / sigma[targets],
+                             minlength=len(nodes))
+        dependency[nodes] = sigma[nodes] * shares
+    dependency[source] = 0.0
+    return dependency, distance
+
+
+def _path_sums(adjacency, sources):
+    """ Per node sums over the given sources of the dependency and its square, of being reached, and of the distance
+        and its square. Sums of disjoint sets of sources add up to the sums over all of them """
+    sums = np.zeros((5, adjacency.shape[0]))
+    for source in sources:
+        dependency, distance = _single_source_dependencies(adjacency, source)
+        reached = distance > 0
+        distance = np.where(reached, distance, 0)
+        sums[0] += dependency
+        sums[1] += dependency ** 2
+        sums[2] += reached
+        sums[3] += distance
+        sums[4] += distance ** 2
+    return sums
+
+
+def _share_adjacency(adjacency):
+    # sent once to each worker process rather than pickled with every chunk of sources
+    global _shared_adjacency
+    _shared_adjacency = adjacency
+
+
+def _shared_path_sums(sources):
+    return _path_sums(_shared_adjacency, sources)
+
+
+def sampled_path_centralities(graph, samples, workers=1, seed=0):
+    """ Betweenness and closeness centrality estimated from the shortest paths of samples source nodes drawn without
+        replacement, normalised like networkx, each with the standard error of its estimate.
+        The searches from the sources are split across workers processes and their sums added up at the end, in the
+        same order whatever the number of workers """
+    node_count = graph.node_count
+    sources = np.random.default_rng(seed).choice(node_count, min(samples, node_count), replace=False)
+    chunks = [chunk for chunk in np.array_split(sources, PATH_CHUNKS) if len(chunk)]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_share_adjacency,
+                                 initargs=(graph.adjacency,)) as executor:
+            sums = sum(executor.map(_shared_path_sums, chunks))
+    else:
+        sums = sum(_path_sums(graph.adjacency, chunk) for chunk in chunks)
+    dependency_sum, dependency_squares, reached_sum, distance_sum, distance_squares = sums
+
+    # betweenness is n times the mean dependency over all sources, nx.betweenness_centrality(k=...) also scales by n/k
+    k = len(sources)
+    scale = 1.0 / ((node_count - 1) * (node_count - 2)) if node_count > 2 else 1.0
+    mean = dependency_sum / k
+    variance = np.maximum(dependency_squares / k - mean ** 2, 0) * k / max(k - 1, 1)
+    betweenness = node_count * scale * mean
+    betweenness_error = node_count * scale * np.sqrt(variance / k * (1 - k / node_count))
+
+    # closeness (r - 1)^2 / ((n - 1) * total distance) from incoming paths, as networkx with wf_improved, becomes
+    # p^2 / mu with p the fraction of other nodes reaching the node and mu their mean distance (0 if unreached)
+    others = k - np.isin(np.arange(node_count), sources)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = reached_sum / others
+        mu = distance_sum / others
+        closeness = np.where(mu > 0, p ** 2 / mu, 0.0)
+        # delta method on the sample means of the reached indicator and the distance
+        correction = others / np.maximum(others - 1, 1)
+        p_variance = p * (1 - p) * correction
+        mu_variance = np.maximum(distance_squares / others - mu ** 2, 0) * correction
+        covariance = mu * (1 - p) * correction
+        dp, dmu = 2 * p / mu, -p ** 2 / mu ** 2
+        variance = dp ** 2 * p_variance + dmu ** 2 * mu_variance + 2 * dp * dmu * covariance
+        closeness_error = np.sqrt(np.maximum(variance, 0) / others * (1 - others / max(node_count - 1, 1)))
+    closeness_error = np.where(mu > 0, closeness_error, 0.0)
+    return betweenness, betweenness_error, closeness, closeness_error
+
+
+def _centrality_frame(graph, in_degree, out_degree, eigen, rank=None, paths=None):
+    all_df = pd.DataFrame({
+        'label': graph.labels,
+        'in_degree_centrality': in_degree,
+        'out_degree_centrality': out_degree,
+        'eigenvector_centrality': eigen
+    })
+    if rank is not None:
+        all_df['pagerank'] = rank
+    if paths is not None:
+        for column, values in zip(PATH_COLUMNS, paths):
+            all_df[column] = values
+
+    print(all_df.shape)
+    # the outer merges of the networkx path leave the rows sorted by label
+    return all_df.sort_values('label').reset_index(drop=True)
+
+
+def path_centralities(edges_df, samples, workers=1, seed=0):
+    """ Only the sampled betweenness and closeness columns, keyed by label """
+    graph = SparseGraph.from_edges(edges_df)
+    paths = sampled_path_centralities(graph, samples, workers=workers, seed=seed)
+    return pd.DataFrame(dict(zip(['label'] + PATH_COLUMNS, (graph.labels,) + paths)))
+
+
+def compute_centralities(edges_df, include_pagerank=False, tol=1e-06, nstart=None, path_samples=None, workers=1):
+    """ Same columns as network_analysis.compute_centralities, without building a networkx graph.
+        With path_samples, betweenness and closeness are estimated from that many source nodes """
+    graph = SparseGraph.from_edges(edges_df)
+    in_degree, out_degree = degree_centralities(graph)
+    eigen = eigenvector_centrality(graph, tol=tol, nstart=nstart)
+    rank = pagerank(graph, tol=tol) if include_pagerank else None
+    paths = sampled_path_centralities(graph, path_samples, workers=workers) if path_samples else None
+    return _centrality_frame(graph, in_degree, out_degree, eigen, rank, paths)
+
+
+def consumed_edges(store_file, network_id=None):
+    """ One past the last index_id of the edges in the graph kept in store_file, None without a store of the network
+        with network_id """
+    if not os.path.exists(store_file):
+        return None
+    with np.load(store_file) as stored:
+        if 'next_edge_index' not in stored.files or str(stored['network_id']) != str(network_id):
+            return None
+        return int(stored['next_edge_index'])
+
+
+def update_centralities(store_file, edges_df, include_pagerank=False, tol=1e-06, path_samples=None, workers=1,
+                        network_id=None):
+    """ Add new edges to the graph kept in store_file and return the centralities of the whole graph.
+        Degrees are updated by the new distinct edges, eigenvector centrality and pagerank are warm started from the
+        previous run. Without a store file the graph is built from edges_df, which should then hold every edge.
+        The store also keeps network_id and one past the largest index_id column of edges_df, see consumed_edges """
+    next_edge_index = 0
+    if os.path.exists(store_file):
+        graph, state = SparseGraph.load(store_file)
+        next_edge_index = int(state.get('next_edge_index', 0))
+        previous_count = graph.node_count
+        graph, added = graph.add_edges(edges_df)
+
+        padding = graph.node_count - previous_count
+        in_count = np.pad(state['in_count'], (0, padding)) + np.asarray(added.sum(axis=0)).ravel()
+        out_count = np.pad(state['out_count'], (0, padding)) + np.asarray(added.sum(axis=1)).ravel()
+        # add_edges numbers new nodes after the old ones, so the previous results warm start by position
+        eigen_start = state['eigenvector']
+        rank_start = state.get('pagerank')
+        print(f'{added.nnz} new edges, {padding} new nodes')
+    else:
+        graph = SparseGraph.from_edges(edges_df)
+        in_count = np.asarray(graph.adjacency.sum(axis=0)).ravel()
+        out_count = np.asarray(graph.adjacency.sum(axis=1)).ravel()
+        eigen_start = rank_start = None
+
+    scale = 1.0 / (graph.node_count - 1) if graph.node_count > 1 else 1.0
+    eigen = eigenvector_centrality(graph, tol=tol, nstart=eigen_start)
+    if 'index_id' in edges_df.columns and len(edges_df):
+        next_edge_index = max(next_edge_index, int(edges_df['index_id'].max()) + 1)
+    arrays = {'in_count': in_count, 'out_count': out_count, 'eigenvector': eigen,
+              'next_edge_index': next_edge_index, 'network_id': str(network_id)}
+    rank = None
+    if include_pagerank:
+        rank = arrays['pagerank'] = pagerank(graph, tol=tol, nstart=rank_start)
+
+    graph.save(store_file, **arrays)
+    # shortest paths change anywhere in the graph with a new edge, so they are estimated again from scratch
+    paths = sampled_path_centralities(graph, path_samples, workers=workers) if path_samples else None
+    return _centrality_frame(graph, in_count * scale, out_count * scale, eigen, rank, paths)
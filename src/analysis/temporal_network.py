@@ -0,0 +1,212 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from src.analysis.sparse_centrality import SparseGraph, degree_centralities, eigenvector_centrality, pagerank
+from src.pipeline import instrumentation
+from src.pipeline.formats import OutputFormat, read_frame, write_frame, with_extension
+
+
+base_dir = '/home/timothy/Projects/assignments/tia_text_analytics/data'
+input_format = OutputFormat.CSV
+output_format = OutputFormat.CSV
+
+WINDOW_COLUMNS = ['window_start', 'window_end', 'label', 'centrality', 'value']
+CENTRALITIES = ['in_degree_centrality', 'out_degree_centrality', 'eigenvector_centrality', 'pagerank']
+
+
+class DatedEdges:
+    """ Edges sorted by date, as integer node codes into labels and codes of the distinct (source, target) pairs """
+
+    def __init__(self, edges_df):
+        dates = pd.to_datetime(edges_df['date_gmt'], format='ISO8601', errors='coerce').to_numpy()
+        dated = ~np.isnat(dates)
+        order = np.flatnonzero(dated)[np.argsort(dates[dated], kind='stable')]
+
+        codes, self.labels = SparseGraph._edge_codes(edges_df)
+        self.dates = dates[order]
+        self.sources = codes[0::2][order]
+        self.targets = codes[1::2][order]
+
+        node_count = len(self.labels)
+        self.pairs, pair_keys = pd.factorize(self.sources.astype(np.int64) * node_count + self.targets)
+        self.pair_sources = pair_keys // node_count
+        self.pair_targets = pair_keys % node_count
+
+    def ranges(self, starts, ends):
+        """ Positions of the first and past the last edge dated within each [start, end) """
+        return np.searchsorted(self.dates, starts), np.searchsorted(self.dates, ends)
+
+
+class WindowGraph:
+    """ The graph of the edges within a range of DatedEdges that only moves forward.
+        Moving it adds the edges entering the range and expires those leaving it, keeping a count of the copies of
+        every distinct edge and of the edges at every node, and the sorted codes of the pairs and nodes counted """
+
+    def __init__(self, edges: DatedEdges):
+        self.edges = edges
+        self.pair_counts = np.zeros(len(edges.pair_sources), dtype=np.int64)
+        self.node_counts = np.zeros(len(edges.labels), dtype=np.int64)
+        self.pairs = self.nodes = np.array([], dtype=np.int64)
+        self.positions = np.zeros(len(edges.labels), dtype=np.int64)
+        self.start = self.end = 0
+
+    def move(self, start, end):
+        if start >= self.end:
+            # nothing is shared with the current range
+            self.pair_counts[self.pairs] = 0
+            self.node_counts[self.nodes] = 0
+            self.pairs = self.nodes = np.array([], dtype=np.int64)
+            pairs, nodes = self.__count(start, end, 1)
+        else:
+            added_pairs, added_nodes = self.__count(self.end, end, 1)
+            expired_pairs, expired_nodes = self.__count(self.start, start, -1)
+            pairs, nodes = np.concatenate([added_pairs, expired_pairs]), np.concatenate([added_nodes, expired_nodes])
+        self.pairs = self._counted(self.pairs, pairs, self.pair_counts)
+        self.nodes = self._counted(self.nodes, nodes, self.node_counts)
+        self.start, self.end = start, end
+
+    def graph(self):
+        """ The SparseGraph of the current range and the codes of its nodes """
+        edges = self.edges
+        # only the positions of the current nodes are ever read
+        self.positions[self.nodes] = np.arange(len(self.nodes))
+        sources = self.positions[edges.pair_sources[self.pairs]]
+        targets = self.positions[edges.pair_targets[self.pairs]]
+        adjacency = sp.csr_matrix((np.ones(len(self.pairs)), (sources, targets)),
+                                  shape=(len(self.nodes), len(self.nodes)))
+        return SparseGraph(adjacency, edges.labels[self.nodes]), self.nodes
+
+    @staticmethod
+    def _counted(codes, changed, counts):
+        """ The sorted codes still counted once the counts of the changed codes have moved """
+        codes = np.sort(np.concatenate([codes[counts[codes] > 0], changed[counts[changed] > 0]]))
+        return codes[np.concatenate([[True], codes[1:] != codes[:-1]])] if len(codes) else codes
+
+    def __count(self, start, end, sign):
+        edges = self.edges
+        pairs = edges.pairs[start:end]
+        nodes = np.concatenate([edges.sources[start:end], edges.targets[start:end]])
+        np.add.at(self.pair_counts, pairs, sign)
+        np.add.at(self.node_counts, nodes, sign)
+        return pairs, nodes
+
+
+def window_bounds(dates, frequency='MS', window=1, step=1):
+    """ Start and end of windows of window periods of the pandas frequency, one starting every step periods from the
+        period of the first date until the last date. step equal to window gives tumbling windows, less sliding ones """
+    dates = pd.DatetimeIndex(dates)
+    first = pd.tseries.frequencies.to_offset(frequency).rollback(dates.min().normalize())
+    count = len(pd.date_range(first, dates.max(), freq=frequency))
+    boundaries = pd.date_range(first, periods=count + window, freq=frequency)
+    starts = boundaries[0:count:step]
+    return starts, boundaries[window:count + window:step]
+
+
+def _evaluate_windows(edges, starts, ends, include_pagerank=False, tol=1e-06):
+    """ Centralities of consecutive windows, each graph moved on from the one before it and its eigenvector
+        centrality and pagerank warm started from the previous window's.
+        Returns the window position and node code of every row, and a column of values per centrality """
+    window_graph = WindowGraph(edges)
+    eigen_start = np.full(len(edges.labels), np.nan)
+    rank_start = np.full(len(edges.labels), np.nan)
+    windows, nodes, values = [], [], []
+
+    lows, highs = edges.ranges(starts, ends)
+    for position, (low, high) in enumerate(zip(lows, highs)):
+        window_graph.move(low, high)
+        if low == high:
+            continue
+        graph, codes = window_graph.graph()
+        in_degree, out_degree = degree_centralities(graph)
+        columns = [in_degree, out_degree]
+        columns.append(eigenvector_centrality(graph, tol=tol, nstart=eigen_start[codes]))
+        eigen_start[codes] = columns[-1]
+        if include_pagerank:
+            columns.append(pagerank(graph, tol=tol, nstart=rank_start[codes]))
+            rank_start[codes] = columns[-1]
+
+        windows.append(np.full(len(codes), position))
+        nodes.append(codes)
+        values.append(np.column_stack(columns))
+
+    centralities = len(CENTRALITIES) if include_pagerank else len(CENTRALITIES) - 1
+    if not windows:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.empty((0, centralities))
+    return np.concatenate(windows), np.concatenate(nodes), np.concatenate(values)
+
+
+def _share_edges(edges):
+    # sent once to each worker process rather than pickled with every block of windows
+    global _shared_edges
+    _shared_edges = edges
+
+
+def _evaluate_shared_windows(starts, ends, include_pagerank, tol):
+    return _evaluate_windows(_shared_edges, starts, ends, include_pagerank, tol)
+
+
+def windowed_centralities(edges_df, frequency='MS', window=1, step=1, workers=1, include_pagerank=False, tol=1e-06):
+    """ Long format centralities of the graph of the edges dated within each window, see window_bounds.
+        The windows are split into one block of consecutive windows per worker process. Within a block every window's
+        graph is moved on from the previous one, the first is built from its edges """
+    edges = DatedEdges(edges_df)
+    if not len(edges.dates):
+        return pd.DataFrame(columns=WINDOW_COLUMNS)
+    starts, ends = window_bounds(edges.dates, frequency, window, step)
+    starts, ends = starts.to_numpy(), ends.to_numpy()
+    blocks = [block for block in np.array_split(np.arange(len(starts)), max(workers, 1)) if len(block)]
+    instrumentation.count('windows', len(starts))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_share_edges, initargs=(edges,)) as executor:
+            results = list(executor.map(_evaluate_shared_windows, [starts[block] for block in blocks],
+                                        [ends[block] for block in blocks], [include_pagerank] * len(blocks),
+                                        [tol] * len(blocks)))
+    else:
+        results = [_evaluate_windows(edges, starts[block], ends[block], include_pagerank, tol) for block in blocks]
+
+    windows = np.concatenate([block[0] + positions for block, (positions, _, _) in zip(blocks, results)])
+    nodes = np.concatenate([codes for _, codes, _ in results])
+    values = np.concatenate([columns for _, _, columns in results])
+    names = CENTRALITIES[:values.shape[1]]
+
+    # one row per window, node and centrality, the centralities of a node next to each other
+    return pd.DataFrame({
+        'window_start': np.repeat(starts[windows], len(names)),
+        'window_end': np.repeat(ends[windows], len(names)),
+        'label': pd.Categorical.from_codes(np.repeat(nodes, len(names)), categories=edges.labels),
+        'centrality': pd.Categorical.from_codes(np.tile(np.arange(len(names)), len(nodes)), categories=names),
+        'value': values.ravel()
+    })
+
+
+def analyse_temporal_network(network_input_dir, network_output_dir, frequency='MS', window=1, step=1, workers=1,
+                             include_pagerank=False, input_format=OutputFormat.CSV, output_format=OutputFormat.CSV):
+    """ Centralities of the network written by network_prep over time, in windows of its edges by date_gmt.
+        Written as one row per window, node and centrality to centrality_windows """
+    edges_df = read_frame(with_extension(network_input_dir + '/edges.csv', input_format),
+                          columns=['source', 'target', 'date_gmt'])
+    windows_df = windowed_centralities(edges_df, frequency, window, step, workers=workers,
+                                       include_pagerank=include_pagerank)
+    instrumentation.count('edges', len(edges_df))
+    instrumentation.count('rows', len(windows_df))
+
+    os.makedirs(network_output_dir, exist_ok=True)
+    write_frame(windows_df, with_extension(network_output_dir + '/centrality_windows.csv', output_format), index=False)
+
+
+if __name__ == "__main__":
+    # pandas frequency of the periods windows are made of, e.g. 'MS' for calendar months or 'W' for weeks
+    frequency = 'MS'
+    # periods in a window and periods between window starts, equal for tumbling windows and smaller for sliding ones
+    window = 3
+    step = 1
+    workers = os.cpu_count()
+
+    analyse_temporal_network(base_dir + '/network_input', base_dir + '/network_output', frequency=frequency,
+                             window=window, step=step, workers=workers, input_format=input_format,
+                             output_format=output_format)
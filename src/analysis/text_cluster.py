@@ -1,40 +1,201 @@
 import string
 import collections
 import csv
+import hashlib
+import json
+import os
+import pickle
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from functools import lru_cache
 
-from nltk import word_tokenize
-from nltk.stem import PorterStemmer
-from nltk.corpus import stopwords
-from sklearn.cluster import KMeans
-from sklearn.feature_extraction.text import TfidfVectorizer
-from pprint import pprint
+import numpy as np
+
+from src.pipeline import instrumentation
+from src.pipeline.formats import OutputFormat, format_of, read_frame
+from src.pipeline.near_duplicates import read_groups
+
+
+# pandas, scipy, nltk and sklearn are imported by the functions that use them, so that importing this module to tokenize
+# a few texts does not load them all
+
+
+@lru_cache(maxsize=None)
+def english_stop_words():
+    """ The nltk english stop words, read from the corpus once per process """
+    from nltk.corpus import stopwords
+
+    return tuple(stopwords.words('english'))
+
+
+class TextPreprocessor:
+    """ Tokenize text and stem words removing punctuation, building the translation table and stemmer once
+        and memoizing stems, since most tokens in a corpus are repeats of a small vocabulary """
+
+    class Tokenizer(Enum):
+        NLTK = 1
+        # splits ascii text directly, applying the only word_tokenize rules left once punctuation is removed,
+        # and falls back to word_tokenize for anything else
+        REGEX = 2
+
+    CONTRACTIONS = re.compile(r"(?i)\b(?:(can)(not)|(gim)(me)|(gon)(na)|(got)(ta)|(lem)(me))\b|\b(wan)(na)(?=\s)")
+
+    def __init__(self, stem=True, tokenizer=Tokenizer.NLTK, cache_size=2 ** 16):
+        from nltk.stem import PorterStemmer
+
+        self.stem = stem
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self.table = str.maketrans("", "", string.punctuation)
+        self.stemmer = PorterStemmer()
+        self._stem_word = lru_cache(maxsize=cache_size)(self.stemmer.stem)
+
+    def __call__(self, text):
+        text = text.translate(self.table)
+        tokens = self._tokenize(text)
+
+        if self.stem:
+            stem_word = self._stem_word
+            tokens = [stem_word(t) for t in tokens]
+
+        return tokens
+
+    def cache_key(self):
+        """ Settings that change the tokens produced, for keying cached vectorizations """
+        return f'{type(self).__name__}(stem={self.stem}, tokenizer={self.tokenizer.name})'
+
+    def _tokenize(self, text):
+        if self.tokenizer == self.Tokenizer.REGEX and text.isascii():
+            return self.CONTRACTIONS.sub(self._split_contraction, text + ' ').split()
+        from nltk import word_tokenize
+
+        return word_tokenize(text)
+
+    @staticmethod
+    def _split_contraction(match):
+        return ' '.join(group for group in match.groups() if group)
+
+    def __getstate__(self):
+        # the stem cache is rebuilt rather than pickled, e.g. when sent to worker processes
+        state = self.__dict__.copy()
+        del state['_stem_word']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._stem_word = lru_cache(maxsize=self.cache_size)(self.stemmer.stem)
+
+
+_preprocessors = {}
 
 
 def process_text(text, stem=True):
     """ Tokenize text and stem words removing punctuation """
-    table = str.maketrans("", "", string.punctuation)
-    text = text.translate(table)
-    tokens = word_tokenize(text)
+    if stem not in _preprocessors:
+        _preprocessors[stem] = TextPreprocessor(stem=stem)
+    return _preprocessors[stem](text)
+
+
+class DocumentTokenizer:
+    """ Lowercase, tokenize and drop stopwords from a batch of texts, as TfidfVectorizer does around its tokenizer """
+
+    def __init__(self, preprocessor, stop_words):
+        self.preprocessor = preprocessor
+        self.stop_words = frozenset(stop_words)
+
+    def __call__(self, texts):
+        return [[token for token in self.preprocessor(text.lower()) if token not in self.stop_words] for text in texts]
+
+
+def tokenize_texts(texts, preprocessor=process_text, stop_words=(), workers=1, chunk_size=1000):
+    """ Tokenize texts in chunks, spreading the chunks across a process pool when workers > 1 """
+    texts = list(texts)
+    tokenize = DocumentTokenizer(preprocessor, stop_words)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            tokenized_chunks = list(executor.map(tokenize, chunks))
+    else:
+        tokenized_chunks = map(tokenize, chunks)
 
-    if stem:
-        stemmer = PorterStemmer()
-        tokens = [stemmer.stem(t) for t in tokens]
+    return [tokens for chunk in tokenized_chunks for tokens in chunk]
 
+
+def pre_tokenized(tokens):
     return tokens
 
 
-def cluster_texts(texts, clusters=3):
-    """ Transform texts to Tf-Idf coordinates and cluster texts using K-Means """
-    vectorizer = TfidfVectorizer(tokenizer=process_text,
-                                 stop_words=stopwords.words('english'),
-                                 max_df=0.5,
-                                 min_df=0.1,
-                                 lowercase=True)
+# parameters of the Tf-Idf vectorizer, part of the key of cached vectorizations
+TFIDF_PARAMETERS = {'max_df': 0.5, 'min_df': 0.1}
+
+
+def vectorize_texts(texts, preprocessor=None, workers=1, stop_words=None, cache_dir=None):
+    """ Transform texts to Tf-Idf coordinates, tokenizing them up front so that it can be done in parallel.
+        With cache_dir, the matrix and the fitted vectorizer are kept there, keyed by the texts, preprocessor,
+        stop words and vectorizer parameters, and loaded instead of vectorizing the same corpus again """
+    import scipy.sparse as sp
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    if stop_words is None:
+        stop_words = english_stop_words()
+    preprocessor = preprocessor or process_text
+
+    if cache_dir is not None:
+        matrix_file, vectorizer_file = tfidf_cache_files(cache_dir, texts, preprocessor, stop_words)
+        if os.path.isfile(matrix_file) and os.path.isfile(vectorizer_file):
+            with open(vectorizer_file, 'rb') as f:
+                vectorizer = pickle.load(f)
+            instrumentation.count('tfidf_cache_hits')
+            return vectorizer, sp.load_npz(matrix_file)
+
+    documents = tokenize_texts(texts, preprocessor, stop_words, workers=workers)
+    vectorizer = TfidfVectorizer(analyzer=pre_tokenized, **TFIDF_PARAMETERS)
+    tfidf_model = vectorizer.fit_transform(documents)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(vectorizer_file, 'wb') as f:
+            pickle.dump(vectorizer, f)
+        # the matrix is moved into place last, so that a cache entry is only found once it is complete
+        sp.save_npz(matrix_file + '.tmp.npz', tfidf_model)
+        os.replace(matrix_file + '.tmp.npz', matrix_file)
+    return vectorizer, tfidf_model
+
 
-    tfidf_model = vectorizer.fit_transform(texts)
+def tfidf_cache_files(cache_dir, texts, preprocessor, stop_words):
+    """ The matrix and vectorizer files vectorize_texts caches the vectorization of texts in """
+    digest = hashlib.sha1()
+    preprocessor_key = (preprocessor.cache_key() if hasattr(preprocessor, 'cache_key')
+                        else f'{preprocessor.__module__}.{preprocessor.__qualname__}')
+    digest.update(json.dumps([preprocessor_key, sorted(set(stop_words)), TFIDF_PARAMETERS]).encode())
+    for text in texts:
+        encoded = text.encode()
+        # length prefixed, so that texts split differently do not hash the same
+        digest.update(len(encoded).to_bytes(8, 'little'))
+        digest.update(encoded)
+
+    key = digest.hexdigest()
+    return f'{cache_dir}/tfidf_{key}.npz', f'{cache_dir}/tfidf_{key}.pkl'
+
+
+def cluster_texts(texts, clusters=3, preprocessor=None, workers=1, artifact_file=None, cache_dir=None):
+    """ Transform texts to Tf-Idf coordinates and cluster texts using K-Means.
+        With artifact_file, the fitted model is saved so that new texts can be labelled by ClusterAssigner """
+    from sklearn.cluster import KMeans
+
+    stop_words = english_stop_words()
+    vectorizer, tfidf_model = vectorize_texts(texts, preprocessor, workers=workers, stop_words=stop_words,
+                                              cache_dir=cache_dir)
     km_model = KMeans(n_clusters=clusters)
     km_model.fit(tfidf_model)
 
+    if artifact_file is not None:
+        save_cluster_artifact(artifact_file, vectorizer, preprocessor or process_text, stop_words, km_model,
+                              tfidf_model)
+
     clustering = collections.defaultdict(list)
 
     for idx, label in enumerate(km_model.labels_):
@@ -43,18 +204,331 @@ def cluster_texts(texts, clusters=3):
     return clustering
 
 
-if __name__ == "__main__":
-    base_dir = "/home/timothy/Projects/assignments/tia_text_analytics/data"
-    output_comments_file = base_dir + '/staging/comments_dedup.csv'
+def fit_cluster_count(tfidf_model, clusters, sample_size=10000, random_state=0, threads=None):
+    """ Fit K-Means with the given number of clusters, returning its inertia and silhouette score.
+        The silhouette is computed on a sample of sample_size texts, as it is quadratic in their number.
+        tfidf_model may be the name of an npz file, which workers load rather than receive pickled """
+    import scipy.sparse as sp
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
+    from threadpoolctl import threadpool_limits
+
+    if isinstance(tfidf_model, str):
+        tfidf_model = sp.load_npz(tfidf_model)
+
+    start = time.perf_counter()
+    with threadpool_limits(limits=threads):
+        km_model = KMeans(n_clusters=clusters, random_state=random_state).fit(tfidf_model)
+
+        # the silhouette needs at least two clusters that are not every text on its own
+        labels_count = len(np.unique(km_model.labels_))
+        if 1 < labels_count < tfidf_model.shape[0]:
+            sample_size = min(sample_size, tfidf_model.shape[0])
+            silhouette = silhouette_score(tfidf_model, km_model.labels_, sample_size=sample_size,
+                                          random_state=random_state)
+        else:
+            silhouette = float('nan')
+
+    return {
+        'clusters': clusters,
+        'inertia': float(km_model.inertia_),
+        'silhouette': float(silhouette),
+        'fit_time': time.perf_counter() - start
+    }
+
+
+def sweep_cluster_counts(texts, cluster_counts, preprocessor=None, workers=1, cache_dir=None, sample_size=10000,
+                         random_state=0):
+    """ Fit K-Means for every number of clusters in cluster_counts, in parallel when workers > 1, over a single
+        vectorization of texts. Returns the inertia and sampled silhouette score of each, by number of clusters """
+    stop_words = english_stop_words()
+    _, tfidf_model = vectorize_texts(texts, preprocessor, workers=workers, stop_words=stop_words, cache_dir=cache_dir)
+    cluster_counts = sorted(cluster_counts)
+
+    if workers > 1:
+        # the cached matrix is loaded by each worker, instead of being pickled to every one of them
+        matrix = tfidf_model
+        if cache_dir is not None:
+            matrix = tfidf_cache_files(cache_dir, texts, preprocessor or process_text, stop_words)[0]
+        # the BLAS and OpenMP threads of the fits share the cpus between the workers
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fit_cluster_count, matrix, clusters, sample_size, random_state, threads)
+                       for clusters in cluster_counts]
+            results = [future.result() for future in futures]
+    else:
+        results = [fit_cluster_count(tfidf_model, clusters, sample_size, random_state) for clusters in cluster_counts]
+
+    instrumentation.count('fits', len(results))
+    return results
+
+
+def write_sweep(file_name, results):
+    with open(file_name, 'w') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(['clusters', 'inertia', 'silhouette', 'fit_time'])
+        writer.writerows([result['clusters'], result['inertia'], result['silhouette'], result['fit_time']]
+                         for result in results)
+
+
+ARTIFACT_VERSION = 1
+
 
-    articles = []
+def save_cluster_artifact(file_name, vectorizer, preprocessor, stop_words, km_model, tfidf_model):
+    artifact = {
+        'version': ARTIFACT_VERSION,
+        'created_at': time.time(),
+        'vectorizer': vectorizer,
+        'preprocessor': preprocessor,
+        'stop_words': sorted(set(stop_words)),
+        'centroids': km_model.cluster_centers_,
+        # baselines for drift: mean squared distance of the fitted texts to their centroid,
+        # and the fraction of them without any term in the vocabulary
+        'mean_distance': km_model.inertia_ / tfidf_model.shape[0],
+        'empty_fraction': np.mean(tfidf_model.getnnz(axis=1) == 0)
+    }
 
-    with open(output_comments_file, 'r') as f:
+    with open(file_name, 'wb') as f:
+        pickle.dump(artifact, f)
+
+
+class ClusterAssigner:
+    """ Labels new texts with the nearest centroid of a saved cluster_texts model, without refitting it """
+
+    def __init__(self, artifact):
+        if artifact['version'] != ARTIFACT_VERSION:
+            raise ValueError(f'Cluster artifact version {artifact["version"]} is not supported, expected {ARTIFACT_VERSION}')
+
+        self.vectorizer = artifact['vectorizer']
+        self.tokenize = DocumentTokenizer(artifact['preprocessor'], artifact['stop_words'])
+        self.centroids = artifact['centroids']
+        self.mean_distance = artifact['mean_distance']
+        self.empty_fraction = artifact['empty_fraction']
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name, 'rb') as f:
+            return cls(pickle.load(f))
+
+    def assign(self, texts):
+        labels, _ = self._nearest_centroids(self._transform(texts))
+        return labels
+
+    def assign_with_drift(self, texts):
+        """ Label texts, also measuring how far they have drifted from the fitted texts: the larger of the relative
+            increase in mean distance to the nearest centroid and the increase in texts without known terms """
+        tfidf_model = self._transform(texts)
+        labels, distances = self._nearest_centroids(tfidf_model)
+
+        distance_drift = np.mean(distances) / self.mean_distance - 1 if self.mean_distance else 0.0
+        vocabulary_drift = np.mean(tfidf_model.getnnz(axis=1) == 0) - self.empty_fraction
+        return labels, max(distance_drift, vocabulary_drift)
+
+    def _transform(self, texts):
+        return self.vectorizer.transform(self.tokenize(list(texts)))
+
+    def _nearest_centroids(self, tfidf_model):
+        from sklearn.metrics.pairwise import euclidean_distances
+
+        distances = euclidean_distances(tfidf_model, self.centroids, squared=True)
+        labels = distances.argmin(axis=1)
+        return labels, distances[np.arange(len(labels)), labels]
+
+
+def assign_or_refit(new_texts, artifact_file, read_all_texts, clusters=3, drift_threshold=0.25, preprocessor=None,
+                    workers=1):
+    """ Label new texts with the saved model, refitting it on the whole corpus first only if there is no model yet
+        or the new texts have drifted from it by more than drift_threshold. read_all_texts returns the whole corpus """
+    if os.path.isfile(artifact_file):
+        labels, drift = ClusterAssigner.load(artifact_file).assign_with_drift(new_texts)
+        print(f'Drift of {len(labels)} new texts is {drift:.3f}')
+
+        if drift <= drift_threshold:
+            return labels
+
+    cluster_texts(read_all_texts(), clusters, preprocessor=preprocessor, workers=workers, artifact_file=artifact_file)
+    return ClusterAssigner.load(artifact_file).assign(new_texts)
+
+
+class StreamingTfidf:
+    """ Tf-Idf over a fixed size hashed feature space, with document frequencies collected chunk by chunk.
+        Weights and max_df/min_df pruning follow TfidfVectorizer, so memory does not grow with the corpus """
+
+    def __init__(self, preprocessor=None, n_features=2 ** 18, max_df=0.5, min_df=0.1):
+        from sklearn.feature_extraction.text import HashingVectorizer
+
+        self.tokenize = DocumentTokenizer(preprocessor or process_text, english_stop_words())
+        self.hasher = HashingVectorizer(analyzer=pre_tokenized, n_features=n_features, alternate_sign=False, norm=None)
+        self.n_features = n_features
+        self.max_df = max_df
+        self.min_df = min_df
+        self.document_frequency = np.zeros(n_features)
+        self.document_count = 0
+        self.idf = None
+
+    def partial_fit(self, texts):
+        counts = self.hasher.transform(self.tokenize(texts))
+        # every stored entry of a csr row is a distinct feature of that document
+        self.document_frequency += np.bincount(counts.indices, minlength=self.n_features)
+        self.document_count += counts.shape[0]
+        self.idf = None
+        return self
+
+    def transform(self, texts):
+        import scipy.sparse as sp
+        from sklearn.preprocessing import normalize
+
+        if self.idf is None:
+            self.idf = self._compute_idf()
+
+        counts = self.hasher.transform(self.tokenize(texts))
+        return normalize(counts @ sp.diags(self.idf))
+
+    def _compute_idf(self):
+        n = self.document_count
+        idf = np.log((1 + n) / (1 + self.document_frequency)) + 1
+        # pruned features get no weight, as if they were not in the vocabulary
+        idf[(self.document_frequency > self.max_df * n) | (self.document_frequency < self.min_df * n)] = 0
+        return idf
+
+
+def read_excerpts(file_name, chunk_size=10000):
+    """ Yield the excerpts of a comments file in chunks of chunk_size """
+    if format_of(file_name) != OutputFormat.CSV:
+        excerpts = read_frame(file_name, columns=['excerpt'])['excerpt'].fillna('').tolist()
+        for start in range(0, len(excerpts), chunk_size):
+            yield excerpts[start:start + chunk_size]
+        return
+
+    with open(file_name, 'r') as f:
         reader = csv.reader(f, delimiter=',', quoting=csv.QUOTE_ALL)
         headers = next(reader)
         pos = headers.index('excerpt')
+
+        chunk = []
         for row in reader:
-            articles.append(row[pos])
+            chunk.append(row[pos])
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def cluster_texts_streaming(read_chunks, clusters=3, preprocessor=None, epochs=1):
+    """ Cluster texts with hashed Tf-Idf and mini batch K-Means, holding only one chunk in memory at a time.
+        read_chunks returns a new iterable of text chunks on each call, as the corpus is read more than once """
+    from sklearn.cluster import MiniBatchKMeans
+
+    tfidf = StreamingTfidf(preprocessor)
+    for texts in read_chunks():
+        tfidf.partial_fit(texts)
+
+    km_model = MiniBatchKMeans(n_clusters=clusters)
+    for _ in range(epochs):
+        for texts in read_chunks():
+            km_model.partial_fit(tfidf.transform(texts))
+
+    clustering = collections.defaultdict(list)
+    idx = 0
+
+    for texts in read_chunks():
+        for label in km_model.predict(tfidf.transform(texts)):
+            clustering[label].append(idx)
+            idx += 1
+
+    return clustering
+
+
+def write_clusters(file_name, clustering):
+    """ Write the cluster of every text, by the position of the text in the corpus """
+    rows = sorted((idx, label) for label, indices in clustering.items() for idx in indices)
+    with open(file_name, 'w') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(['row', 'cluster'])
+        writer.writerows(rows)
+
+
+def cluster_comments(comments_file, clusters_file=None, clusters=7, streaming=False, artifact_file=None, workers=1,
+                     preprocessor=None, cache_dir=None, groups_file=None):
+    """ Cluster the excerpts of a comments file, writing the cluster of each comment to clusters_file.
+        With cache_dir, the Tf-Idf matrix is cached there for later runs over the same comments.
+        With the groups_file of find_near_duplicates, only one comment of each group of near duplicates is clustered
+        and the others are given its cluster, so that reposts do not pull the clusters towards them.
+        groups_file is not used in the streaming mode """
+    if streaming:
+        clustering = cluster_texts_streaming(lambda: read_excerpts(comments_file), clusters, preprocessor=preprocessor)
+    else:
+        articles = [text for chunk in read_excerpts(comments_file) for text in chunk]
+        representatives = None
+        if groups_file is not None:
+            import pandas as pd
+
+            ids = read_frame(comments_file, columns=['id'])['id'].to_numpy()
+            group_codes, _ = pd.factorize(read_groups(groups_file, ids))
+            _, representatives = np.unique(group_codes, return_index=True)
+            articles = [articles[idx] for idx in representatives]
+
+        clustering = cluster_texts(articles, clusters, preprocessor=preprocessor, workers=workers,
+                                   artifact_file=artifact_file, cache_dir=cache_dir)
+
+        if representatives is not None:
+            clustering = _expand_clustering(clustering, group_codes)
+
+    instrumentation.count('documents', sum(len(indices) for indices in clustering.values()))
+    if clusters_file is not None:
+        write_clusters(clusters_file, clustering)
+    return clustering
+
+
+def _expand_clustering(clustering, group_codes):
+    """ Clustering of every text from the clustering of one text per group, the i-th clustered text being the
+        first of group i """
+    group_labels = np.empty(group_codes.max() + 1 if len(group_codes) else 0, dtype=np.int64)
+    for label, indices in clustering.items():
+        group_labels[indices] = label
+
+    expanded = collections.defaultdict(list)
+    for idx, label in enumerate(group_labels[group_codes].tolist()):
+        expanded[label].append(idx)
+    return expanded
+
+
+def sweep_comments(comments_file, cluster_counts, sweep_file=None, workers=1, preprocessor=None, cache_dir=None,
+                   sample_size=10000):
+    """ Inertia and silhouette score of clustering the excerpts of a comments file into each of cluster_counts,
+        for choosing the number of clusters, written to sweep_file """
+    articles = [text for chunk in read_excerpts(comments_file) for text in chunk]
+    results = sweep_cluster_counts(articles, cluster_counts, preprocessor=preprocessor, workers=workers,
+                                   cache_dir=cache_dir, sample_size=sample_size)
+
+    if sweep_file is not None:
+        write_sweep(sweep_file, results)
+    return results
+
+
+if __name__ == "__main__":
+    from pprint import pprint
+
+    base_dir = "/home/timothy/Projects/assignments/tia_text_analytics/data"
+    output_comments_file = base_dir + '/staging/comments_dedup.csv'
+
+    streaming = False
+    # fit every number of clusters in cluster_counts instead, to choose one
+    sweep = False
+    cluster_counts = range(2, 16)
+    artifact_file = base_dir + '/analysis/cluster_model.pkl'
+    cache_dir = base_dir + '/analysis/tfidf_cache'
+    preprocessor = TextPreprocessor(tokenizer=TextPreprocessor.Tokenizer.REGEX)
 
-    clusters = cluster_texts(articles, 7)
-    pprint(dict(clusters))
+    if sweep:
+        results = sweep_comments(output_comments_file, cluster_counts, base_dir + '/analysis/cluster_sweep.csv',
+                                 workers=os.cpu_count(), preprocessor=preprocessor, cache_dir=cache_dir)
+        for result in results:
+            print(f"{result['clusters']:>3} clusters: inertia {result['inertia']:.1f}, "
+                  f"silhouette {result['silhouette']:.3f}")
+    else:
+        clusters = cluster_comments(output_comments_file, base_dir + '/analysis/clusters.csv', 7, streaming=streaming,
+                                    artifact_file=artifact_file, workers=os.cpu_count(), preprocessor=preprocessor,
+                                    cache_dir=cache_dir)
+        pprint(dict(clusters))
@@ -0,0 +1,234 @@
+import argparse
+import os
+import sys
+
+from src.pipeline.formats import OutputFormat, with_extension
+
+# corpora used by text_cluster, word_tokenize needs punkt_tab
+NLTK_CORPORA = ['stopwords', 'punkt_tab']
+
+
+# every subcommand imports what it runs only once it is chosen, so that the lightweight ones start without loading
+# pandas, networkx, sklearn or nltk
+
+
+def _directory(path):
+    """ path, created if it does not exist yet, as the pipeline does for the outputs of its stages """
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def crawl_command(args):
+    from src.pipeline.crawler import TiaCrawler, crawl
+
+    crawl(concurrency=args.concurrency, requests_per_second=args.requests_per_second, delta=args.delta,
+          raw_dir=args.data_dir + '/raw', raw_store=args.raw_store, base_url=args.base_url or TiaCrawler.BASE_URL,
+          rescan_days=args.rescan_days, posts=args.posts)
+
+
+def pack_command(args):
+    from src.pipeline.raw_store import pack_directory
+
+    for directory in args.directories:
+        pack_directory(directory, remove=not args.keep)
+
+
+def munge_command(args):
+    from src.pipeline.munger import munge_comments, munge_posts
+
+    _directory(args.data_dir + '/staging')
+    if args.only in (None, 'posts'):
+        munge_posts(workers=args.workers, output_format=args.format, compression=args.compression,
+                    data_dir=args.data_dir)
+    if args.only in (None, 'comments'):
+        munge_comments(workers=args.workers, output_format=args.format, compression=args.compression,
+                       data_dir=args.data_dir)
+
+
+def near_duplicates_command(args):
+    from src.pipeline.near_duplicates import find_near_duplicates
+
+    staging_dir = args.data_dir + '/staging'
+    find_near_duplicates(with_extension(staging_dir + '/comments_dedup.csv', args.format),
+                         with_extension(staging_dir + '/duplicate_groups.csv', args.format),
+                         staging_dir + '/minhash_index.npz', threshold=args.threshold)
+
+
+def network_prep_command(args):
+    from src.pipeline.network_prep import build_network, update_network
+
+    groups_file = None
+    if args.collapse_duplicates:
+        groups_file = with_extension(args.data_dir + '/staging/duplicate_groups.csv', args.format)
+
+    if args.incremental:
+        update_network(args.data_dir + '/staging_delta', _directory(args.data_dir + '/network_input'), args.format,
+                       args.format, groups_file=groups_file)
+    else:
+        build_network(args.data_dir + '/staging', _directory(args.data_dir + '/network_input'), args.format,
+                      args.format, groups_file=groups_file)
+
+
+def network_analysis_command(args):
+    from src.analysis.network_analysis import CentralityBackend, analyse_network
+
+    analyse_network(args.data_dir + '/network_input', _directory(args.data_dir + '/network_output'),
+                    backend=CentralityBackend(args.backend), incremental=args.incremental, input_format=args.format,
+                    output_format=args.format, path_samples=args.path_samples, workers=args.workers)
+
+
+def temporal_command(args):
+    from src.analysis.temporal_network import analyse_temporal_network
+
+    analyse_temporal_network(args.data_dir + '/network_input', args.data_dir + '/network_output',
+                             frequency=args.frequency, window=args.window, step=args.step or args.window,
+                             workers=args.workers, include_pagerank=args.pagerank, input_format=args.format,
+                             output_format=args.format)
+
+
+def cluster_command(args):
+    from src.analysis.text_cluster import TextPreprocessor, cluster_comments
+
+    comments_file = with_extension(args.data_dir + '/staging/comments_dedup.csv', args.format)
+    groups_file = None
+    if args.collapse_duplicates:
+        groups_file = with_extension(args.data_dir + '/staging/duplicate_groups.csv', args.format)
+
+    cluster_comments(comments_file, _directory(args.data_dir + '/analysis') + '/clusters.csv', args.clusters,
+                     streaming=args.streaming, workers=args.workers,
+                     preprocessor=TextPreprocessor(tokenizer=TextPreprocessor.Tokenizer.REGEX),
+                     cache_dir=args.data_dir + '/analysis/tfidf_cache', groups_file=groups_file)
+
+
+def sweep_command(args):
+    from src.analysis.text_cluster import TextPreprocessor, sweep_comments
+
+    comments_file = with_extension(args.data_dir + '/staging/comments_dedup.csv', args.format)
+
+    results = sweep_comments(comments_file, range(args.min_clusters, args.max_clusters + 1),
+                             _directory(args.data_dir + '/analysis') + '/cluster_sweep.csv', workers=args.workers,
+                             preprocessor=TextPreprocessor(tokenizer=TextPreprocessor.Tokenizer.REGEX),
+                             cache_dir=args.data_dir + '/analysis/tfidf_cache')
+    for result in results:
+        print(f"{result['clusters']:>3} clusters: inertia {result['inertia']:.1f}, "
+              f"silhouette {result['silhouette']:.3f}")
+
+
+def pipeline_command(args):
+    from src.analysis.network_analysis import CentralityBackend
+    from src.pipeline.orchestrator import tia_pipeline
+
+    pipeline = tia_pipeline(args.data_dir, crawl_posts=args.crawl, workers=args.workers,
+                            munge_workers=args.munge_workers, output_format=args.format,
+                            backend=CentralityBackend(args.backend), clusters=args.clusters,
+                            streaming=args.streaming, temporal=args.temporal, base_url=args.base_url,
+                            collapse_duplicates=args.collapse_duplicates)
+    pipeline.run(args.targets or None, force=args.force, profile=args.profile)
+
+
+def download_corpora_command(args):
+    import nltk
+
+    for corpus in NLTK_CORPORA:
+        nltk.download(corpus, download_dir=args.download_dir)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='tia', description='Crawl, munge and analyse TechInAsia posts and comments. '
+                                                            'DATA_DIR holds the raw, staging, network and analysis '
+                                                            'directories of a run')
+    subparsers = parser.add_subparsers(dest='command', required=True, metavar='command')
+    workers = os.cpu_count() or 1
+
+    def add_command(name, run, help, data_dir=True, output_format=True):
+        command = subparsers.add_parser(name, help=help, description=help)
+        command.set_defaults(run=run)
+        if data_dir:
+            command.add_argument('data_dir', metavar='DATA_DIR')
+        if output_format:
+            command.add_argument('--format', type=OutputFormat, default=OutputFormat.CSV,
+                                 metavar='{' + ','.join(f.value for f in OutputFormat) + '}',
+                                 help='format of the staging and network files, csv by default')
+        return command
+
+    command = add_command('crawl', crawl_command, 'crawl posts and comments into DATA_DIR/raw', output_format=False)
+    command.add_argument('--delta', action='store_true', help='only crawl new posts and changed comments')
+    command.add_argument('--rescan-days', type=float,
+                         help='with --delta, scan every page of posts for changed comments when the last full scan is '
+                              'older than this many days')
+    command.add_argument('--posts', action='store_true',
+                         help='crawl every page of posts before their comments, rather than using those on disk')
+    command.add_argument('--concurrency', type=int, default=8)
+    command.add_argument('--requests-per-second', type=float, default=10)
+    command.add_argument('--raw-store', action='store_true', help='append pages to compressed raw stores')
+    command.add_argument('--base-url', help='posts endpoint of the API to crawl, like a mirror, TechInAsia by default')
+
+    command = add_command('pack', pack_command, 'move crawled page files into compressed raw stores', data_dir=False,
+                          output_format=False)
+    command.add_argument('directories', nargs='+', metavar='DIR')
+    command.add_argument('--keep', action='store_true', help='keep the page files once packed')
+
+    command = add_command('munge', munge_command, 'flatten raw posts and comments into DATA_DIR/staging')
+    command.add_argument('--only', choices=['posts', 'comments'])
+    command.add_argument('--workers', type=int, default=1)
+    command.add_argument('--compression')
+
+    command = add_command('near-duplicates', near_duplicates_command, 'group near duplicate comments')
+    command.add_argument('--threshold', type=float, default=0.8)
+
+    command = add_command('network-prep', network_prep_command, 'build the network nodes and edges from staging')
+    command.add_argument('--incremental', action='store_true', help='add DATA_DIR/staging_delta to the network')
+    command.add_argument('--collapse-duplicates', action='store_true', help='use the near-duplicates groups')
+
+    command = add_command('network-analysis', network_analysis_command, 'compute the centralities of the network')
+    command.add_argument('--backend', choices=['networkx', 'sparse'], default='sparse')
+    command.add_argument('--incremental', action='store_true', help='only add the edges new since the last run')
+    command.add_argument('--path-samples', type=int, help='estimate betweenness and closeness from this many sources')
+    command.add_argument('--workers', type=int, default=workers)
+
+    command = add_command('temporal', temporal_command, 'compute the centralities of time windows of the network')
+    command.add_argument('--frequency', default='MS', help='pandas frequency of the window periods')
+    command.add_argument('--window', type=int, default=1, help='periods in a window')
+    command.add_argument('--step', type=int, help='periods between window starts, the window by default')
+    command.add_argument('--pagerank', action='store_true')
+    command.add_argument('--workers', type=int, default=workers)
+
+    command = add_command('cluster', cluster_command, 'cluster the comment excerpts into DATA_DIR/analysis')
+    command.add_argument('--clusters', type=int, default=7)
+    command.add_argument('--streaming', action='store_true')
+    command.add_argument('--collapse-duplicates', action='store_true', help='use the near-duplicates groups')
+    command.add_argument('--workers', type=int, default=workers)
+
+    command = add_command('sweep', sweep_command, 'fit a range of numbers of clusters, to choose one')
+    command.add_argument('--min-clusters', type=int, default=2)
+    command.add_argument('--max-clusters', type=int, default=15)
+    command.add_argument('--workers', type=int, default=workers)
+
+    command = add_command('pipeline', pipeline_command, 'run the pipeline stages that are out of date')
+    command.add_argument('targets', nargs='*', metavar='STAGE', help='stages to run, all by default')
+    command.add_argument('--crawl', action='store_true', help='include the crawl of posts and comments')
+    command.add_argument('--base-url', help='posts endpoint of the API to crawl, like a mirror, TechInAsia by default')
+    command.add_argument('--collapse-duplicates', action='store_true',
+                         help='use the near-duplicates groups in the network and the clusters')
+    command.add_argument('--workers', type=int, default=2)
+    command.add_argument('--munge-workers', type=int, default=1)
+    command.add_argument('--backend', choices=['networkx', 'sparse'], default='sparse')
+    command.add_argument('--clusters', type=int, default=7)
+    command.add_argument('--streaming', action='store_true')
+    command.add_argument('--temporal', action='store_true', help='include the monthly window centralities')
+    command.add_argument('--force', action='store_true', help='run the stages even if they are up to date')
+    command.add_argument('--profile', nargs='*', default=[], metavar='STAGE', help='stages to run under cProfile')
+
+    command = add_command('download-corpora', download_corpora_command, 'download the nltk corpora text_cluster uses',
+                          data_dir=False, output_format=False)
+    command.add_argument('--download-dir', help="nltk's default data directory by default")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
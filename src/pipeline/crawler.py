@@ -1,10 +1,153 @@
 import urllib.parse
+import hashlib
+import threading
 import time
 import json
+import os
+import uuid
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from os import listdir
-from os.path import isfile, join
+from os.path import isfile
+
+from src.pipeline import instrumentation
+from src.pipeline.raw_store import RawStore, list_pages, load_page
+
+
+class TokenBucket:
+    """ Thread safe token bucket, allowing bursts of up to capacity requests at rate requests per second """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def create_session(pool_size=10):
+    """ Create a session whose keep-alive connection pool can be shared across crawler threads """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class CrawlManifest:
+    """ Append-only jsonl record of every page written by the crawler, used to resume and delta crawl.
+        Pages are recorded under the run that crawled them, and a run is marked complete once all its pages are """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.pages = {}
+        self.comments_counts = {}
+        # whether each run has completed, in the order the runs started
+        self.runs = {}
+        self.run = None
+        self.lock = threading.Lock()
+
+        if isfile(file_name):
+            self.__drop_partial_line()
+            with open(file_name) as f:
+                for line in f:
+                    if line.strip():
+                        self.__apply(json.loads(line))
+
+    def __drop_partial_line(self):
+        # a record cut short by a crash is not valid json, and would otherwise run into the next one appended
+        with open(self.file_name, 'r+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - 2 ** 16))
+            tail = f.read()
+            if tail and not tail.endswith(b'\n'):
+                f.truncate(size - len(tail) + tail.rfind(b'\n') + 1)
+
+    def start_run(self):
+        """ Resume the last run if it did not complete, otherwise start a new one """
+        unfinished = [run for run, complete in self.runs.items() if not complete]
+        self.run = unfinished[-1] if unfinished else uuid.uuid4().hex
+
+    def complete_run(self):
+        self.__append({'run': self.run, 'complete': True})
+
+    def is_page_crawled(self, file_name, comments_count=None):
+        """ Whether the page can be skipped: comments pages crawled at the same comments_count of their post, and
+            other pages, like those of the posts, only when crawled earlier in this run """
+        record = self.pages.get(file_name)
+        if record is None:
+            return False
+        if comments_count is None:
+            return self.run is not None and record.get('run') == self.run
+        return record['comments_count'] == comments_count
+
+    def get_total_pages(self, file_name):
+        return self.pages[file_name]['total_pages']
+
+    def has_post(self, post_id):
+        return post_id in self.comments_counts
+
+    def get_comments_count(self, post_id):
+        return self.comments_counts.get(post_id)
+
+    def get_post_ids(self):
+        return sorted(self.comments_counts)
+
+    def get_last_full_scan(self):
+        """ When the last page of the posts was last crawled, as a time.time() timestamp, or None """
+        return max((record['fetched_at'] for record in self.pages.values()
+                    if record['data_type'] == 'POST' and record['page'] >= record['total_pages']), default=None)
+
+    def get_changed_post_ids(self):
+        """ Post ids whose latest comments_count differs from the one their comments were crawled at """
+        crawled_counts = {record['post_id']: record['comments_count'] for record in self.pages.values()
+                          if record['data_type'] == 'COMMENT' and record['page'] == 1}
+        return [post_id for post_id in self.get_post_ids()
+                if crawled_counts.get(post_id, -1) != self.comments_counts[post_id]]
+
+    def record_page(self, file_name, data_type, post_id, page, json_contents, comments_count=None):
+        record = {
+            'file': file_name,
+            'data_type': data_type.name,
+            'post_id': post_id,
+            'page': page,
+            'fetched_at': time.time(),
+            'total_pages': json_contents['total_pages'],
+            'content_hash': hashlib.sha1(json.dumps(json_contents, sort_keys=True).encode()).hexdigest(),
+            'comments_count': comments_count,
+            'posts': [[post['id'], post.get('comments_count', 0)] for post in json_contents.get('posts', [])],
+            'run': self.run
+        }
+        self.__append(record)
+
+    def __append(self, record):
+        with self.lock:
+            with open(self.file_name, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self.__apply(record)
+
+    def __apply(self, record):
+        if record.get('run') is not None:
+            self.runs[record['run']] = self.runs.get(record['run'], False) or record.get('complete', False)
+        if 'file' not in record:
+            return
+        self.pages[record['file']] = record
+        for post_id, comments_count in record['posts']:
+            self.comments_counts[post_id] = comments_count
 
 
 class TiaCrawler:
@@ -15,11 +158,19 @@ class TiaCrawler:
         POST = 1
         COMMENT = 2
 
-    def __init__(self, directory, data_type: DataType, post_id=0, sleep_interval=10):
+    def __init__(self, directory, data_type: DataType, post_id=0, sleep_interval=10,
+                 session=None, rate_limiter=None, base_url=BASE_URL, manifest=None, comments_count=None, store=None):
         self.directory = directory
         self.sleep_interval = sleep_interval
         self.data_type = data_type
         self.post_id = post_id
+        self.session = session
+        self.rate_limiter = rate_limiter
+        self.base_url = base_url
+        self.manifest = manifest
+        self.comments_count = comments_count
+        # pages are appended to the raw store when given, instead of each being written to a file of its own
+        self.store = store
 
     def iterate_and_crawl(self, start=1):
         page = start
@@ -33,20 +184,70 @@ class TiaCrawler:
             if page % self.sleep_interval == 0:
                 time.sleep(1)
 
+    def iterate_and_crawl_concurrently(self, start=1, concurrency=8):
+        crawl_concurrently([self], start=start, concurrency=concurrency)
+
+    def iterate_and_crawl_delta(self, full_scan=False, known_post_ids=()):
+        """ Crawl posts from the newest page onwards, stopping at the first page with posts already in the manifest
+            or in known_post_ids, like those of pages crawled before there was a manifest. Only new posts are written.
+            Only the comments_count of posts on the pages crawled is refreshed, so comments on older posts are missed
+            unless full_scan, which crawls every page of posts """
+        known_post_ids = set(known_post_ids)
+        # the run id keeps the files of delta crawls started within the same second apart
+        run = f"{time.strftime('%Y%m%d%H%M%S')}_{self.manifest.run}"
+        page = 1
+        total_pages = 1
+
+        while page <= total_pages:
+            response = self.__make_request(self.__create_url(page))
+            new_posts = [post for post in response.get('posts', [])
+                         if not self.manifest.has_post(post['id']) and post['id'] not in known_post_ids]
+
+            file_name = f'delta_{run}_{page}'
+            print(f'Crawling page {page} for new posts')
+            self.__write_to_file(file_name, dict(response, posts=new_posts))
+            self.manifest.record_page(file_name, self.data_type, self.post_id, page, response)
+
+            if not full_scan and (len(new_posts) < len(response.get('posts', [])) or not new_posts):
+                break
+            total_pages = self.__get_total_pages(response)
+            page += 1
+
+    def crawl_page(self, page):
+        return self.__request_and_write(page)
+
     def __request_and_write(self, page):
+        file_name = self.__get_file_name(page)
+        if self.manifest is not None and self.manifest.is_page_crawled(file_name, self.comments_count):
+            return self.manifest.get_total_pages(file_name)
+
         url = self.__create_url(page)
         response = self.__make_request(url)
         self.__write_to_file(self.__get_output_file_name(page), response)
+        if self.manifest is not None:
+            self.manifest.record_page(file_name, self.data_type, self.post_id, page, response, self.comments_count)
         return self.__get_total_pages(response)
 
     def __make_request(self, url):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        http = self.session if self.session is not None else requests
         try:
-            r = requests.get(url, headers=self.__headers())
+            start = time.perf_counter()
+            r = http.get(url, headers=self.__headers())
+            instrumentation.observe('http_request', time.perf_counter() - start)
+            instrumentation.count('http_requests')
+            instrumentation.count('bytes_downloaded', len(r.content))
             return r.json()
         except RuntimeError:
             print(f'Unable to send request successfully. Url is {url}')
 
     def __write_to_file(self, file_name, json_contents):
+        if self.store is not None:
+            self.store.write_page(file_name, json_contents)
+            return
+
         with open(self.directory + file_name, 'w') as f:
             json.dump(json_contents, f)
 
@@ -54,16 +255,21 @@ class TiaCrawler:
         params = self.__create_parameters(page)
 
         if self.data_type == self.DataType.POST:
-            return self.BASE_URL + '?' + urllib.parse.urlencode(params)
+            return self.base_url + '?' + urllib.parse.urlencode(params)
         elif self.data_type == self.DataType.COMMENT:
-            return self.BASE_URL + f'/{self.post_id}/comments?' + urllib.parse.urlencode(params)
+            return self.base_url + f'/{self.post_id}/comments?' + urllib.parse.urlencode(params)
 
     def __get_output_file_name(self, page):
         if self.data_type == self.DataType.POST:
             print(f'Crawling page {page}')
-            return f'{page}'
         elif self.data_type == self.DataType.COMMENT:
             print(f'Crawling page {page} of post {self.post_id}')
+        return self.__get_file_name(page)
+
+    def __get_file_name(self, page):
+        if self.data_type == self.DataType.POST:
+            return f'{page}'
+        elif self.data_type == self.DataType.COMMENT:
             return f'{self.post_id}_{page}'
 
     @staticmethod
@@ -79,6 +285,19 @@ class TiaCrawler:
         return {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/61.0.3163.91 Safari/537.36'}
 
 
+def crawl_concurrently(crawlers, start=1, concurrency=8):
+    """ Crawl the first page of every crawler, then fan out all remaining pages across a thread pool """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        all_total_pages = list(executor.map(lambda crawler: crawler.crawl_page(start), crawlers))
+
+        futures = [executor.submit(crawler.crawl_page, page)
+                   for crawler, total_pages in zip(crawlers, all_total_pages)
+                   for page in range(start + 1, total_pages + 1)]
+
+        for future in futures:
+            future.result()
+
+
 class TiaDataMunger():
 
     def __init__(self, input_directory, output_file_name=""):
@@ -91,40 +310,69 @@ class TiaDataMunger():
         all_file_counter = 0
         valid_file_counter = 0
 
-        for file in self.__input_file_list():
+        for page in list_pages(self.input_directory):
             all_file_counter += 1
+            json_obj = load_page(page)
 
-            with open(file) as f:
-                json_obj = json.load(f)
-
-                if 'posts' in json_obj:
-                    valid_file_counter += 1
-                    for item in json_obj['posts']:
-                        post_ids.append(item['id'])
-                        records += 1
+            if 'posts' in json_obj:
+                valid_file_counter += 1
+                for item in json_obj['posts']:
+                    post_ids.append(item['id'])
+                    records += 1
 
         print(f'{records} post ids have been retrieved from {valid_file_counter} valid json files, out of a total of {all_file_counter} json files')
         return sorted(post_ids)
 
-    def __input_file_list(self):
-        files = [join(self.input_directory, f) for f in listdir(self.input_directory) if isfile(join(self.input_directory, f))]
-        return sorted(files)
-
 
 base_dir = "/home/timothy/Projects/assignments/tia_text_analytics/data/raw"
 
 
-def crawl():
-    posts_dir = base_dir + '/posts/'
-    # post_crawler = TiaCrawler(posts_dir, TiaCrawler.DataType.POST)
-    # post_crawler.iterate_and_crawl()
-
-    munger = TiaDataMunger(posts_dir)
-    ids = munger.get_all_post_ids()
-
-    for post_id in ids:
-        comments_crawler = TiaCrawler(base_dir + '/comments/', TiaCrawler.DataType.COMMENT, post_id=post_id)
-        comments_crawler.iterate_and_crawl()
-
-
-crawl()
+def crawl(concurrency=8, requests_per_second=10, delta=False, raw_dir=base_dir, raw_store=False,
+          base_url=TiaCrawler.BASE_URL, rescan_days=None, posts=False):
+    """ Crawl new posts and the comments of new and changed posts with delta. Otherwise crawl the comments of the posts
+        in the posts directory, crawling every page of posts into it first when posts is set.
+        With raw_store, pages are appended to compressed raw stores in the posts and comments directories.
+        base_url is the posts endpoint of the API, which can be pointed at a mirror.
+        With rescan_days, a delta crawl scans every page of posts when the last full scan is older than that, to pick
+        up new comments on posts past the pages of new posts """
+    posts_dir = raw_dir + '/posts/'
+    comments_dir = raw_dir + '/comments/'
+    for directory in [posts_dir, comments_dir]:
+        os.makedirs(directory, exist_ok=True)
+    session = create_session(pool_size=concurrency)
+    rate_limiter = TokenBucket(requests_per_second)
+    manifest = CrawlManifest(raw_dir + '/crawl_manifest.jsonl')
+    manifest.start_run()
+    posts_store = RawStore(posts_dir) if raw_store else None
+    comments_store = RawStore(comments_dir) if raw_store else None
+    post_crawler = TiaCrawler(posts_dir, TiaCrawler.DataType.POST, session=session, rate_limiter=rate_limiter,
+                              base_url=base_url, manifest=manifest, store=posts_store)
+
+    if delta:
+        # only new posts, and comments of posts whose comments_count has changed since they were crawled
+        last_full_scan = manifest.get_last_full_scan()
+        full_scan = rescan_days is not None and (last_full_scan is None or
+                                                 time.time() - last_full_scan >= rescan_days * 24 * 60 * 60)
+        post_crawler.iterate_and_crawl_delta(full_scan=full_scan,
+                                             known_post_ids=TiaDataMunger(posts_dir).get_all_post_ids())
+        ids = manifest.get_changed_post_ids()
+    else:
+        if posts:
+            post_crawler.iterate_and_crawl_concurrently(concurrency=concurrency)
+        munger = TiaDataMunger(posts_dir)
+        ids = munger.get_all_post_ids()
+
+    comments_crawlers = [TiaCrawler(comments_dir, TiaCrawler.DataType.COMMENT, post_id=post_id,
+                                    session=session, rate_limiter=rate_limiter, base_url=base_url, manifest=manifest,
+                                    comments_count=manifest.get_comments_count(post_id), store=comments_store)
+                         for post_id in ids]
+    crawl_concurrently(comments_crawlers, concurrency=concurrency)
+
+    for store in [posts_store, comments_store]:
+        if store is not None:
+            store.close()
+    manifest.complete_run()
+
+
+if __name__ == "__main__":
+    crawl()
@@ -0,0 +1,198 @@
+import csv
+import os
+from enum import Enum
+
+
+class OutputFormat(Enum):
+    CSV = "csv"
+    PARQUET = "parquet"
+    FEATHER = "feather"
+
+    @property
+    def extension(self):
+        return '.' + self.value
+
+
+def with_extension(file_name, output_format: OutputFormat):
+    """ Replace a trailing .csv with the extension of the given output format, appending it otherwise """
+    if file_name.endswith('.csv'):
+        file_name = file_name[:-len('.csv')]
+    return file_name + output_format.extension
+
+
+def format_of(file_name):
+    for output_format in OutputFormat:
+        if file_name.endswith(output_format.extension):
+            return output_format
+    return OutputFormat.CSV
+
+
+class CsvRowWriter:
+
+    def __init__(self, file_name, header):
+        self.file = open(file_name, 'w')
+        self.writer = csv.writer(self.file, quoting=csv.QUOTE_ALL)
+        self.writer.writerow(header)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ArrowRowWriter:
+    """ Buffers rows and streams them out as parquet row groups or feather record batches.
+        The column types are declared up front as arrow type names, see column_type, so that every row group is
+        written with the same schema. Columns without a declared type are strings """
+
+    def __init__(self, file_name, header, output_format: OutputFormat, compression=None, row_group_size=65536,
+                 types=None):
+        import pyarrow
+
+        self.pa = pyarrow
+        self.file_name = file_name
+        self.header = header
+        self.output_format = output_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.schema = pyarrow.schema([(name, getattr(pyarrow, type_name)())
+                                      for name, type_name in zip(header, types or ['string'] * len(header))])
+        self.writer = None
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.row_group_size:
+            self.__flush()
+
+    def close(self):
+        self.__flush()
+        if self.writer is None:
+            self.__open_writer()
+        self.writer.close()
+
+    def __flush(self):
+        if not self.rows:
+            return
+
+        arrays = [self.__array(column, field.type) for column, field in zip(zip(*self.rows), self.schema)]
+        self.rows = []
+
+        if self.writer is None:
+            self.__open_writer()
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def __array(self, values, type):
+        if self.pa.types.is_string(type):
+            values = [self._to_string(value) for value in values]
+        return self.pa.array(values, type=type)
+
+    def __open_writer(self):
+        if self.output_format == OutputFormat.PARQUET:
+            import pyarrow.parquet
+
+            self.writer = pyarrow.parquet.ParquetWriter(self.file_name, self.schema,
+                                                        compression=self.compression or 'none')
+        else:
+            import pyarrow.ipc
+
+            options = pyarrow.ipc.IpcWriteOptions(compression=self.compression)
+            self.writer = pyarrow.ipc.new_file(self.file_name, self.schema, options=options)
+
+    @staticmethod
+    def _to_string(value):
+        # values are written the way the csv writer would print them
+        if value is None or isinstance(value, str):
+            return value
+        return str(value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def column_type(type_names):
+    """ Name of the arrow type of a column holding values of the python types named, None values aside.
+        Columns whose values are of no single kind are strings """
+    type_names = set(type_names)
+    if not type_names:
+        return 'string'
+    if type_names == {'bool'}:
+        return 'bool_'
+    if type_names == {'int'}:
+        return 'int64'
+    if type_names <= {'int', 'float'}:
+        return 'float64'
+    return 'string'
+
+
+def open_row_writer(file_name, header, output_format=OutputFormat.CSV, compression=None, types=None):
+    """ Writer of rows under header, types are the arrow type names of the columns and are not needed for csv """
+    if output_format == OutputFormat.CSV:
+        return CsvRowWriter(file_name, header)
+    return ArrowRowWriter(file_name, header, output_format, compression=compression, types=types)
+
+
+def write_frame(df, file_name, compression=None, index=True):
+    """ Write a dataframe in the format given by the file extension """
+    output_format = format_of(file_name)
+
+    if output_format == OutputFormat.CSV:
+        df.to_csv(file_name, quoting=csv.QUOTE_ALL, index=index)
+    elif output_format == OutputFormat.PARQUET:
+        df.to_parquet(file_name, compression=compression, index=index)
+    else:
+        # feather cannot store a non default index, so it is kept as a column
+        df = df.reset_index() if index else df.reset_index(drop=True)
+        df.to_feather(file_name, compression=compression)
+
+
+def append_frame(df, file_name, compression=None, index=True):
+    """ Append rows to a file written by write_frame. csv files are appended in place, the others are rewritten """
+    import pandas as pd
+
+    if not os.path.exists(file_name):
+        write_frame(df, file_name, compression=compression, index=index)
+        return
+
+    output_format = format_of(file_name)
+
+    if output_format == OutputFormat.CSV:
+        df.to_csv(file_name, mode='a', header=False, quoting=csv.QUOTE_ALL, index=index)
+    elif output_format == OutputFormat.PARQUET:
+        write_frame(pd.concat([read_frame(file_name), df]), file_name, compression=compression, index=index)
+    else:
+        # the index of a feather file was written as a column, so it is appended as one
+        df = df.reset_index() if index else df.reset_index(drop=True)
+        write_frame(pd.concat([read_frame(file_name), df]), file_name, compression=compression, index=False)
+
+
+def read_frame(file_name, columns=None, dtype=None):
+    """ Read a dataframe in the format given by the file extension, loading only the requested columns """
+    import pandas as pd
+
+    output_format = format_of(file_name)
+
+    if output_format == OutputFormat.CSV:
+        return pd.read_csv(file_name, usecols=columns, dtype=dtype)
+    elif output_format == OutputFormat.PARQUET:
+        df = pd.read_parquet(file_name, columns=columns)
+    else:
+        df = pd.read_feather(file_name, columns=columns)
+
+    return df.astype(dtype) if dtype is not None else df
@@ -0,0 +1,177 @@
+import bisect
+import cProfile
+import json
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class LatencyHistogram:
+    """ Counts of latencies in buckets doubling from 1ms up to about a minute, with a last bucket for anything slower """
+    BOUNDS = [0.001 * 2 ** i for i in range(17)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """ Upper bound of the bucket holding the q-th percentile """
+        if self.count == 0:
+            return 0.0
+
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {f'{bound:g}': count for bound, count in zip(self.BOUNDS + ['inf'], self.counts) if count}
+        }
+
+
+class StageMetrics:
+    """ Wall time, cpu time, peak rss, counters and latency histograms of one stage.
+        cpu time includes worker processes the stage waited for, peak rss is the high water mark of the process
+        or of its largest finished child, whichever is larger. Both are lifetime marks, so a stage only has a peak
+        rss of its own when it is measured in a fresh process, see run_measured """
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss_mb = 0.0
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault(name, LatencyHistogram())
+        histogram.record(seconds)
+
+    def to_dict(self):
+        metrics = {
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'peak_rss_mb': self.peak_rss_mb,
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+        }
+        if self.wall_time > 0:
+            metrics['throughput'] = {f'{name}_per_second': value / self.wall_time for name, value in self.counters.items()}
+        return metrics
+
+
+_active_stage = None
+
+
+def count(name, value=1):
+    """ Add to a counter of the stage being measured, does nothing outside of MetricsRecorder.stage """
+    if _active_stage is not None:
+        _active_stage.count(name, value)
+
+
+def observe(name, seconds):
+    """ Record a latency in a histogram of the stage being measured, does nothing outside of MetricsRecorder.stage """
+    if _active_stage is not None:
+        _active_stage.observe(name, seconds)
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+class MetricsRecorder:
+    """ Metrics of one run, by stage. Code running inside stage reports records and bytes through count and
+        latencies through observe, and the whole run is written out as json """
+
+    def __init__(self, run_id=None):
+        self.run_id = run_id or datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        self.started_at = time.time()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, profile_file=None):
+        """ Measure the enclosed code as stage name, with profile_file it is also profiled and the cProfile
+            stats are dumped there """
+        global _active_stage
+
+        stage = self.stages[name] = StageMetrics(name)
+        previous_stage, _active_stage = _active_stage, stage
+        profiler = cProfile.Profile() if profile_file is not None else None
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_seconds()
+
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(profile_file)
+
+            stage.wall_time = time.perf_counter() - start_wall
+            stage.cpu_time = _cpu_seconds() - start_cpu
+            stage.peak_rss_mb = _peak_rss_mb()
+            _active_stage = previous_stage
+
+    def add_stage(self, name, metrics):
+        """ Add the metrics of a stage measured elsewhere, like in a worker process """
+        self.stages[name] = metrics
+
+    def to_dict(self):
+        return {
+            'run_id': self.run_id,
+            'started_at': self.started_at,
+            'stages': {name: stage if isinstance(stage, dict) else stage.to_dict() for name, stage in self.stages.items()}
+        }
+
+    def write(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def run_measured(name, function, params, profile_file=None):
+    """ Call function with params as stage name of a fresh recorder, returning the stage metrics as a dict.
+        Used to measure stages in worker processes, where the recorder of the run is not available.
+        The process should run no other stage, or the peak rss will be that of the largest stage it has run """
+    recorder = MetricsRecorder()
+    with recorder.stage(name, profile_file=profile_file):
+        function(**params)
+    return recorder.stages[name].to_dict()
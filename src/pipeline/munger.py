@@ -1,8 +1,78 @@
 import json
-import csv
+import mmap
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from os import listdir
-from os.path import isfile, join
+from operator import itemgetter
+from os.path import isfile
+
+from src.pipeline import instrumentation
+from src.pipeline.formats import OutputFormat, column_type, open_row_writer, with_extension
+from src.pipeline.raw_store import list_pages, load_page, page_size, page_version
+
+
+class IdBitmap:
+    """ Compact set of non-negative integer ids using one bit per id, optionally backed by a memory mapped file """
+
+    def __init__(self, file_name=None):
+        self.file = open(file_name, 'w+b') if file_name is not None else None
+        self.bits = bytearray()
+
+    def add(self, id):
+        """ Add an id to the set, returning False if it was already present.
+            Raises ValueError for anything but a non-negative integer, which has no bit """
+        if not isinstance(id, int) or id < 0:
+            raise ValueError(f'IdBitmap only holds non-negative integer ids, not {id!r}')
+        byte, bit = divmod(id, 8)
+        if byte >= len(self.bits):
+            self.__grow(byte + 1)
+
+        mask = 1 << bit
+        if self.bits[byte] & mask:
+            return False
+        self.bits[byte] |= mask
+        return True
+
+    def close(self):
+        if self.file is not None:
+            if isinstance(self.bits, mmap.mmap):
+                self.bits.close()
+            self.file.close()
+
+    def __grow(self, size):
+        size = max(size, 2 * len(self.bits))
+
+        if self.file is None:
+            self.bits.extend(bytes(size - len(self.bits)))
+        else:
+            if isinstance(self.bits, mmap.mmap):
+                self.bits.close()
+            self.file.truncate(size)
+            self.bits = mmap.mmap(self.file.fileno(), size)
+
+
+class DeduplicatingWriter:
+    """ Wraps a csv writer, dropping rows whose id in the first column has already been written.
+        Ids the bitmap cannot hold, like the None of comments without an id or negative ids, are kept in a set """
+
+    def __init__(self, writer, ids):
+        self.writer = writer
+        self.ids = ids
+        self.other_ids = set()
+        self.duplicates = 0
+
+    def writerows(self, rows):
+        unique_rows = [row for row in rows if self.__add(row[0])]
+        self.duplicates += len(rows) - len(unique_rows)
+        self.writer.writerows(unique_rows)
+
+    def __add(self, id):
+        try:
+            return self.ids.add(id)
+        except ValueError:
+            if id in self.other_ids:
+                return False
+            self.other_ids.add(id)
+            return True
 
 
 class JsonToCsv:
@@ -11,45 +81,142 @@ class JsonToCsv:
         POST = "posts"
         COMMENT = "comments"
 
-    def __init__(self, input_directory, output_file_name, data_type: DataType, exclude=list()):
+    # keys of nested objects whose own keys become columns, discovered together with the top level keys
+    SUB_LEVEL_KEYS = []
+    # number of csv files each item is flattened into
+    OUTPUT_COUNT = 1
+
+    def __init__(self, input_directory, output_file_name, data_type: DataType, exclude=list(), workers=1,
+                 output_format=OutputFormat.CSV, compression=None):
         self.input_directory = input_directory
         self.output_file_name = output_file_name
         self.data_type = data_type
+        self.workers = workers
+        self.output_format = output_format
+        self.compression = compression
+        self.schema = self._get_schema()
         self.key_list = self._get_top_level_keys(exclude=exclude)
 
-    def _get_top_level_keys(self, exclude=list()):
-        key_list = set()
+    def _get_schema(self):
+        """ Load the schema cached next to the input directory, rediscovering it if any input page has changed """
+        file_mtimes = {page.name: page_version(page) for page in self._input_pages()}
+
+        if isfile(self._schema_file_name()):
+            with open(self._schema_file_name()) as f:
+                schema = json.load(f)
+            if (schema['file_mtimes'] == file_mtimes and schema['sub_level_keys'].keys() == set(self.SUB_LEVEL_KEYS)
+                    and 'top_level_types' in schema):
+                return schema
+
+        schema = self._discover_schema()
+        schema['file_mtimes'] = file_mtimes
+        with open(self._schema_file_name(), 'w') as f:
+            json.dump(schema, f)
+        return schema
+
+    def _discover_schema(self):
+        """ Collect the top level keys and the keys of every sub level object in a single pass over the input,
+            together with the names of the types of their values """
+        top_level_types = {}
+        sub_level_types = {key: {} for key in self.SUB_LEVEL_KEYS}
+
+        for item in self._iterate_items():
+            for obj in self._schema_objects(item):
+                self._add_types(top_level_types, obj)
+                for key, key_types in sub_level_types.items():
+                    value = obj.get(key, None)
+                    if isinstance(value, list):
+                        for element in value:
+                            self._add_types(key_types, element)
+                    elif isinstance(value, dict):
+                        self._add_types(key_types, value)
+
+        return {
+            'top_level_keys': sorted(top_level_types),
+            'sub_level_keys': {key: sorted(key_types) for key, key_types in sub_level_types.items()},
+            'top_level_types': {key: sorted(types) for key, types in top_level_types.items()},
+            'sub_level_types': {key: {k: sorted(types) for k, types in key_types.items()}
+                                for key, key_types in sub_level_types.items()}
+        }
+
+    def _schema_objects(self, item):
+        """ The objects of an item that are written as rows """
+        return [item]
+
+    @staticmethod
+    def _add_types(key_types, obj):
+        for key, value in obj.items():
+            types = key_types.setdefault(key, set())
+            if value is not None:
+                types.add(type(value).__name__)
 
-        for file in self._input_file_list():
-            with open(file) as f:
-                json_obj = json.load(f)
-                if self.data_type.value in json_obj:
-                    for item in json_obj[self.data_type.value]:
-                        key_list.update(item.keys())
+    def _schema_file_name(self):
+        return self.input_directory.rstrip('/') + '_schema.json'
+
+    def _get_top_level_keys(self, exclude=list()):
+        key_list = set(self.schema['top_level_keys'])
 
         for key in exclude:
             key_list.remove(key)
 
         key_list.remove('id')
         # push id to be the first column
-        return ['id'] + list(key_list)
+        return ['id'] + sorted(key_list)
 
     def _get_sub_level_keys(self, key):
-        key_list = set()
-
-        for file in self._input_file_list():
-            with open(file) as f:
-                json_obj = json.load(f)
-                if self.data_type.value in json_obj:
-                    for item in json_obj[self.data_type.value]:
-                        if key in item:
-                            if isinstance(item[key], list):
-                                for element in item[key]:
-                                    key_list.update(element.keys())
-                            else:
-                                key_list.update(item[key].keys())
-
-        return list(key_list)
+        return self.schema['sub_level_keys'][key]
+
+    def _column_types(self, key_list, sub_level_key=None):
+        """ Names of the arrow types of the columns of key_list, declared to the writers so that the types of the
+            columns do not depend on the rows that happen to be written first """
+        if sub_level_key is None:
+            types = self.schema['top_level_types']
+        else:
+            types = self.schema['sub_level_types'][sub_level_key]
+        return [column_type(types.get(key, [])) for key in key_list]
+
+    def _iterate_items(self):
+        for page in self._input_pages():
+            json_obj = load_page(page)
+            if self.data_type.value in json_obj:
+                yield from json_obj[self.data_type.value]
+
+    def _write_batches(self, writers):
+        records = 0
+
+        for batches, file_records in self._flatten_files():
+            for writer, rows in zip(writers, batches):
+                writer.writerows(rows)
+            records += file_records
+        print(f'{records} have been printed')
+        instrumentation.count('records', records)
+
+    def _flatten_files(self):
+        """ Flatten every input page in sorted order, sharding the pages across a process pool when workers > 1 """
+        pages = self._input_pages()
+        instrumentation.count('files_read', len(pages))
+        instrumentation.count('bytes_read', sum(page_size(page) for page in pages))
+
+        if self.workers > 1:
+            chunksize = max(1, len(pages) // (self.workers * 4))
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                yield from executor.map(self._flatten_file, pages, chunksize=chunksize)
+        else:
+            yield from map(self._flatten_file, pages)
+
+    def _flatten_file(self, page):
+        batches = [[] for _ in range(self.OUTPUT_COUNT)]
+        records = 0
+
+        json_obj = load_page(page)
+        if self.data_type.value in json_obj:
+            for item in json_obj[self.data_type.value]:
+                self._flatten(batches, item)
+                records += 1
+        return batches, records
+
+    def _flatten(self, batches, item):
+        raise NotImplementedError
 
     @staticmethod
     def _get_sub_level_headers(key, key_list):
@@ -59,58 +226,116 @@ class JsonToCsv:
     def _json_to_arr(json_obj, key_list):
         return [json_obj.get(key, None) for key in key_list]
 
-    def _input_file_list(self):
-        files = [join(self.input_directory, f) for f in listdir(self.input_directory) if isfile(join(self.input_directory, f))]
-        return sorted(files)
+    @staticmethod
+    def _tuple_getter(key_list):
+        """ itemgetter of the values of key_list as a tuple, raising KeyError when a key is missing.
+            None for fewer than two keys, as itemgetter would not return a tuple """
+        return itemgetter(*key_list) if len(key_list) > 1 else None
+
+    def _open_writer(self, file_name, header, types):
+        return open_row_writer(with_extension(file_name, self.output_format), header,
+                               output_format=self.output_format, compression=self.compression, types=types)
+
+    def _input_pages(self):
+        # pages are either json files of their own or packed into a raw store, see raw_store
+        return list_pages(self.input_directory)
 
 
 class CommentsJsonToCsv(JsonToCsv):
 
-    def __init__(self, input_directory, output_file_name, exclude=list()):
-        super().__init__(input_directory, output_file_name, JsonToCsv.DataType.COMMENT, exclude=exclude)
+    SUB_LEVEL_KEYS = ['author']
+    # depth below the top level comment of the thread, and the id of that comment
+    THREAD_COLUMNS = ['depth', 'root_id']
+
+    def __init__(self, input_directory, output_file_name, exclude=list(), workers=1,
+                 deduplicate=False, dedup_file_name=None, output_format=OutputFormat.CSV, compression=None):
+        super().__init__(input_directory, output_file_name, JsonToCsv.DataType.COMMENT, exclude=exclude, workers=workers,
+                         output_format=output_format, compression=compression)
         self.author_key_list = self._get_sub_level_keys('author')
+        self.values = self._tuple_getter(self.key_list)
+        self.author_values = self._tuple_getter(self.author_key_list)
+        self.deduplicate = deduplicate
+        self.dedup_file_name = dedup_file_name
 
     def write_data_to_csv(self):
         # print(f'list of keys extracted: {key_list}')
-        with open(self.output_file_name, 'w') as csv_file:
-            writer = csv.writer(csv_file, quoting=csv.QUOTE_ALL)
-            writer.writerow(self.key_list + self._get_sub_level_headers('author', self.author_key_list))
+        header = self.key_list + self._get_sub_level_headers('author', self.author_key_list) + self.THREAD_COLUMNS
+        types = (self._column_types(self.key_list) + self._column_types(self.author_key_list, 'author') +
+                 ['int64'] + self._column_types(['id']))
+        with self._open_writer(self.output_file_name, header, types) as writer:
             self._write_to_csv(writer)
 
     def _write_to_csv(self, writer):
-        records = 0
-
-        for file in self._input_file_list():
-            with open(file) as f:
-                json_obj = json.load(f)
-                if self.data_type.value in json_obj:
-                    for item in json_obj[self.data_type.value]:
-                        self._write(writer, item)
-                        self._extract_children_and_replies(item, writer)
-                        records += 1
-        print(f'{records} have been printed')
-
-    # recursively extract all children and replies for comments
-    def _extract_children_and_replies(self, obj, writer):
-        if 'children' in obj:
-            for object in obj['children']:
-                self._write(writer, object)
-                self._extract_children_and_replies(object, writer)
-        if 'replies' in obj:
-            for object in obj['replies']:
-                self._write(writer, object)
-                self._extract_children_and_replies(object, writer)
-
-    def _write(self, writer, object):
-        standard_values = self._json_to_arr(object, self.key_list)
-        author_values = self._json_to_arr(object.get('author', None), self.author_key_list)
-        writer.writerow(standard_values + author_values)
+        if not self.deduplicate:
+            self._write_batches([writer])
+            return
+
+        # comments reached through both children and replies are only written once
+        ids = IdBitmap(self.dedup_file_name)
+        dedup_writer = DeduplicatingWriter(writer, ids)
+        try:
+            self._write_batches([dedup_writer])
+        finally:
+            ids.close()
+        print(f'{dedup_writer.duplicates} duplicates have been suppressed')
+        instrumentation.count('duplicates', dedup_writer.duplicates)
+
+    def _flatten(self, batches, item):
+        """ Write a top level comment and every comment under it, in the order a depth first walk over children
+            and then replies reaches them. An explicit stack is used, so that no thread is too deep to flatten """
+        rows = batches[0]
+        values = self.values
+        author_values = self.author_values
+        root_id = item.get('id')
+        # iterators over the comments left to write at each level of the thread, with the depth of that level
+        stack = [(iter((item,)), 0)]
+
+        while stack:
+            comments, depth = stack[-1]
+            for obj in comments:
+                try:
+                    rows.append(values(obj) + author_values(obj['author']) + (depth, root_id))
+                except (KeyError, TypeError):
+                    rows.append(self.__row(obj) + (depth, root_id))
+
+                children = obj.get('children')
+                replies = obj.get('replies')
+                if children or replies:
+                    # pushed so that children are written first, the rest of this level is resumed afterwards
+                    if replies:
+                        stack.append((iter(replies), depth + 1))
+                    if children:
+                        stack.append((iter(children), depth + 1))
+                    break
+            else:
+                stack.pop()
+
+    def _schema_objects(self, item):
+        # every comment of the thread is written, not only the top level one
+        objects = []
+        stack = [item]
+        while stack:
+            obj = stack.pop()
+            objects.append(obj)
+            stack.extend(obj.get('children') or ())
+            stack.extend(obj.get('replies') or ())
+        return objects
+
+    def __row(self, obj):
+        # comments missing some of the keys, or with fewer than two keys to get, which the getters cannot handle
+        author = obj.get('author', None) or {}
+        return tuple(self._json_to_arr(obj, self.key_list) + self._json_to_arr(author, self.author_key_list))
 
 
 class PostsJsonToCsv(JsonToCsv):
 
-    def __init__(self, input_directory, output_file_name, exclude=list()):
-        super().__init__(input_directory, output_file_name, JsonToCsv.DataType.POST, exclude=exclude)
+    SUB_LEVEL_KEYS = ['author', 'seo', 'sponsor', 'categories', 'companies', 'tags']
+    OUTPUT_COUNT = 4
+
+    def __init__(self, input_directory, output_file_name, exclude=list(), workers=1,
+                 output_format=OutputFormat.CSV, compression=None):
+        super().__init__(input_directory, output_file_name, JsonToCsv.DataType.POST, exclude=exclude, workers=workers,
+                         output_format=output_format, compression=compression)
         self.author_key_list = self._get_sub_level_keys('author')
         self.seo_key_list = self._get_sub_level_keys('seo')
         self.sponsor_key_list = self._get_sub_level_keys('sponsor')
@@ -121,87 +346,76 @@ class PostsJsonToCsv(JsonToCsv):
 
     def write_data_to_csv(self):
         # print(f'list of keys extracted: {key_list}')
-        with open(self.output_file_name + '.csv', 'w') as posts_csv, \
-                open(self.output_file_name + '_categories.csv', 'w') as categories_csv, \
-                open(self.output_file_name + '_companies.csv', 'w') as companies_csv, \
-                open(self.output_file_name + '_tags.csv', 'w') as tags_csv:
-
-            self.post_writer = csv.writer(posts_csv, quoting=csv.QUOTE_ALL)
-            self.category_writer = csv.writer(categories_csv, quoting=csv.QUOTE_ALL)
-            self.company_writer = csv.writer(companies_csv, quoting=csv.QUOTE_ALL)
-            self.tag_writer = csv.writer(tags_csv, quoting=csv.QUOTE_ALL)
-
-            self.post_writer.writerow(self.key_list +
-                            self._get_sub_level_headers('author', self.author_key_list) +
-                            self._get_sub_level_headers('seo', self.seo_key_list) +
-                            self._get_sub_level_headers('sponsor', self.sponsor_key_list)
-                            )
-            self.category_writer.writerow(self.category_key_list + ['post_id'])
-            self.company_writer.writerow(self.company_key_list + ['post_id'])
-            self.tag_writer.writerow(self.tag_key_list + ['post_id'])
-
-            self._write_to_csv()
-
-    def _write_to_csv(self):
-        records = 0
-
-        for file in self._input_file_list():
-            with open(file) as f:
-                json_obj = json.load(f)
-                if self.data_type.value in json_obj:
-                    for item in json_obj[self.data_type.value]:
-                        self._write(item)
-                        records += 1
-        print(f'{records} have been printed')
-
-    def _write(self, object):
+        post_header = (self.key_list +
+                       self._get_sub_level_headers('author', self.author_key_list) +
+                       self._get_sub_level_headers('seo', self.seo_key_list) +
+                       self._get_sub_level_headers('sponsor', self.sponsor_key_list))
+
+        post_types = (self._column_types(self.key_list) +
+                      self._column_types(self.author_key_list, 'author') +
+                      self._column_types(self.seo_key_list, 'seo') +
+                      self._column_types(self.sponsor_key_list, 'sponsor'))
+        post_id_type = self._column_types(['id'])
+
+        with self._open_writer(self.output_file_name, post_header, post_types) as post_writer, \
+                self._open_writer(self.output_file_name + '_categories', self.category_key_list + ['post_id'],
+                                  self._column_types(self.category_key_list, 'categories') + post_id_type) as category_writer, \
+                self._open_writer(self.output_file_name + '_companies', self.company_key_list + ['post_id'],
+                                  self._column_types(self.company_key_list, 'companies') + post_id_type) as company_writer, \
+                self._open_writer(self.output_file_name + '_tags', self.tag_key_list + ['post_id'],
+                                  self._column_types(self.tag_key_list, 'tags') + post_id_type) as tag_writer:
+
+            self._write_to_csv([post_writer, category_writer, company_writer, tag_writer])
+
+    def _write_to_csv(self, writers):
+        self._write_batches(writers)
+
+    def _flatten(self, batches, item):
+        self._write(batches, item)
+
+    def _write(self, batches, object):
+        post_rows, category_rows, company_rows, tag_rows = batches
         standard_values = self._json_to_arr(object, self.key_list)
         author_values = self._json_to_arr(object.get('author', None), self.author_key_list)
         seo_values = self._json_to_arr(object.get('seo', None), self.seo_key_list)
         sponsor_values = self._json_to_arr(object.get('sponsor', None), self.sponsor_key_list)
-        self.post_writer.writerow(standard_values + author_values + seo_values + sponsor_values)
+        post_rows.append(standard_values + author_values + seo_values + sponsor_values)
 
-        self._extract_sub_array(object, 'categories', self.category_writer, self.category_key_list)
-        self._extract_sub_array(object, 'companies', self.company_writer, self.company_key_list)
-        self._extract_sub_array(object, 'tags', self.tag_writer, self.tag_key_list)
+        self._extract_sub_array(object, 'categories', category_rows, self.category_key_list)
+        self._extract_sub_array(object, 'companies', company_rows, self.company_key_list)
+        self._extract_sub_array(object, 'tags', tag_rows, self.tag_key_list)
 
-    def _extract_sub_array(self, obj, key, writer, key_list):
+    def _extract_sub_array(self, obj, key, rows, key_list):
         if key in obj:
             for element in obj[key]:
                 values = self._json_to_arr(element, key_list)
-                writer.writerow(values + [obj['id']])
+                rows.append(values + [obj['id']])
 
 
 base_dir = "/home/timothy/Projects/assignments/tia_text_analytics/data"
 
 #   find the keys of the sub-level,
 #  write them to an external file, also include the post_id
-def munge_posts():
-    posts_dir = base_dir + '/raw/posts/'
-    output_posts_file = base_dir + '/staging/posts'
+def munge_posts(workers=1, output_format=OutputFormat.CSV, compression=None, data_dir=base_dir):
+    posts_dir = data_dir + '/raw/posts/'
+    output_posts_file = data_dir + '/staging/posts'
 
-    post_munger = PostsJsonToCsv(posts_dir, output_posts_file, exclude=['seo', 'sponsor', 'author', 'categories', 'companies', 'tags'])
+    post_munger = PostsJsonToCsv(posts_dir, output_posts_file, exclude=['seo', 'sponsor', 'author', 'categories', 'companies', 'tags'],
+                                 workers=workers, output_format=output_format, compression=compression)
     post_munger.write_data_to_csv()
 
 
-def munge_comments():
-    comments_dir = base_dir + '/raw/comments/'
-    output_comments_file = base_dir + '/staging/comments.csv'
-    output_comments_dedup_file = base_dir + '/staging/comments_dedup.csv'
+def munge_comments(workers=1, output_format=OutputFormat.CSV, compression=None, data_dir=base_dir):
+    comments_dir = data_dir + '/raw/comments/'
+    output_comments_dedup_file = data_dir + '/staging/comments_dedup.csv'
 
-    comment_munger = CommentsJsonToCsv(comments_dir, output_comments_file, exclude=['children', 'replies', 'author'])
+    comment_munger = CommentsJsonToCsv(comments_dir, output_comments_dedup_file, exclude=['children', 'replies', 'author'],
+                                       workers=workers, deduplicate=True, output_format=output_format,
+                                       compression=compression)
     comment_munger.write_data_to_csv()
 
-    # remove duplicate rows
-    with open(output_comments_file, 'r') as f, open(output_comments_dedup_file, 'w') as out_file:
-        writer = csv.writer(out_file, quoting=csv.QUOTE_ALL)
-        reader = csv.reader(f, delimiter=',', quoting=csv.QUOTE_ALL)
-        identifiers = set()
-        for row in reader:
-            if row[0] not in identifiers:
-                writer.writerow(row)
-                identifiers.add(row[0])
-
 
-munge_comments()
-munge_posts()
+# guarded so that spawned munging worker processes do not re-run the munge
+if __name__ == "__main__":
+    munge_comments()
+    munge_posts()
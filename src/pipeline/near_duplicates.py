@@ -0,0 +1,315 @@
+import os
+
+import numpy as np
+
+from src.pipeline import instrumentation
+from src.pipeline.formats import OutputFormat, read_frame, with_extension, write_frame
+
+MAX_HASH = np.uint32(2 ** 32 - 1)
+
+
+class MinHashIndex:
+    """ MinHash signatures of comment excerpts in a banded LSH index, grouping texts whose estimated Jaccard
+        similarity of character shingles is at least threshold. Each text is only compared with the first text
+        that fell into the same bucket of any band, so adding n texts takes about n * bands comparisons,
+        and groups are the connected components of the matches. A group is named after its earliest added text """
+
+    def __init__(self, num_perm=128, bands=16, shingle_size=5, threshold=0.8, seed=0):
+        if num_perm % bands:
+            raise ValueError(f'num_perm {num_perm} is not a multiple of bands {bands}')
+
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        # multiply-shift hashing, one odd multiplier and offset per permutation, and one multiplier per band row
+        self.multipliers = self._odd_integers(rng, num_perm)
+        self.offsets = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+        self.band_multipliers = self._odd_integers(rng, num_perm // bands)
+
+        self.ids = np.empty(0, dtype=np.int64)
+        self.parents = np.empty(0, dtype=np.int64)
+        self.signatures = np.empty((0, num_perm), dtype=np.uint32)
+        # text_digests of the indexed texts, to tell when one has changed
+        self.digests = np.empty(0, dtype=np.uint64)
+        # per band, the sorted bucket hashes and the position of the first text in each bucket
+        self.band_hashes = [np.empty(0, dtype=np.uint64) for _ in range(bands)]
+        self.band_texts = [np.empty(0, dtype=np.int64) for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def shingle_hashes(self, texts):
+        """ 64 bit hashes of the character shingles of every text, lowercased with runs of whitespace collapsed,
+            returned with the number of shingles of each text. Texts shorter than a shingle are one shingle """
+        k = self.shingle_size
+        encoded = [' '.join(str(text).lower().split()).encode() for text in texts]
+        encoded = [text.ljust(k, b'\0') if text else text for text in encoded]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        counts = np.maximum(lengths - k + 1, 0)
+
+        buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8).astype(np.uint64)
+        window_count = max(len(buffer) - k + 1, 0)
+        hashes = np.zeros(window_count, dtype=np.uint64)
+        for i in range(k):
+            hashes = hashes * np.uint64(1099511628211) + buffer[i:i + window_count]
+
+        # only the windows starting far enough from the end of their text are shingles
+        starts = np.cumsum(lengths) - lengths
+        first_shingle = np.cumsum(counts) - counts
+        windows = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(first_shingle, counts)
+        return hashes[windows], counts
+
+    def minhash(self, texts, max_values=2 ** 20):
+        """ MinHash signatures of texts, computed over slices of texts whose shingles times num_perm stay below
+            max_values. Texts without any shingle, the empty ones, get a signature of MAX_HASH """
+        shingles, counts = self.shingle_hashes(texts)
+        signatures = np.full((len(counts), self.num_perm), MAX_HASH, dtype=np.uint32)
+        ends = np.cumsum(counts)
+        max_shingles = max(1, max_values // self.num_perm)
+
+        start_text = 0
+        while start_text < len(counts):
+            first = ends[start_text] - counts[start_text]
+            # at least one text per slice, however long it is
+            end_text = max(start_text + 1, int(np.searchsorted(ends, first + max_shingles, side='right')))
+            last = ends[end_text - 1]
+            if last > first:
+                # one row per permutation, so that the minimum of each text is taken over contiguous memory
+                values = np.multiply.outer(self.multipliers, shingles[first:last])
+                values += self.offsets[:, None]
+                values >>= np.uint64(32)
+                filled = counts[start_text:end_text] > 0
+                slice_starts = (ends[start_text:end_text] - counts[start_text:end_text] - first)[filled]
+                signatures[start_text + np.flatnonzero(filled)] = np.minimum.reduceat(values, slice_starts, axis=1).T
+            start_text = end_text
+        return signatures
+
+    def add(self, ids, texts):
+        """ Add texts by their integer ids, linking them to the texts already indexed that they near-duplicate.
+            Ids already in the index are skipped """
+        ids = np.asarray(ids, dtype=np.int64)
+        _, first = np.unique(ids, return_index=True)
+        keep = np.zeros(len(ids), dtype=bool)
+        keep[first] = True
+        keep &= ~np.isin(ids, self.ids)
+        ids = ids[keep]
+        texts = [text for text, kept in zip(texts, keep) if kept]
+        if not len(ids):
+            return
+        self._add_signatures(ids, self.minhash(texts), text_digests(texts))
+
+    def retain(self, ids, digests):
+        """ The index of only the indexed texts whose id is still in ids with the same text_digest, as if the others
+            had never been added. Their signatures are reused rather than computed again """
+        import pandas as pd
+
+        ids = np.asarray(ids, dtype=np.int64)
+        first = ~pd.Index(ids).duplicated()
+        positions = pd.Index(ids[first]).get_indexer(self.ids)
+        keep = positions >= 0
+        keep[keep] = np.asarray(digests)[first][positions[keep]] == self.digests[keep]
+        if keep.all():
+            return self
+
+        index = MinHashIndex(self.num_perm, self.bands, self.shingle_size, self.threshold, self.seed)
+        if keep.any():
+            index._add_signatures(self.ids[keep], self.signatures[keep], self.digests[keep])
+        return index
+
+    def _add_signatures(self, ids, signatures, digests):
+        filled = (signatures != MAX_HASH).any(axis=1)
+        positions = len(self.ids) + np.arange(len(ids))
+        band_hashes = self._band_hashes(signatures)
+
+        lefts, rights = [], []
+        for band in range(self.bands):
+            hashes = band_hashes[filled, band]
+            texts_in_band = positions[filled]
+
+            # a text indexed by an earlier call in the same bucket
+            indexed = self._lookup(band, hashes)
+            found = indexed >= 0
+            lefts.append(texts_in_band[found])
+            rights.append(indexed[found])
+
+            # the first text of this call in the same bucket
+            unique_hashes, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+            earlier = texts_in_band[first][inverse]
+            lefts.append(texts_in_band[earlier != texts_in_band])
+            rights.append(earlier[earlier != texts_in_band])
+
+            # buckets seen for the first time keep their first text
+            unseen = ~found[first]
+            self._insert(band, unique_hashes[unseen], texts_in_band[first][unseen])
+
+        self.ids = np.concatenate([self.ids, ids])
+        self.parents = np.concatenate([self.parents, positions])
+        self.signatures = np.concatenate([self.signatures, signatures])
+        self.digests = np.concatenate([self.digests, digests])
+
+        # pairs sharing a bucket in several bands are compared once
+        pairs = np.unique(np.concatenate(lefts) * len(self.ids) + np.concatenate(rights))
+        left, right = np.divmod(pairs, len(self.ids))
+        matches = self._similarities(left, right) >= self.threshold
+        self._union(left[matches], right[matches])
+        instrumentation.count('candidate_pairs', len(left))
+        instrumentation.count('matched_pairs', int(matches.sum()))
+
+    def query(self, texts):
+        """ The group of an indexed near-duplicate of every text, or -1 for texts without one. Nothing is added """
+        signatures = self.minhash(texts)
+        band_hashes = self._band_hashes(signatures)
+        filled = (signatures != MAX_HASH).any(axis=1)
+        groups = np.full(len(texts), -1, dtype=np.int64)
+        roots = self._roots()
+
+        for band in range(self.bands):
+            indexed = self._lookup(band, band_hashes[:, band])
+            candidates = np.flatnonzero((indexed >= 0) & filled & (groups == -1))
+            similar = (signatures[candidates] == self.signatures[indexed[candidates]]).mean(axis=1) >= self.threshold
+            groups[candidates[similar]] = self.ids[roots[indexed[candidates[similar]]]]
+        return groups
+
+    def groups(self, ids):
+        """ The group of every id, the id of the earliest added text it near-duplicates, itself if there is none.
+            Ids that are not in the index are their own group """
+        import pandas as pd
+
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = pd.Index(self.ids).get_indexer(ids)
+        groups = ids.copy()
+        indexed = positions >= 0
+        groups[indexed] = self.ids[self._roots()[positions[indexed]]]
+        return groups
+
+    @staticmethod
+    def _odd_integers(rng, count):
+        return rng.integers(0, 2 ** 63, count, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+
+    def _band_hashes(self, signatures):
+        rows = signatures.reshape(len(signatures), self.bands, self.num_perm // self.bands).astype(np.uint64)
+        return (rows * self.band_multipliers).sum(axis=2, dtype=np.uint64)
+
+    def _lookup(self, band, hashes):
+        """ Position of the first text in the bucket of each hash, -1 for buckets not in the index """
+        bucket_hashes = self.band_hashes[band]
+        if not len(bucket_hashes):
+            return np.full(len(hashes), -1, dtype=np.int64)
+        slots = np.minimum(np.searchsorted(bucket_hashes, hashes), len(bucket_hashes) - 1)
+        return np.where(bucket_hashes[slots] == hashes, self.band_texts[band][slots], -1)
+
+    def _insert(self, band, hashes, texts):
+        # hashes are unique and sorted, as returned by np.unique
+        slots = np.searchsorted(self.band_hashes[band], hashes)
+        self.band_hashes[band] = np.insert(self.band_hashes[band], slots, hashes)
+        self.band_texts[band] = np.insert(self.band_texts[band], slots, texts)
+
+    def _similarities(self, left, right, chunk_size=2 ** 16):
+        """ Estimated Jaccard similarity of the texts at the given positions, the fraction of equal minhashes """
+        similarities = np.empty(len(left))
+        for start in range(0, len(left), chunk_size):
+            left_signatures = self.signatures[left[start:start + chunk_size]]
+            right_signatures = self.signatures[right[start:start + chunk_size]]
+            similarities[start:start + chunk_size] = (left_signatures == right_signatures).mean(axis=1)
+        return similarities
+
+    def _union(self, left, right):
+        # union find with path halving over a list, the earlier text of two groups becomes the root
+        parents = self.parents.tolist()
+        for a, b in zip(left.tolist(), right.tolist()):
+            while parents[a] != a:
+                parents[a] = a = parents[parents[a]]
+            while parents[b] != b:
+                parents[b] = b = parents[parents[b]]
+            if a != b:
+                parents[max(a, b)] = min(a, b)
+        self.parents = np.asarray(parents, dtype=np.int64)
+
+    def _roots(self):
+        roots = self.parents
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
+
+    def save(self, file_name):
+        bands = {f'band_hashes_{band}': hashes for band, hashes in enumerate(self.band_hashes)}
+        bands.update({f'band_texts_{band}': texts for band, texts in enumerate(self.band_texts)})
+        np.savez(file_name, ids=self.ids, parents=self.parents, signatures=self.signatures, digests=self.digests,
+                 parameters=np.array([self.num_perm, self.bands, self.shingle_size, self.seed]),
+                 threshold=np.array(self.threshold), **bands)
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as stored:
+            num_perm, bands, shingle_size, seed = stored['parameters'].tolist()
+            index = cls(num_perm, bands, shingle_size, float(stored['threshold']), seed)
+            index.ids = stored['ids']
+            index.parents = stored['parents']
+            index.signatures = stored['signatures']
+            # indexes saved before digests were kept cannot tell changed texts apart
+            index.digests = stored['digests'] if 'digests' in stored.files else None
+            index.band_hashes = [stored[f'band_hashes_{band}'] for band in range(bands)]
+            index.band_texts = [stored[f'band_texts_{band}'] for band in range(bands)]
+        return index
+
+
+def text_digests(texts):
+    """ 64 bit hashes of texts, to tell which indexed texts have changed """
+    import pandas as pd
+
+    return pd.util.hash_array(np.asarray(texts, dtype=object))
+
+
+def find_near_duplicates(comments_file, groups_file, index_file, threshold=0.8, batch_size=100000, compression=None):
+    """ Add the comments of comments_file to the index kept in index_file, creating it on the first run, and write
+        the duplicate_group of every comment to groups_file. Comments indexed by earlier runs with the same excerpt
+        are not hashed again. Comments no longer in comments_file, or whose excerpt has changed, are dropped from the
+        index first, and an index built with another threshold is built again """
+    import pandas as pd
+
+    comments_df = read_frame(comments_file, columns=['id', 'excerpt'])
+    ids = comments_df['id'].to_numpy()
+    excerpts = comments_df['excerpt'].fillna('').tolist()
+    index = MinHashIndex.load(index_file) if os.path.isfile(index_file) else None
+    if index is None or index.threshold != threshold or index.digests is None:
+        index = MinHashIndex(threshold=threshold)
+    else:
+        index = index.retain(ids, text_digests(excerpts))
+
+    indexed = len(index)
+    for start in range(0, len(ids), batch_size):
+        index.add(ids[start:start + batch_size], excerpts[start:start + batch_size])
+    os.makedirs(os.path.dirname(index_file) or '.', exist_ok=True)
+    index.save(index_file)
+
+    groups_df = pd.DataFrame({'id': ids, 'duplicate_group': index.groups(ids)})
+    write_frame(groups_df, groups_file, compression=compression, index=False)
+
+    near_duplicates = int((groups_df['id'] != groups_df['duplicate_group']).sum())
+    print(f'{len(index) - indexed} comments indexed, {near_duplicates} of {len(ids)} are near duplicates')
+    instrumentation.count('records', len(ids))
+    instrumentation.count('near_duplicates', near_duplicates)
+    return groups_df
+
+
+def read_groups(groups_file, ids):
+    """ The duplicate_group of every id, itself for ids not in groups_file """
+    import pandas as pd
+
+    groups_df = read_frame(groups_file, columns=['id', 'duplicate_group'])
+    positions = pd.Index(groups_df['id']).get_indexer(ids)
+    return np.where(positions >= 0, groups_df['duplicate_group'].to_numpy()[positions], ids)
+
+
+if __name__ == "__main__":
+    base_dir = '/home/timothy/Projects/assignments/tia_text_analytics/data'
+    output_format = OutputFormat.CSV
+
+    find_near_duplicates(with_extension(base_dir + '/staging/comments_dedup.csv', output_format),
+                         with_extension(base_dir + '/staging/duplicate_groups.csv', output_format),
+                         base_dir + '/staging/minhash_index.npz')
@@ -1,118 +1,289 @@
+import json
+import os
+import uuid
+
+import numpy as np
 import pandas as pd
-import csv
-
-base_dir = '/home/timothy/Projects/assignments/tia_text_analytics/data'
-
-posts_csv = base_dir + '/staging/posts.csv'
-companies_csv = base_dir + '/staging/posts_companies.csv'
-comments_csv = base_dir + '/staging/comments_dedup.csv'
-
-companies_node_csv = base_dir + '/network_input/companies_node.csv'
-authors_node_csv = base_dir + '/network_input/authors_node.csv'
-all_edges_csv = base_dir + '/network_input/edges.csv'
-
-posts_df = pd.read_csv(posts_csv)
-companies_df = pd.read_csv(companies_csv)
-comments_df = pd.read_csv(comments_csv)
-
-
-
-# rename columns
-posts_df = posts_df.rename(index=str, columns={'id': 'post_id'})
-companies_df = companies_df.rename(index=str, columns={'id': 'company_id'})
-comments_df = comments_df.rename(index=str, columns={'id': 'comment_id', 'post': 'post_id', 'parent':'parent_id'})
-
-# subset columns
-posts_df = posts_df[['post_id', 'date_gmt', 'comments_count', 'is_sponsored', 'title', 'read_time', 'type',
-                     'author_id', 'author_display_name', 'author_roles']]
-companies_df = companies_df[['company_id', 'name', 'post_id', 'date_founded']]
-comments_df = comments_df[['comment_id', 'date_gmt', 'post_id', 'excerpt', 'parent_id',
-                           'author_id', 'author_display_name', 'author_roles']]
-
-
-# nodes (company, authors)
-# edges (posts, comments)
-
-# prepare node data for authors
-author_posts_df = posts_df[['author_id', 'author_display_name', 'author_roles']]
-author_comments_df = comments_df[['author_id', 'author_display_name', 'author_roles']]
-authors_node_df = pd.concat([author_posts_df, author_comments_df])
-authors_node_df = authors_node_df.drop_duplicates(keep='first')
-authors_node_df = authors_node_df.rename(index=str, columns={'author_id': 'id', 'author_display_name': 'label'})
-authors_node_df['type'] = 'author'
-
-# prepare node data for companies
-companies_node_df = companies_df.drop_duplicates(subset=['company_id', 'name', 'date_founded'], keep='first')
-companies_node_df = companies_node_df[['company_id', 'name', 'date_founded']]
-companies_node_df['type'] = 'company'
-companies_node_df = companies_node_df.rename(index=str, columns={'company_id': 'id', 'name':'label'})
-
-authors_node_df.index.name = 'index_id'
-companies_node_df.index.name = 'index_id'
-authors_node_df.to_csv(authors_node_csv, quoting=csv.QUOTE_ALL)
-companies_node_df.to_csv(companies_node_csv, quoting=csv.QUOTE_ALL)
-
-
-# edges :
-#   author -> company (through post)
-#   author -> company (through comments)
-#   author -> author (through comments)
-# print(posts_df.shape)
-author_to_posts_df = pd.merge(posts_df, companies_df, on='post_id')
-author_to_posts_df = author_to_posts_df[['post_id', 'company_id', 'author_id', 'title']]
-# print(author_to_posts_df.shape)
-
-# prepare edge data: author -> company (through posts)
-author_to_company_df = author_to_posts_df[['company_id', 'author_id', 'title']]
-author_to_company_df = author_to_company_df.rename(index=str, columns={'author_id': 'source', 'company_id': 'target', 'title': 'excerpt'})
-author_to_company_df['source_type'] = 'author'
-author_to_company_df['target_type'] = 'company'
-author_to_company_df['edge_type'] = 'post'
-# # Note, not all posts are linked to companies, hence there will be less records here than there are posts
-# print(author_to_company_df.shape)
-# print(author_to_company_df)
-
-
-# prepare edge data: author -> company (through comments)
-comments_to_posts_df = pd.merge(author_to_posts_df[['post_id', 'company_id']], comments_df, on='post_id')
-comments_to_posts_df = comments_to_posts_df[['post_id', 'company_id', 'comment_id', 'parent_id', 'author_id', 'excerpt']]
-# print(comments_to_posts_df)
-# print(comments_to_posts_df.shape)
-
-# if parent_id = 0, then its a comment on the post/company directly
-comments_on_posts_df = comments_to_posts_df.loc[comments_to_posts_df['parent_id'] == 0]
-comments_on_posts_df = comments_on_posts_df[['company_id', 'author_id', 'excerpt']]
-comments_on_posts_df = comments_on_posts_df.rename(index=str, columns={'author_id': 'source', 'company_id': 'target'})
-comments_on_posts_df['source_type'] = 'author'
-comments_on_posts_df['target_type'] = 'company'
-comments_on_posts_df['edge_type'] = 'comment'
-# print(comments_on_posts_df.shape)
-# Note, the above is limited by comments on posts with companies
-
-# prepare edge data: author -> author (through comments)
-# join back with itself to join the author_id of the parent post
-comment_parents_df = comments_df[['comment_id','author_id']]
-comment_parents_df = comment_parents_df.rename(index=str, columns={'comment_id':'parent_id', 'author_id': 'parent_author_id'})
-comments_on_comments_df = pd.merge(comments_df, comment_parents_df, on='parent_id')
-# print(comments_on_comments_df)
-
-# if parent_id != 0, then we use the parent_id instead of post_id
-comments_on_comments_df = comments_on_comments_df.loc[comments_on_comments_df['parent_id'] != 0]
-comments_on_comments_df = comments_on_comments_df[['author_id', 'parent_author_id', 'excerpt']]
-comments_on_comments_df = comments_on_comments_df.rename(index=str, columns={'author_id': 'source', 'parent_author_id': 'target'})
-comments_on_comments_df['source_type'] = 'author'
-comments_on_comments_df['target_type'] = 'author'
-comments_on_comments_df['edge_type'] = 'comment'
-# print(comments_on_comments_df.shape)
-# print(comments_on_comments_df)
-
-
-all_edges_df = pd.concat([author_to_company_df, comments_on_posts_df, comments_on_comments_df])
-all_edges_df = all_edges_df.rename(index=str, columns={'excerpt': 'label'})
-all_edges_df.index.name = 'index_id'
-
-# print(all_edges_df)
-all_edges_df.to_csv(all_edges_csv, quoting=csv.QUOTE_ALL)
+
+from src.pipeline import instrumentation
+from src.pipeline.formats import OutputFormat, append_frame, read_frame, write_frame, with_extension
+from src.pipeline.near_duplicates import read_groups
+
+POST_COLUMNS = ['id', 'comments_count', 'date_gmt', 'is_sponsored', 'title', 'read_time', 'type',
+                'author_id', 'author_display_name', 'author_roles']
+COMPANY_COLUMNS = ['id', 'name', 'post_id', 'date_founded']
+COMMENT_COLUMNS = ['id', 'date_gmt', 'post', 'excerpt', 'parent', 'author_id', 'author_display_name', 'author_roles']
+AUTHOR_COLUMNS = ['author_id', 'author_display_name', 'author_roles']
+# columns that tell nodes apart when new ones are added to an existing network
+AUTHOR_NODE_KEYS = ['id', 'label', 'author_roles']
+COMPANY_NODE_KEYS = ['id', 'label', 'date_founded']
+
+
+def read_staging(posts_file, companies_file, comments_file):
+    posts_df = read_frame(posts_file, columns=POST_COLUMNS)
+    companies_df = read_frame(companies_file, columns=COMPANY_COLUMNS)
+    comments_df = read_frame(comments_file, columns=COMMENT_COLUMNS)
+    instrumentation.count('bytes_read', sum(os.path.getsize(file) for file in [posts_file, companies_file, comments_file]))
+    instrumentation.count('records', len(posts_df) + len(companies_df) + len(comments_df))
+
+    posts_df = posts_df.rename(columns={'id': 'post_id'})
+    companies_df = companies_df.rename(columns={'id': 'company_id'})
+    comments_df = comments_df.rename(columns={'id': 'comment_id', 'post': 'post_id', 'parent': 'parent_id'})
+    return posts_df, companies_df, comments_df
+
+
+def prepare_author_nodes(posts_df, comments_df):
+    authors_node_df = pd.concat([posts_df[AUTHOR_COLUMNS], comments_df[AUTHOR_COLUMNS]])
+    authors_node_df = authors_node_df.drop_duplicates(keep='first')
+    authors_node_df = authors_node_df.rename(columns={'author_id': 'id', 'author_display_name': 'label'})
+    authors_node_df['type'] = 'author'
+    authors_node_df.index.name = 'index_id'
+    return authors_node_df
+
+
+def prepare_company_nodes(companies_df):
+    companies_node_df = companies_df.drop_duplicates(subset=['company_id', 'name', 'date_founded'], keep='first')
+    companies_node_df = companies_node_df[['company_id', 'name', 'date_founded']]
+    companies_node_df['type'] = 'company'
+    companies_node_df = companies_node_df.rename(columns={'company_id': 'id', 'name': 'label'})
+    companies_node_df.index.name = 'index_id'
+    return companies_node_df
+
+
+def join_positions(left_keys, right_keys, left_mask=None, right_mask=None):
+    """ Row positions of the inner join of two key columns, without materialising the joined frame.
+        Pairs come in pandas merge order, by left row and then by right row. The masks drop rows before joining,
+        and the returned join positions are those the kept pairs would have had in the unfiltered join """
+    left_count = len(left_keys)
+    codes, uniques = pd.factorize(np.concatenate([np.asarray(left_keys), np.asarray(right_keys)]),
+                                  use_na_sentinel=False)
+    left_codes, right_codes = codes[:left_count], codes[left_count:]
+
+    # rank of every right row among the right rows sharing its key, and where each left row's pairs would start
+    right_counts = np.bincount(right_codes, minlength=len(uniques))
+    right_order = np.argsort(right_codes, kind='stable')
+    right_rank = np.empty(len(right_codes), dtype=np.int64)
+    right_rank[right_order] = np.arange(len(right_codes)) - np.repeat(np.cumsum(right_counts) - right_counts, right_counts)
+    left_offsets = np.cumsum(right_counts[left_codes]) - right_counts[left_codes]
+
+    kept_right = np.arange(len(right_codes)) if right_mask is None else np.flatnonzero(right_mask)
+    kept_right = kept_right[np.argsort(right_codes[kept_right], kind='stable')]
+    kept_counts = np.bincount(right_codes[kept_right], minlength=len(uniques))
+    kept_starts = np.cumsum(kept_counts) - kept_counts
+
+    pairs_per_left = kept_counts[left_codes]
+    if left_mask is not None:
+        pairs_per_left = pairs_per_left * np.asarray(left_mask, dtype=np.int64)
+
+    left_idx = np.repeat(np.arange(left_count), pairs_per_left)
+    within = np.arange(len(left_idx)) - np.repeat(np.cumsum(pairs_per_left) - pairs_per_left, pairs_per_left)
+    right_idx = kept_right[np.repeat(kept_starts[left_codes], pairs_per_left) + within]
+    return left_idx, right_idx, left_offsets[left_idx] + right_rank[right_idx]
+
+
+def _edges(index, source, target, label, source_type, target_type, edge_type, date_gmt):
+    return pd.DataFrame({
+        'target': target,
+        'source': source,
+        'label': label,
+        'source_type': source_type,
+        'target_type': target_type,
+        'edge_type': edge_type,
+        'date_gmt': date_gmt
+    }, index=pd.Index(index, name='index_id'))
+
+
+def prepare_edges(posts_df, companies_df, comments_df, post_companies_df=None, comment_authors_df=None):
+    """ Edges author -> company through posts, author -> company through comments on posts and
+        author -> author through replies to comments, each dated by the post or comment that makes it.
+        post_companies_df and comment_authors_df are lookups of earlier runs, so that new comments are also joined
+        to the posts and comments already in the network """
+    post_author = posts_df['author_id'].to_numpy()
+    company_id = companies_df['company_id'].to_numpy()
+    comment_author = comments_df['author_id'].to_numpy()
+    comment_excerpt = comments_df['excerpt'].to_numpy()
+    parent_id = comments_df['parent_id'].to_numpy()
+    comment_date = comments_df['date_gmt'].to_numpy()
+
+    # author -> company (through posts), not all posts are linked to companies
+    post_idx, company_idx, positions = join_positions(posts_df['post_id'], companies_df['post_id'])
+    author_to_company_df = _edges(positions, post_author[post_idx], company_id[company_idx],
+                                  posts_df['title'].to_numpy()[post_idx], 'author', 'company', 'post',
+                                  posts_df['date_gmt'].to_numpy()[post_idx])
+
+    # author -> company (through comments), if parent_id = 0 then it is a comment on the post/company directly
+    pair_post = companies_df['post_id'].to_numpy()[company_idx]
+    pair_company = company_id[company_idx]
+    if post_companies_df is not None:
+        pair_post = np.concatenate([post_companies_df['post_id'].to_numpy(), pair_post])
+        pair_company = np.concatenate([post_companies_df['company_id'].to_numpy(), pair_company])
+    pair_idx, comment_idx, positions = join_positions(pair_post, comments_df['post_id'], right_mask=parent_id == 0)
+    comments_on_posts_df = _edges(positions, comment_author[comment_idx], pair_company[pair_idx],
+                                  comment_excerpt[comment_idx], 'author', 'company', 'comment',
+                                  comment_date[comment_idx])
+
+    # author -> author (through comments), joining each reply to the author of the comment it replies to
+    parent_keys = comments_df['comment_id'].to_numpy()
+    parent_author = comment_author
+    if comment_authors_df is not None:
+        parent_keys = np.concatenate([comment_authors_df['comment_id'].to_numpy(), parent_keys])
+        parent_author = np.concatenate([comment_authors_df['author_id'].to_numpy(), parent_author])
+    reply_idx, parent_idx, positions = join_positions(parent_id, parent_keys, left_mask=parent_id != 0)
+    comments_on_comments_df = _edges(positions, comment_author[reply_idx], parent_author[parent_idx],
+                                     comment_excerpt[reply_idx], 'author', 'author', 'comment',
+                                     comment_date[reply_idx])
+
+    return pd.concat([author_to_company_df, comments_on_posts_df, comments_on_comments_df])
+
+
+def collapse_near_duplicates(comments_df, groups):
+    """ Split comments into those that make edges and the near duplicates of an earlier comment by the same author,
+        like reposted spam. The near duplicates are returned as a (comment_id, author_id) lookup, so that replies
+        to them are still joined to their author """
+    repeated = pd.DataFrame({'group': groups, 'author_id': comments_df['author_id'].to_numpy()}).duplicated().to_numpy()
+    instrumentation.count('collapsed_comments', int(repeated.sum()))
+    return comments_df[~repeated], comments_df.loc[repeated, ['comment_id', 'author_id']]
+
+
+def prepare_lookups(posts_df, companies_df, comments_df):
+    """ The (post_id, company_id) pairs of linked posts and the (comment_id, author_id) of comments,
+        kept next to the network so that later runs can join new comments without the full staging files """
+    post_idx, company_idx, _ = join_positions(posts_df['post_id'], companies_df['post_id'])
+    post_companies_df = pd.DataFrame({'post_id': posts_df['post_id'].to_numpy()[post_idx],
+                                      'company_id': companies_df['company_id'].to_numpy()[company_idx]})
+    comment_authors_df = comments_df[['comment_id', 'author_id']]
+    return post_companies_df, comment_authors_df
+
+
+def _network_files(network_input_dir, output_format):
+    return {name: with_extension(f'{network_input_dir}/{name}.csv', output_format)
+            for name in ['authors_node', 'companies_node', 'edges', 'edges_delta', 'post_companies', 'comment_authors']}
+
+
+def _state_file(network_input_dir):
+    return network_input_dir + '/network_state.json'
+
+
+def read_state(network_input_dir):
+    """ The state kept next to the network: the network_id given to it when it was built, and the next_edge_index
+        to number added edges from """
+    with open(_state_file(network_input_dir)) as f:
+        return json.load(f)
+
+
+def _write_state(network_input_dir, edges_df, state=None):
+    state = dict(state or {})
+    state['next_edge_index'] = max(state.get('next_edge_index', 0), int(edges_df.index.max()) + 1 if len(edges_df) else 0)
+    with open(_state_file(network_input_dir), 'w') as f:
+        json.dump(state, f)
+
+
+def _read_indexed(file_name):
+    df = read_frame(file_name)
+    return df.set_index('index_id') if 'index_id' in df.columns else df
+
+
+def _new_nodes(nodes_df, node_file, keys):
+    """ Nodes that are not in node_file yet, indexed after the ones that are """
+    existing_df = _read_indexed(node_file)
+    known = pd.concat([existing_df[keys], nodes_df[keys]]).duplicated(keep='first').to_numpy()[len(existing_df):]
+    nodes_df = nodes_df[~known]
+
+    start = int(existing_df.index.max()) + 1 if len(existing_df) else 0
+    nodes_df.index = pd.Index(start + np.arange(len(nodes_df)), name='index_id')
+    return nodes_df
+
+
+def build_network(staging_dir, network_input_dir, staging_format=OutputFormat.CSV, output_format=OutputFormat.CSV,
+                  compression=None, groups_file=None):
+    """ Read the staging posts, companies and comments and write the author and company nodes and all edges.
+        With the groups_file of find_near_duplicates, repeated near duplicates of an author make no edges """
+    posts_df, companies_df, comments_df = read_staging(
+        with_extension(staging_dir + '/posts.csv', staging_format),
+        with_extension(staging_dir + '/posts_companies.csv', staging_format),
+        with_extension(staging_dir + '/comments_dedup.csv', staging_format))
+    files = _network_files(network_input_dir, output_format)
+
+    authors_node_df = prepare_author_nodes(posts_df, comments_df)
+    companies_node_df = prepare_company_nodes(companies_df)
+    edge_comments_df, collapsed_df = comments_df, None
+    if groups_file is not None:
+        groups = read_groups(groups_file, comments_df['comment_id'])
+        edge_comments_df, collapsed_df = collapse_near_duplicates(comments_df, groups)
+    edges_df = prepare_edges(posts_df, companies_df, edge_comments_df, comment_authors_df=collapsed_df)
+    instrumentation.count('nodes', len(authors_node_df) + len(companies_node_df))
+    instrumentation.count('edges', len(edges_df))
+
+    write_frame(authors_node_df, files['authors_node'], compression=compression)
+    write_frame(companies_node_df, files['companies_node'], compression=compression)
+    write_frame(edges_df, files['edges'], compression=compression)
+
+    post_companies_df, comment_authors_df = prepare_lookups(posts_df, companies_df, comments_df)
+    write_frame(post_companies_df, files['post_companies'], compression=compression, index=False)
+    write_frame(comment_authors_df, files['comment_authors'], compression=compression, index=False)
+    # the edges of an update of the previous network do not belong to this one
+    if os.path.exists(files['edges_delta']):
+        os.remove(files['edges_delta'])
+    # a new id, so that centralities kept for the previous network are not updated with this one
+    _write_state(network_input_dir, edges_df, {'network_id': uuid.uuid4().hex})
+
+
+def update_network(staging_dir, network_input_dir, staging_format=OutputFormat.CSV, output_format=OutputFormat.CSV,
+                   compression=None, groups_file=None):
+    """ Add the posts and comments staged since the last run to the network in network_input_dir.
+        Their edges are appended to edges, numbered after the existing ones, and also written to edges_delta, which
+        only ever holds the edges of the last update. Only unseen author and company nodes are added.
+        Without an existing network the whole network is built instead.
+        With groups_file, near duplicates are collapsed among the comments being added """
+    if not os.path.exists(_state_file(network_input_dir)):
+        build_network(staging_dir, network_input_dir, staging_format, output_format, compression, groups_file)
+        return
+
+    posts_df, companies_df, comments_df = read_staging(
+        with_extension(staging_dir + '/posts.csv', staging_format),
+        with_extension(staging_dir + '/posts_companies.csv', staging_format),
+        with_extension(staging_dir + '/comments_dedup.csv', staging_format))
+    files = _network_files(network_input_dir, output_format)
+    state = read_state(network_input_dir)
+
+    edge_comments_df, comment_authors_df = comments_df, read_frame(files['comment_authors'])
+    if groups_file is not None:
+        groups = read_groups(groups_file, comments_df['comment_id'])
+        edge_comments_df, collapsed_df = collapse_near_duplicates(comments_df, groups)
+        comment_authors_df = pd.concat([comment_authors_df, collapsed_df])
+    edges_df = prepare_edges(posts_df, companies_df, edge_comments_df,
+                             post_companies_df=read_frame(files['post_companies']),
+                             comment_authors_df=comment_authors_df)
+    edges_df.index = pd.Index(state['next_edge_index'] + np.arange(len(edges_df)), name='index_id')
+
+    authors_node_df = _new_nodes(prepare_author_nodes(posts_df, comments_df), files['authors_node'], AUTHOR_NODE_KEYS)
+    companies_node_df = _new_nodes(prepare_company_nodes(companies_df), files['companies_node'], COMPANY_NODE_KEYS)
+    post_companies_df, comment_authors_df = prepare_lookups(posts_df, companies_df, comments_df)
+
+    append_frame(authors_node_df, files['authors_node'], compression=compression)
+    append_frame(companies_node_df, files['companies_node'], compression=compression)
+    append_frame(edges_df, files['edges'], compression=compression)
+    write_frame(edges_df, files['edges_delta'], compression=compression)
+    append_frame(post_companies_df, files['post_companies'], compression=compression, index=False)
+    append_frame(comment_authors_df, files['comment_authors'], compression=compression, index=False)
+    _write_state(network_input_dir, edges_df, state)
+    print(f'{len(edges_df)} edges, {len(authors_node_df)} authors and {len(companies_node_df)} companies added')
+    instrumentation.count('nodes', len(authors_node_df) + len(companies_node_df))
+    instrumentation.count('edges', len(edges_df))
 
 
 # instead of using companies, we can use posts instead
+
+
+if __name__ == "__main__":
+    base_dir = '/home/timothy/Projects/assignments/tia_text_analytics/data'
+    # set to add only the posts and comments munged into staging_delta to the existing network
+    incremental = False
+
+    # the duplicate_groups of near_duplicates, to collapse reposted comments, or None
+    groups_file = None
+
+    if incremental:
+        update_network(base_dir + '/staging_delta', base_dir + '/network_input', groups_file=groups_file)
+    else:
+        build_network(base_dir + '/staging', base_dir + '/network_input', groups_file=groups_file)
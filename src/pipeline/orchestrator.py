@@ -0,0 +1,284 @@
+import hashlib
+import inspect
+import json
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from src.analysis.network_analysis import CentralityBackend
+from src.pipeline.formats import OutputFormat, with_extension
+from src.pipeline.instrumentation import MetricsRecorder, run_measured
+
+
+class ContentHasher:
+    """ sha1 of the contents of a file, or of every file under a directory but for __pycache__ directories.
+        Digests are remembered by path and reused for as long as the size and modification time of the file match """
+
+    def __init__(self, known=None):
+        self.known = known if known is not None else {}
+
+    def digest(self, path):
+        if os.path.isdir(path):
+            digest = hashlib.sha1()
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(name for name in dirs if name != '__pycache__')
+                for file_name in sorted(files):
+                    file_path = os.path.join(root, file_name)
+                    digest.update(os.path.relpath(file_path, path).encode())
+                    digest.update(self.__file_digest(file_path).encode())
+            return digest.hexdigest()
+
+        if not os.path.exists(path):
+            return 'missing'
+        return self.__file_digest(path)
+
+    def __file_digest(self, path):
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        known = self.known.get(path)
+        if known is not None and known[:2] == key:
+            return known[2]
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(block)
+        self.known[path] = key + [digest.hexdigest()]
+        return digest.hexdigest()
+
+
+class Stage:
+    """ A step of the pipeline, calling function with params. inputs and outputs are the files and directories it
+        reads and writes, a stage that reads what another stage writes runs after it.
+        Stages without cache, like the crawl, run every time they are selected """
+
+    def __init__(self, name, function, inputs=(), outputs=(), params=None, cache=True):
+        self.name = name
+        self.function = function
+        self.inputs = [os.path.normpath(path) for path in inputs]
+        self.outputs = [os.path.normpath(path) for path in outputs]
+        self.params = params or {}
+        self.cache = cache
+
+    def reads_from(self, other):
+        return any(self._overlaps(path, output) for path in self.inputs for output in other.outputs)
+
+    def fingerprint(self, hasher):
+        """ Hash of the stage's code, params and input contents. The code is the whole package the function is in,
+            as the function calls into modules other than its own """
+        digest = hashlib.sha1()
+        digest.update(f'{self.function.__module__}.{self.function.__qualname__}'.encode())
+        digest.update(hasher.digest(self.code_path()).encode())
+        digest.update(json.dumps(self.params, sort_keys=True, default=str).encode())
+        for path in self.inputs:
+            digest.update(path.encode())
+            digest.update(hasher.digest(path).encode())
+        return digest.hexdigest()
+
+    def code_path(self):
+        """ The directory of the top level package of the function, or its source file outside of a package """
+        package = sys.modules[self.function.__module__.split('.')[0]]
+        if hasattr(package, '__path__'):
+            return list(package.__path__)[0]
+        return inspect.getsourcefile(self.function)
+
+    def outputs_exist(self):
+        return all(os.path.exists(path) for path in self.outputs)
+
+    @staticmethod
+    def _overlaps(path, other):
+        # a directory overlaps everything under it
+        return path == other or path.startswith(other + os.sep) or other.startswith(path + os.sep)
+
+
+class Pipeline:
+    """ Stages run as a DAG ordered by their inputs and outputs, with up to workers independent stages running in
+        parallel, each in a fresh process. With metrics_dir, the metrics of every run are written there as {run_id}.json """
+
+    def __init__(self, stages, cache_file, workers=2, metrics_dir=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_file = cache_file
+        self.workers = workers
+        self.metrics_dir = metrics_dir
+        self.dependencies = {stage.name: {other.name for other in stages if other is not stage and stage.reads_from(other)}
+                             for stage in stages}
+
+    def run(self, targets=None, force=False, profile=()):
+        """ Run the targets, all stages by default, and the stages they depend on.
+            A stage is skipped when its fingerprint matches its last successful run and its outputs exist.
+            Stages named in profile are run under cProfile, with their stats dumped next to the metrics """
+        recorder = MetricsRecorder()
+        cache = self.__load_cache()
+        hasher = ContentHasher(cache['files'])
+        selected = self.__upstream(targets or list(self.stages))
+        waiting = {name: self.dependencies[name] & selected for name in selected}
+        done = set()
+        running = {}
+
+        try:
+            while waiting or running:
+                ready = [name for name, dependencies in waiting.items() if dependencies <= done]
+                if not ready and not running:
+                    raise ValueError(f'Stages {sorted(waiting)} depend on each other')
+
+                for name in ready:
+                    if len(running) >= max(self.workers, 1):
+                        break
+                    del waiting[name]
+                    stage = self.stages[name]
+                    fingerprint = stage.fingerprint(hasher)
+
+                    if not force and stage.cache and cache['stages'].get(name) == fingerprint and stage.outputs_exist():
+                        print(f'{name}: inputs unchanged, skipped')
+                        recorder.add_stage(name, {'skipped': True})
+                        done.add(name)
+                        continue
+
+                    print(f'{name}: running')
+                    for path in stage.outputs:
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                    profile_file = self.__profile_file(recorder, name) if name in profile else None
+                    # every stage gets a process of its own, as a reused worker would report the peak rss of the
+                    # stages it ran before
+                    executor = ProcessPoolExecutor(max_workers=1)
+                    future = executor.submit(run_measured, name, stage.function, stage.params, profile_file)
+                    running[future] = (name, fingerprint, executor)
+
+                # skipped stages may have made others ready without anything to wait for
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, fingerprint, executor = running.pop(future)
+                    executor.shutdown()
+                    recorder.add_stage(name, future.result())
+                    print(f'{name}: done in {recorder.stages[name]["wall_time"]:.2f}s')
+                    done.add(name)
+                    cache['stages'][name] = fingerprint
+                    self.__save_cache(cache)
+        finally:
+            for _, _, executor in running.values():
+                executor.shutdown()
+
+        self.__save_cache(cache)
+        if self.metrics_dir is not None:
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            recorder.write(f'{self.metrics_dir}/{recorder.run_id}.json')
+        return recorder
+
+    def __profile_file(self, recorder, name):
+        if self.metrics_dir is None:
+            raise ValueError('Profiling a stage needs a metrics_dir to write the stats to')
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        return f'{self.metrics_dir}/{recorder.run_id}_{name}.prof'
+
+    def __upstream(self, targets):
+        selected = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.dependencies[name])
+        return selected
+
+    def __load_cache(self):
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                return json.load(f)
+        return {'files': {}, 'stages': {}}
+
+    def __save_cache(self, cache):
+        with open(self.cache_file, 'w') as f:
+            json.dump(cache, f)
+
+
+def tia_pipeline(data_dir, crawl_posts=False, workers=2, munge_workers=1, output_format=OutputFormat.CSV,
+                 backend=CentralityBackend.SPARSE, clusters=7, streaming=False, temporal=False, base_url=None,
+                 collapse_duplicates=False):
+    """ The crawl, munge, network and clustering stages over a data directory laid out like base_dir.
+        The crawl of posts and their comments is only included with crawl_posts, otherwise the raw files already on
+        disk are used. base_url is the posts endpoint of the API the crawl uses, TechInAsia by default.
+        With collapse_duplicates, the network and the clusters use the groups of near duplicate comments, as the
+        --collapse-duplicates option of the network-prep and cluster commands does.
+        temporal adds the centralities of monthly windows of the network """
+    # the stages are only imported when a pipeline is built, as they load most of the heavy dependencies
+    from src.analysis.network_analysis import analyse_network
+    from src.analysis.temporal_network import analyse_temporal_network
+    from src.analysis.text_cluster import cluster_comments
+    from src.pipeline.crawler import TiaCrawler, crawl
+    from src.pipeline.munger import munge_comments, munge_posts
+    from src.pipeline.near_duplicates import find_near_duplicates
+    from src.pipeline.network_prep import build_network
+
+    raw_dir = data_dir + '/raw'
+    staging_dir = data_dir + '/staging'
+    network_input_dir = data_dir + '/network_input'
+    network_output_dir = data_dir + '/network_output'
+
+    def staging(name):
+        return with_extension(f'{staging_dir}/{name}.csv', output_format)
+
+    def network_input(name):
+        return with_extension(f'{network_input_dir}/{name}.csv', output_format)
+
+    groups_file = staging('duplicate_groups') if collapse_duplicates else None
+    groups_inputs = [groups_file] if collapse_duplicates else []
+
+    stages = [
+        Stage('munge_posts', munge_posts,
+              inputs=[raw_dir + '/posts'],
+              outputs=[staging(name) for name in ['posts', 'posts_categories', 'posts_companies', 'posts_tags']],
+              params={'workers': munge_workers, 'output_format': output_format, 'data_dir': data_dir}),
+        Stage('munge_comments', munge_comments,
+              inputs=[raw_dir + '/comments'],
+              outputs=[staging('comments_dedup')],
+              params={'workers': munge_workers, 'output_format': output_format, 'data_dir': data_dir}),
+        Stage('near_duplicates', find_near_duplicates,
+              inputs=[staging('comments_dedup')],
+              outputs=[staging('duplicate_groups'), staging_dir + '/minhash_index.npz'],
+              params={'comments_file': staging('comments_dedup'), 'groups_file': staging('duplicate_groups'),
+                      'index_file': staging_dir + '/minhash_index.npz'}),
+        Stage('network_prep', build_network,
+              inputs=[staging(name) for name in ['posts', 'posts_companies', 'comments_dedup']] + groups_inputs,
+              outputs=[network_input(name) for name in ['authors_node', 'companies_node', 'edges']],
+              params={'staging_dir': staging_dir, 'network_input_dir': network_input_dir,
+                      'staging_format': output_format, 'output_format': output_format,
+                      'groups_file': groups_file}),
+        Stage('network_analysis', analyse_network,
+              inputs=[network_input(name) for name in ['authors_node', 'companies_node', 'edges']],
+              outputs=[with_extension(network_output_dir + '/centralities.csv', output_format)],
+              params={'network_input_dir': network_input_dir, 'network_output_dir': network_output_dir,
+                      'backend': backend, 'input_format': output_format, 'output_format': output_format}),
+        Stage('text_cluster', cluster_comments,
+              inputs=[staging('comments_dedup')] + groups_inputs,
+              outputs=[data_dir + '/analysis/clusters.csv'],
+              params={'comments_file': staging('comments_dedup'), 'clusters_file': data_dir + '/analysis/clusters.csv',
+                      'clusters': clusters, 'streaming': streaming, 'cache_dir': data_dir + '/analysis/tfidf_cache',
+                      'groups_file': groups_file})
+    ]
+
+    if temporal:
+        stages.append(Stage('temporal_analysis', analyse_temporal_network,
+                            inputs=[network_input('edges')],
+                            outputs=[with_extension(network_output_dir + '/centrality_windows.csv', output_format)],
+                            params={'network_input_dir': network_input_dir, 'network_output_dir': network_output_dir,
+                                    'input_format': output_format, 'output_format': output_format}))
+
+    if crawl_posts:
+        stages.append(Stage('crawl', crawl, outputs=[raw_dir + '/posts', raw_dir + '/comments'],
+                            params={'raw_dir': raw_dir, 'posts': True, 'base_url': base_url or TiaCrawler.BASE_URL},
+                            cache=False))
+
+    return Pipeline(stages, data_dir + '/pipeline_cache.json', workers=workers, metrics_dir=data_dir + '/metrics')
+
+
+if __name__ == "__main__":
+    base_dir = '/home/timothy/Projects/assignments/tia_text_analytics/data'
+    # stage names to run with the stages they depend on, all stages by default
+    targets = sys.argv[1:] or None
+    # stage names to run under cProfile
+    profile = []
+
+    tia_pipeline(base_dir).run(targets, profile=profile)
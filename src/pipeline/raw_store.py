@@ -0,0 +1,260 @@
+import gzip
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+from json.decoder import JSONDecodeError, scanstring
+from json.scanner import make_scanner
+from os import listdir
+from os.path import getmtime, isfile, join
+
+INDEX_FILE = 'index.jsonl'
+SEGMENT_PREFIX = 'segment_'
+SEGMENT_SUFFIX = '.jsonl.gz'
+
+# a crawled page, either a json file of its own (offset is None) or a gzip member at offset in a store segment
+PageRef = namedtuple('PageRef', ['name', 'path', 'offset', 'length'])
+
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+# json's own scanner, only used for the strings, numbers and constants between the brackets
+scan_value = make_scanner(json.JSONDecoder())
+
+
+class RawStore:
+    """ Crawled pages appended to gzip compressed jsonl segments, with an index of where each page is.
+        Every page is a gzip member of its own, so that it is durable as soon as it is written and can be read
+        without decompressing the rest of its segment. A page written again under the same name replaces the old one """
+
+    def __init__(self, directory, segment_size=2 ** 26, compresslevel=6):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compresslevel = compresslevel
+        self.lock = threading.Lock()
+        self.pages = read_index(directory)
+        self.segment = max((int(file[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) for file in listdir(directory)
+                            if is_store_file(file) and file != INDEX_FILE), default=0)
+        self.segment_file = None
+        self.__drop_partial_index_line()
+        self.index_file = open(join(directory, INDEX_FILE), 'a')
+
+    def write_page(self, name, page):
+        self.write_text(name, json.dumps(page))
+
+    def write_text(self, name, text):
+        """ Write a page already encoded as json """
+        data = gzip.compress((text.rstrip('\n') + '\n').encode(), compresslevel=self.compresslevel)
+
+        with self.lock:
+            if self.segment_file is None or self.segment_file.tell() >= self.segment_size:
+                self.__open_next_segment()
+
+            offset = self.segment_file.tell()
+            self.segment_file.write(data)
+            self.segment_file.flush()
+            self.index_file.write(json.dumps([name, self.segment, offset, len(data), time.time()]) + '\n')
+            self.index_file.flush()
+            self.pages[name] = PageRef(name, self.segment_file.name, offset, len(data))
+
+    def close(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.index_file.close()
+
+    def __drop_partial_index_line(self):
+        # a line cut short by a crash would otherwise run into the next one written
+        index_file = join(self.directory, INDEX_FILE)
+        if not isfile(index_file):
+            return
+
+        with open(index_file, 'r+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - 2 ** 16))
+            tail = f.read()
+            if tail and not tail.endswith(b'\n'):
+                f.truncate(size - len(tail) + tail.rfind(b'\n') + 1)
+
+    def __open_next_segment(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+        # a segment left over from an earlier run is appended to until it is full
+        if self.segment == 0 or os.path.getsize(segment_path(self.directory, self.segment)) >= self.segment_size:
+            self.segment += 1
+        self.segment_file = open(segment_path(self.directory, self.segment), 'ab')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def segment_path(directory, segment):
+    return join(directory, f'{SEGMENT_PREFIX}{segment:05d}{SEGMENT_SUFFIX}')
+
+
+def is_store_file(file_name):
+    return file_name == INDEX_FILE or (file_name.startswith(SEGMENT_PREFIX) and file_name.endswith(SEGMENT_SUFFIX))
+
+
+def read_index(directory, written_at=None):
+    """ The latest location of every page in the store in directory, by page name.
+        With written_at, the time each page was written is added to it, by page name """
+    pages = {}
+    index_file = join(directory, INDEX_FILE)
+    if not isfile(index_file):
+        return pages
+
+    with open(index_file) as f:
+        for line in f:
+            # a line cut short by a crash while it was being written is ignored
+            if not line.endswith('\n'):
+                break
+            name, segment, offset, length, *written = json.loads(line)
+            pages[name] = PageRef(name, segment_path(directory, segment), offset, length)
+            if written_at is not None:
+                # stores written before the time was indexed only have that of their segment
+                written_at[name] = written[0] if written else getmtime(pages[name].path)
+    return pages
+
+
+def list_pages(directory):
+    """ Every page in directory sorted by name, whether it is in a store or a json file of its own.
+        A page in both is read from wherever it was written last, like a file crawled again after it was packed """
+    written_at = {}
+    pages = read_index(directory, written_at)
+    for file in listdir(directory):
+        path = join(directory, file)
+        if not is_store_file(file) and isfile(path) and (file not in pages or getmtime(path) > written_at[file]):
+            pages[file] = PageRef(file, path, None, None)
+    return [pages[name] for name in sorted(pages)]
+
+
+def read_page_text(page: PageRef):
+    """ The json text of the page """
+    if page.offset is None:
+        with open(page.path) as f:
+            return f.read()
+
+    with open(page.path, 'rb') as f:
+        f.seek(page.offset)
+        return gzip.decompress(f.read(page.length)).decode()
+
+
+def load_page(page: PageRef):
+    return loads(read_page_text(page))
+
+
+def loads(text):
+    """ json.loads, falling back to a decoder without recursion for documents nested deeper than the recursion limit,
+        such as comment threads thousands of replies deep """
+    try:
+        return json.loads(text)
+    except RecursionError:
+        return _loads_iteratively(text)
+
+
+def _loads_iteratively(text):
+    """ Decode json with an explicit stack of the arrays and objects still being filled, with the key the next value
+        goes under for objects """
+    stack = []
+    index = WHITESPACE_RE.match(text, 0).end()
+
+    while True:
+        # the next value starts at index, containers are pushed until a value that is complete is reached
+        char = text[index:index + 1]
+        if char == '{':
+            index = WHITESPACE_RE.match(text, index + 1).end()
+            if text[index:index + 1] == '}':
+                value, index = {}, index + 1
+            else:
+                key, index = _object_key(text, index)
+                stack.append(({}, key))
+                continue
+        elif char == '[':
+            index = WHITESPACE_RE.match(text, index + 1).end()
+            if text[index:index + 1] == ']':
+                value, index = [], index + 1
+            else:
+                stack.append(([], None))
+                continue
+        else:
+            try:
+                value, index = scan_value(text, index)
+            except StopIteration as error:
+                raise JSONDecodeError('Expecting value', text, error.value) from None
+
+        # add the value to its container, and every container it completes to the one it is in
+        while True:
+            index = WHITESPACE_RE.match(text, index).end()
+            if not stack:
+                if index != len(text):
+                    raise JSONDecodeError('Extra data', text, index)
+                return value
+
+            container, key = stack[-1]
+            if key is None:
+                container.append(value)
+            else:
+                container[key] = value
+
+            char = text[index:index + 1]
+            if char == ',':
+                index = WHITESPACE_RE.match(text, index + 1).end()
+                if key is not None:
+                    key, index = _object_key(text, index)
+                    stack[-1] = (container, key)
+                break
+            if char != ('}' if key is not None else ']'):
+                raise JSONDecodeError("Expecting ',' delimiter", text, index)
+            stack.pop()
+            value, index = container, index + 1
+
+
+def _object_key(text, index):
+    """ The key starting at index and the position of the value after its colon """
+    if text[index:index + 1] != '"':
+        raise JSONDecodeError('Expecting property name enclosed in double quotes', text, index)
+    key, index = scanstring(text, index + 1)
+    index = WHITESPACE_RE.match(text, index).end()
+    if text[index:index + 1] != ':':
+        raise JSONDecodeError("Expecting ':' delimiter", text, index)
+    return key, WHITESPACE_RE.match(text, index + 1).end()
+
+
+def page_size(page: PageRef):
+    """ Bytes read from disk to load the page """
+    if page.offset is None:
+        return os.path.getsize(page.path)
+    return page.length
+
+
+def page_version(page: PageRef):
+    """ Changes whenever the page is rewritten, like a modification time """
+    if page.offset is None:
+        return getmtime(page.path)
+    return f'{os.path.basename(page.path)}:{page.offset}'
+
+
+def pack_directory(directory, remove=True, segment_size=2 ** 26):
+    """ Move the json page files of a raw directory into a store in the same directory """
+    files = [page for page in list_pages(directory) if page.offset is None]
+
+    with RawStore(directory, segment_size=segment_size) as store:
+        # the text is stored as it is, pages are not decoded only to be encoded again
+        for page in files:
+            store.write_text(page.name, read_page_text(page))
+
+    if remove:
+        for page in files:
+            os.remove(page.path)
+    print(f'{len(files)} pages have been packed into {directory}')
+
+
+if __name__ == "__main__":
+    # pack the page files already crawled into stores, e.g. raw/posts/ raw/comments/
+    for directory in sys.argv[1:]:
+        pack_directory(directory)
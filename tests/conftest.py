@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class StubApi:
+    """ Posts and comments shaped like the TechInAsia API, newest posts first, recording the time and path of every
+        request. Posts and their comment pages can be changed between crawls """
+
+    def __init__(self, posts=30, posts_per_page=10, comment_pages=3):
+        self.posts = [{'id': post_id, 'title': f'post {post_id}', 'comments_count': 2 * comment_pages}
+                      for post_id in range(posts, 0, -1)]
+        self.posts_per_page = posts_per_page
+        self.comment_pages = {post['id']: comment_pages for post in self.posts}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.base_url = None
+
+    def add_post(self, comment_pages=1):
+        post = {'id': self.posts[0]['id'] + 1, 'title': 'new post', 'comments_count': 2 * comment_pages}
+        self.posts.insert(0, post)
+        self.comment_pages[post['id']] = comment_pages
+        return post
+
+    def add_comment_page(self, post_id):
+        post = next(post for post in self.posts if post['id'] == post_id)
+        self.comment_pages[post_id] += 1
+        post['comments_count'] += 2
+
+    def response(self, path, page):
+        parts = path.strip('/').split('/')
+        if parts == ['posts']:
+            total_pages = (len(self.posts) + self.posts_per_page - 1) // self.posts_per_page
+            posts = self.posts[(page - 1) * self.posts_per_page:page * self.posts_per_page]
+            return {'total_pages': total_pages, 'posts': [dict(post) for post in posts]}
+
+        post_id = int(parts[1])
+        return {'total_pages': self.comment_pages[post_id], 'comments': [
+            {'id': post_id * 1000 + page * 10 + i, 'post': post_id, 'parent': 0, 'excerpt': f'comment {i}',
+             'author': {'id': i}, 'children': [], 'replies': []} for i in range(2)]}
+
+    def requested(self, path_prefix=''):
+        """ (path, page) of the requests for paths starting with path_prefix, in the order they arrived """
+        with self.lock:
+            return [(path, page) for _, path, page in self.requests if path.startswith(path_prefix)]
+
+
+@pytest.fixture
+def stub_api():
+    api = StubApi()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            page = int(urllib.parse.parse_qs(url.query)['page'][0])
+            with api.lock:
+                api.requests.append((time.monotonic(), url.path, page))
+                body = json.dumps(api.response(url.path, page)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    api.base_url = f'http://127.0.0.1:{server.server_port}/posts'
+    yield api
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,60 @@
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from benchmarks.graph_load import synthetic_edges
+from src.analysis import sparse_centrality
+from src.analysis.network_analysis import compute_centralities, load_graph
+
+
+def test_sparse_matches_networkx():
+    # parallel edges, and nodes that only appear as sources or only as targets
+    edges_df = synthetic_edges(3000, authors=400, companies=60)[['source', 'target']]
+    DG = load_graph(edges_df)
+
+    sparse_df = sparse_centrality.compute_centralities(edges_df, include_pagerank=True, tol=1e-10)
+    networkx_df = compute_centralities(DG)
+    assert list(sparse_df.columns[:4]) == list(networkx_df.columns)
+    assert sparse_df['label'].tolist() == networkx_df['label'].tolist()
+
+    for column in ['in_degree_centrality', 'out_degree_centrality']:
+        np.testing.assert_allclose(sparse_df[column], networkx_df[column])
+
+    labels = sparse_df['label'].tolist()
+    eigen = nx.eigenvector_centrality(DG, max_iter=1000, tol=1e-10)
+    np.testing.assert_allclose(sparse_df['eigenvector_centrality'], [eigen[label] for label in labels], atol=1e-08)
+    rank = nx.pagerank(DG, tol=1e-10)
+    np.testing.assert_allclose(sparse_df['pagerank'], [rank[label] for label in labels], atol=1e-08)
+
+
+def test_warm_start_and_added_edges():
+    edges_df = synthetic_edges(3000, authors=400, companies=60)[['source', 'target']]
+    old_df, new_df = edges_df.iloc[:2500], edges_df.iloc[2500:]
+    graph = sparse_centrality.SparseGraph.from_edges(old_df)
+    previous = sparse_centrality.eigenvector_centrality(graph, tol=1e-10)
+
+    graph, _ = graph.add_edges(new_df)
+    warm = sparse_centrality.eigenvector_centrality(graph, tol=1e-10, nstart=previous)
+    full_df = sparse_centrality.compute_centralities(edges_df, tol=1e-10)
+    warm_df = pd.DataFrame({'label': graph.labels, 'eigenvector_centrality': warm}).sort_values('label')
+    np.testing.assert_allclose(warm_df['eigenvector_centrality'], full_df['eigenvector_centrality'], atol=1e-08)
+
+
+def test_all_sources_give_exact_path_centralities():
+    # a directed graph with unreachable pairs, so that closeness needs the wf_improved scaling
+    edges_df = synthetic_edges(600, authors=80, companies=20)[['source', 'target']]
+    DG = load_graph(edges_df)
+    paths_df = sparse_centrality.path_centralities(edges_df, samples=DG.number_of_nodes())
+
+    labels = paths_df['label'].tolist()
+    betweenness = nx.betweenness_centrality(DG)
+    closeness = nx.closeness_centrality(DG)
+    np.testing.assert_allclose(paths_df['betweenness_centrality'], [betweenness[label] for label in labels],
+                               rtol=1e-12, atol=1e-15)
+    np.testing.assert_allclose(paths_df['closeness_centrality'], [closeness[label] for label in labels],
+                               rtol=1e-12, atol=1e-15)
+    assert (paths_df['betweenness_error'] == 0).all() and (paths_df['closeness_error'] == 0).all()
+
+    parallel_df = sparse_centrality.path_centralities(edges_df, samples=40, workers=3)
+    pd.testing.assert_frame_equal(parallel_df, sparse_centrality.path_centralities(edges_df, samples=40),
+                                  check_exact=True)
@@ -0,0 +1,132 @@
+import json
+import os
+
+from src.pipeline.crawler import TiaDataMunger, crawl
+
+
+def write_posts(api, raw_dir):
+    """ The posts pages of the api on disk, as crawl reads the post ids of a full crawl from them """
+    os.makedirs(raw_dir + '/posts')
+    os.makedirs(raw_dir + '/comments')
+    total_pages = api.response('/posts', 1)['total_pages']
+    for page in range(1, total_pages + 1):
+        with open(f'{raw_dir}/posts/{page}', 'w') as f:
+            json.dump(api.response('/posts', page), f)
+
+
+def test_crawl_rate_limit_and_page_order(stub_api, tmp_path):
+    raw_dir = str(tmp_path / 'raw')
+    write_posts(stub_api, raw_dir)
+    rate = 50
+
+    crawl(concurrency=8, requests_per_second=rate, raw_dir=raw_dir, base_url=stub_api.base_url)
+
+    # every comments page is requested once, the first page of every post before any later page
+    requested = stub_api.requested()
+    expected = {(f'/posts/{post_id}/comments', page) for post_id, pages in stub_api.comment_pages.items()
+                for page in range(1, pages + 1)}
+    assert len(requested) == len(expected) and set(requested) == expected
+    first_pages = [page == 1 for _, page in requested]
+    assert first_pages == sorted(first_pages, reverse=True)
+
+    for post_id, pages in stub_api.comment_pages.items():
+        for page in range(1, pages + 1):
+            with open(f'{raw_dir}/comments/{post_id}_{page}') as f:
+                assert json.load(f) == stub_api.response(f'/posts/{post_id}/comments', page)
+
+    # the bucket starts full with a second of requests, and refills at rate requests per second after
+    times = sorted(time for time, _, _ in stub_api.requests)
+    for first in range(len(times)):
+        for last in range(first, len(times)):
+            assert last - first + 1 <= rate + 1 + (times[last] - times[first]) * rate
+    assert times[-1] - times[0] >= (len(times) - rate - 1) / rate
+
+
+def post_pages(api):
+    return [page for path, page in api.requested() if path == '/posts']
+
+
+def crawled_post_ids(raw_dir):
+    return TiaDataMunger(raw_dir + '/posts/').get_all_post_ids()
+
+
+def test_delta_crawl_over_posts_on_disk(stub_api, tmp_path):
+    raw_dir = str(tmp_path / 'raw')
+    write_posts(stub_api, raw_dir)
+    # posts crawled before there was a manifest are not written again
+    crawl(delta=True, requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url)
+    assert post_pages(stub_api) == [1]
+    assert crawled_post_ids(raw_dir) == list(range(1, 31))
+
+    stub_api.add_post()
+    crawl(delta=True, requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url)
+    assert crawled_post_ids(raw_dir) == list(range(1, 32))
+
+
+def test_delta_crawl_rescan(stub_api, tmp_path):
+    raw_dir = str(tmp_path / 'raw')
+    write_posts(stub_api, raw_dir)
+    # without a full scan yet, the first delta crawl scans every page
+    crawl(delta=True, requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url, rescan_days=1)
+    assert post_pages(stub_api) == [1, 2, 3]
+    assert len(stub_api.requested('/posts/')) == 3 * 30
+
+    # a crash partway through appending a record
+    with open(raw_dir + '/crawl_manifest.jsonl', 'a') as f:
+        f.write('{"file": "delta_')
+
+    stub_api.add_post()
+    stub_api.add_comment_page(1)
+    stub_api.requests.clear()
+    crawl(delta=True, requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url, rescan_days=1)
+    # the delta stops at the first page of posts, so only the new post's comments are crawled
+    assert post_pages(stub_api) == [1]
+    assert stub_api.requested('/posts/') == [('/posts/31/comments', 1)]
+
+    stub_api.requests.clear()
+    crawl(delta=True, requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url, rescan_days=0)
+    assert post_pages(stub_api) == [1, 2, 3, 4]
+    assert set(stub_api.requested('/posts/')) == {('/posts/1/comments', page) for page in range(1, 5)}
+    assert crawled_post_ids(raw_dir) == list(range(1, 32))
+    with open(raw_dir + '/crawl_manifest.jsonl') as f:
+        assert all(json.loads(line) for line in f)
+
+
+def test_crawl_posts(stub_api, tmp_path):
+    raw_dir = str(tmp_path / 'raw')
+    crawl(requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url, posts=True)
+
+    assert sorted(post_pages(stub_api)) == [1, 2, 3]
+    for page in range(1, 4):
+        with open(f'{raw_dir}/posts/{page}') as f:
+            assert json.load(f) == stub_api.response('/posts', page)
+    assert len(stub_api.requested('/posts/')) == 3 * 30
+
+
+def test_crawl_posts_again(stub_api, tmp_path):
+    raw_dir = str(tmp_path / 'raw')
+    crawl(requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url, posts=True)
+
+    # a completed crawl is not resumed, every page of posts is crawled again
+    stub_api.add_post()
+    stub_api.add_comment_page(1)
+    stub_api.requests.clear()
+    crawl(requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url, posts=True)
+    assert sorted(post_pages(stub_api)) == [1, 2, 3, 4]
+    assert set(stub_api.requested('/posts/')) == ({('/posts/31/comments', 1)} |
+                                                  {('/posts/1/comments', page) for page in range(1, 5)})
+    assert crawled_post_ids(raw_dir) == list(range(1, 32))
+
+
+def test_resume_unfinished_crawl(stub_api, tmp_path):
+    raw_dir = str(tmp_path / 'raw')
+    crawl(requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url, posts=True)
+    # drop the completion of the run, as if the crawl had stopped after its last page
+    with open(raw_dir + '/crawl_manifest.jsonl') as f:
+        lines = f.readlines()
+    with open(raw_dir + '/crawl_manifest.jsonl', 'w') as f:
+        f.writelines(lines[:-1])
+
+    stub_api.requests.clear()
+    crawl(requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url, posts=True)
+    assert stub_api.requested() == []
@@ -0,0 +1,39 @@
+import pytest
+
+from src.pipeline.formats import ArrowRowWriter, OutputFormat, column_type
+
+pa = pytest.importorskip('pyarrow')
+
+
+def test_column_type():
+    assert column_type([]) == 'string'
+    assert column_type(['int']) == 'int64'
+    assert column_type(['float', 'int']) == 'float64'
+    assert column_type(['bool']) == 'bool_'
+    assert column_type(['int', 'str']) == 'string'
+    assert column_type(['dict']) == 'string'
+
+
+@pytest.mark.parametrize('output_format', [OutputFormat.PARQUET, OutputFormat.FEATHER])
+def test_types_change_between_row_groups(tmp_path, output_format):
+    file_name = str(tmp_path / ('rows' + output_format.extension))
+    header = ['id', 'likes', 'edited', 'tags']
+    types = [column_type(['int']), column_type(['int', 'str']), column_type(['bool']), column_type(['list'])]
+
+    with ArrowRowWriter(file_name, header, output_format, row_group_size=2, types=types) as writer:
+        # the first row group has no edited values, and only integer likes
+        writer.writerows([[1, 1, None, ['a']], [2, 2, None, []]])
+        writer.writerows([[3, 'x', True, None], [4, None, False, ['b', 'c']]])
+
+    if output_format == OutputFormat.PARQUET:
+        import pyarrow.parquet
+
+        table = pyarrow.parquet.read_table(file_name)
+    else:
+        import pyarrow.feather
+
+        table = pyarrow.feather.read_table(file_name)
+    assert table.schema.types == [pa.int64(), pa.string(), pa.bool_(), pa.string()]
+    assert table.column('likes').to_pylist() == ['1', '2', 'x', None]
+    assert table.column('edited').to_pylist() == [None, None, True, False]
+    assert table.column('tags').to_pylist() == ["['a']", '[]', None, "['b', 'c']"]
@@ -0,0 +1,101 @@
+import os
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.analysis.network_analysis import CentralityBackend, analyse_network
+from src.pipeline.formats import OutputFormat
+from src.pipeline.network_prep import build_network, update_network
+
+CENTRALITIES = ['in_degree_centrality', 'out_degree_centrality', 'eigenvector_centrality']
+
+
+def write_staging(staging_dir, posts, comments, first_post=1, first_comment=1, seed=0):
+    """ Staging files of posts with a company each and comments on them, replying to earlier comments at random """
+    rng = random.Random(seed)
+    os.makedirs(staging_dir, exist_ok=True)
+    post_ids = list(range(first_post, first_post + posts))
+    pd.DataFrame({
+        'id': post_ids, 'comments_count': 0, 'date_gmt': '2015-01-01T00:00:00', 'is_sponsored': False,
+        'title': [f'post {i}' for i in post_ids], 'read_time': 1, 'type': 'post',
+        'author_id': [rng.randrange(10) for _ in post_ids], 'author_display_name': 'author', 'author_roles': 'x'
+    }).to_csv(staging_dir + '/posts.csv', index=False)
+    pd.DataFrame({
+        'id': [i % 7 for i in post_ids], 'name': [f'company {i % 7}' for i in post_ids], 'post_id': post_ids,
+        'date_founded': '2010'
+    }).to_csv(staging_dir + '/posts_companies.csv', index=False)
+    comment_ids = list(range(first_comment, first_comment + comments))
+    pd.DataFrame({
+        'id': comment_ids, 'date_gmt': '2015-02-01T00:00:00', 'post': [rng.choice(post_ids) for _ in comment_ids],
+        'excerpt': 'text', 'parent': [rng.choice([0, rng.randrange(1, i + 1)]) for i in comment_ids],
+        'author_id': [10 + rng.randrange(30) for _ in comment_ids], 'author_display_name': 'author',
+        'author_roles': 'x'
+    }).to_csv(staging_dir + '/comments_dedup.csv', index=False)
+
+
+def centralities(network_dir, incremental):
+    analyse_network(network_dir + '/network_input', network_dir + '/network_output', incremental=incremental,
+                    backend=CentralityBackend.SPARSE, input_format=network_format(network_dir))
+    df = pd.read_csv(network_dir + '/network_output/centralities.csv', index_col=0)
+    return df.set_index('label').sort_index()[CENTRALITIES]
+
+
+def network_format(network_dir):
+    return OutputFormat.PARQUET if network_dir.endswith('parquet') else OutputFormat.CSV
+
+
+@pytest.fixture(params=[OutputFormat.CSV, OutputFormat.PARQUET])
+def network_dir(tmp_path, request):
+    if request.param != OutputFormat.CSV:
+        pytest.importorskip('pyarrow')
+    network_dir = str(tmp_path / request.param.value)
+    os.makedirs(network_dir + '/network_input')
+    os.makedirs(network_dir + '/network_output')
+    write_staging(network_dir + '/staging', 20, 100)
+    build_network(network_dir + '/staging', network_dir + '/network_input', output_format=request.param)
+    return network_dir
+
+
+def update(network_dir, update_number):
+    staging_dir = f'{network_dir}/staging_delta_{update_number}'
+    write_staging(staging_dir, 5, 30, first_post=100 * update_number, first_comment=1000 * update_number,
+                  seed=update_number)
+    update_network(staging_dir, network_dir + '/network_input', output_format=network_format(network_dir))
+
+
+def assert_matches_full(network_dir):
+    incremental_df = centralities(network_dir, incremental=True)
+    full_df = centralities(network_dir, incremental=False)
+    assert incremental_df.index.equals(full_df.index)
+    np.testing.assert_allclose(incremental_df.iloc[:, :2].to_numpy(), full_df.iloc[:, :2].to_numpy())
+    # the warm started eigenvector centrality converges to the same tolerance from a different start
+    np.testing.assert_allclose(incremental_df.iloc[:, 2].to_numpy(), full_df.iloc[:, 2].to_numpy(), atol=1e-04)
+
+
+def test_two_updates_between_analyses(network_dir):
+    centralities(network_dir, incremental=True)
+    update(network_dir, 1)
+    update(network_dir, 2)
+    assert_matches_full(network_dir)
+
+    # and a single update, read from edges_delta
+    update(network_dir, 3)
+    assert_matches_full(network_dir)
+
+
+def test_analysis_without_update(network_dir):
+    centralities(network_dir, incremental=True)
+    update(network_dir, 1)
+    assert_matches_full(network_dir)
+    assert_matches_full(network_dir)
+
+
+def test_rebuilt_network(network_dir):
+    centralities(network_dir, incremental=True)
+    update(network_dir, 1)
+    write_staging(network_dir + '/staging', 10, 50, seed=5)
+    build_network(network_dir + '/staging', network_dir + '/network_input', output_format=network_format(network_dir))
+    assert not any(file.startswith('edges_delta') for file in os.listdir(network_dir + '/network_input'))
+    assert_matches_full(network_dir)
@@ -0,0 +1,156 @@
+import csv
+import json
+import os
+
+import pytest
+
+from benchmarks.corpus import CorpusGenerator
+from src.pipeline.formats import OutputFormat
+from src.pipeline.munger import CommentsJsonToCsv, IdBitmap, munge_comments, munge_posts
+from src.pipeline.raw_store import pack_directory
+
+
+def deep_thread_page(depth):
+    """ json text of a comments page holding one thread of depth replies, each the only child of the one before.
+        Built as text, as json.dumps cannot encode a thread this deep either """
+    comment = '{{"id": {id}, "post": 1, "excerpt": "comment {id}", "author": {{"id": 1}}, "replies": [], "children": ['
+    return ('{"total_pages": 1, "comments": [' + ''.join(comment.format(id=i + 1) for i in range(depth + 1)) +
+            ']}' * (depth + 1) + ']}')
+
+
+def munged_comments(data_dir):
+    os.makedirs(data_dir + '/staging', exist_ok=True)
+    munge_comments(data_dir=data_dir)
+    with open(data_dir + '/staging/comments_dedup.csv') as f:
+        return list(csv.DictReader(f))
+
+
+def test_deep_thread_on_disk(tmp_path):
+    depth = 5000
+    data_dir = str(tmp_path)
+    os.makedirs(data_dir + '/raw/comments')
+    with open(data_dir + '/raw/comments/1_1', 'w') as f:
+        f.write(deep_thread_page(depth))
+
+    rows = munged_comments(data_dir)
+    assert len(rows) == depth + 1
+    assert [int(row['id']) for row in rows] == list(range(1, depth + 2))
+    assert rows[-1]['depth'] == str(depth) and rows[-1]['root_id'] == '1'
+
+    # the same page packed into a raw store
+    pack_directory(data_dir + '/raw/comments')
+    assert munged_comments(data_dir) == rows
+
+
+def test_parquet_column_types_from_every_comment(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+
+    data_dir = str(tmp_path)
+    os.makedirs(data_dir + '/raw/comments')
+    os.makedirs(data_dir + '/staging')
+    child = {'id': 2, 'likes': 'many', 'edited': True, 'author': {'id': 'b'}, 'children': [], 'replies': []}
+    page = {'total_pages': 1, 'comments': [
+        {'id': 1, 'likes': 3, 'edited': None, 'author': {'id': 7}, 'children': [child], 'replies': []}
+    ]}
+    with open(data_dir + '/raw/comments/1_1', 'w') as f:
+        json.dump(page, f)
+
+    munge_comments(output_format=OutputFormat.PARQUET, data_dir=data_dir)
+    table = pyarrow.parquet.read_table(data_dir + '/staging/comments_dedup.parquet')
+    types = dict(zip(table.schema.names, table.schema.types))
+    assert types['id'] == pa.int64() and types['depth'] == pa.int64() and types['root_id'] == pa.int64()
+    assert types['likes'] == pa.string() and types['edited'] == pa.bool_() and types['author_id'] == pa.string()
+    assert table.column('likes').to_pylist() == ['3', 'many']
+
+
+def test_workers_match_serial(tmp_path):
+    data_dir = str(tmp_path)
+    CorpusGenerator(1500).write(data_dir + '/raw')
+    os.makedirs(data_dir + '/staging')
+    files = ['comments_dedup.csv', 'posts.csv', 'posts_categories.csv', 'posts_companies.csv', 'posts_tags.csv']
+
+    outputs = []
+    for workers in [1, 3]:
+        munge_posts(workers=workers, data_dir=data_dir)
+        munge_comments(workers=workers, data_dir=data_dir)
+        outputs.append([(tmp_path / 'staging' / file).read_bytes() for file in files])
+    assert outputs[0] == outputs[1]
+    assert all(output.count(b'\n') > 1 for output in outputs[0])
+
+
+def test_dedup_matches_csv_pass(tmp_path):
+    data_dir = str(tmp_path)
+    os.makedirs(data_dir + '/raw/comments')
+    # a comment reached through both children and replies, comments without an id, and a negative id that would
+    # have marked id 7 as seen in the last byte of the bitmap
+    shared = {'id': 3, 'excerpt': 'shared', 'author': {'id': 1}, 'children': [], 'replies': []}
+    no_id = {'excerpt': 'no id', 'author': {'id': 2}}
+    negative = {'id': -1, 'excerpt': 'negative', 'author': {'id': 1}, 'children': [], 'replies': []}
+    seventh = {'id': 7, 'excerpt': 'seventh', 'author': {'id': 1}, 'children': [], 'replies': []}
+    pages = [
+        [{'id': 1, 'excerpt': 'top', 'author': {'id': 1}, 'children': [shared, no_id], 'replies': [shared]}],
+        [{'id': 2, 'excerpt': 'other', 'author': {'id': 2}, 'children': [negative, no_id], 'replies': []}, seventh, shared],
+    ]
+    for page, comments in enumerate(pages, start=1):
+        with open(f'{data_dir}/raw/comments/1_{page}', 'w') as f:
+            json.dump({'total_pages': len(pages), 'comments': comments}, f)
+
+    rows = munged_comments(data_dir)
+    assert [row['id'] for row in rows] == ['1', '3', '', '2', '-1', '7']
+
+    # the rows the csv pass over every flattened comment used to keep, by the first value of each row
+    comment_munger = CommentsJsonToCsv(data_dir + '/raw/comments', data_dir + '/staging/comments.csv',
+                                       exclude=['children', 'replies', 'author'])
+    comment_munger.write_data_to_csv()
+    with open(data_dir + '/staging/comments.csv') as f:
+        identifiers, expected = set(), []
+        for row in csv.reader(f):
+            if row[0] not in identifiers:
+                expected.append(row)
+                identifiers.add(row[0])
+    with open(data_dir + '/staging/comments_dedup.csv') as f:
+        assert list(csv.reader(f)) == expected
+
+
+def test_id_bitmap_rejects_ids_without_a_bit():
+    ids = IdBitmap()
+    assert ids.add(7) and not ids.add(7)
+    for id in [None, -1, '7']:
+        with pytest.raises(ValueError):
+            ids.add(id)
+
+
+def write_comments_page(data_dir, name, comments, mtime=None):
+    file_name = f'{data_dir}/raw/comments/{name}'
+    with open(file_name, 'w') as f:
+        json.dump({'total_pages': 1, 'comments': [dict(comment, children=[], replies=[]) for comment in comments]}, f)
+    if mtime is not None:
+        os.utime(file_name, (mtime, mtime))
+
+
+def test_schema_cache(tmp_path, monkeypatch):
+    data_dir = str(tmp_path)
+    os.makedirs(data_dir + '/raw/comments')
+    write_comments_page(data_dir, '1_1', [{'id': 1, 'excerpt': 'one', 'author': {'id': 1}}], mtime=1000)
+    assert list(munged_comments(data_dir)[0]) == ['id', 'excerpt', 'author_id', 'depth', 'root_id']
+    schema_file = data_dir + '/raw/comments_schema.json'
+    assert os.path.isfile(schema_file)
+
+    def discover_schema(self):
+        raise AssertionError('the cached schema was not used')
+
+    # nothing changed, the schema is read from the cache
+    with monkeypatch.context() as patch:
+        patch.setattr(CommentsJsonToCsv, '_discover_schema', discover_schema)
+        assert list(munged_comments(data_dir)[0]) == ['id', 'excerpt', 'author_id', 'depth', 'root_id']
+
+    # a page rewritten with a new key, its modification time changed
+    write_comments_page(data_dir, '1_1', [{'id': 1, 'excerpt': 'one', 'likes': 2, 'author': {'id': 1}}], mtime=2000)
+    assert list(munged_comments(data_dir)[0]) == ['id', 'excerpt', 'likes', 'author_id', 'depth', 'root_id']
+
+    # a page added with a new author key
+    write_comments_page(data_dir, '1_2', [{'id': 2, 'excerpt': 'two', 'author': {'id': 2, 'name': 'b'}}])
+    rows = munged_comments(data_dir)
+    assert list(rows[0]) == ['id', 'excerpt', 'likes', 'author_id', 'author_name', 'depth', 'root_id']
+    assert rows[1]['author_name'] == 'b'
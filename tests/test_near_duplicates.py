@@ -0,0 +1,57 @@
+import os
+
+import pandas as pd
+
+from src.pipeline.near_duplicates import find_near_duplicates
+
+TEXTS = ['the quick brown fox jumps over the lazy dog near the river bank',
+         'buy cheap watches online today with free shipping to your door',
+         'a completely different comment about hiring engineers in singapore',
+         'startups in jakarta are raising larger seed rounds than last year']
+
+
+def write_comments(comments_file, excerpts):
+    pd.DataFrame({'id': list(excerpts), 'excerpt': list(excerpts.values())}).to_csv(comments_file, index=False)
+
+
+def partition(groups_df):
+    """ The groups as sets of ids, regardless of which id names each group """
+    return sorted(sorted(ids) for ids in groups_df.groupby('duplicate_group')['id'].apply(list))
+
+
+def run(tmp_path, excerpts, threshold=0.8, index_name='minhash_index.npz'):
+    comments_file = str(tmp_path / 'comments.csv')
+    write_comments(comments_file, excerpts)
+    return find_near_duplicates(comments_file, str(tmp_path / 'groups.csv'), str(tmp_path / index_name),
+                                threshold=threshold)
+
+
+def fresh_run(tmp_path, excerpts, threshold=0.8):
+    index_file = tmp_path / 'fresh_index.npz'
+    if index_file.exists():
+        os.remove(index_file)
+    return run(tmp_path, excerpts, threshold, index_name='fresh_index.npz')
+
+
+def test_groups(tmp_path):
+    excerpts = {1: TEXTS[0], 2: TEXTS[1], 3: TEXTS[0].upper(), 4: TEXTS[2], 5: TEXTS[1] + '!'}
+    groups_df = run(tmp_path, excerpts)
+    assert groups_df['duplicate_group'].tolist() == [1, 2, 1, 4, 2]
+
+
+def test_edited_and_deleted_comments(tmp_path):
+    run(tmp_path, {1: TEXTS[0], 2: TEXTS[1], 3: TEXTS[0].upper(), 4: TEXTS[2], 5: TEXTS[1] + '!'})
+
+    # the root of a group is deleted, and a near duplicate is edited into a text of its own
+    excerpts = {2: TEXTS[1], 3: TEXTS[0].upper(), 4: TEXTS[2], 5: TEXTS[3], 6: TEXTS[0] + '.'}
+    groups_df = run(tmp_path, excerpts)
+    assert partition(groups_df) == partition(fresh_run(tmp_path, excerpts)) == [[2], [3, 6], [4], [5]]
+    assert groups_df.set_index('id')['duplicate_group'][6] == 3
+
+
+def test_changed_threshold(tmp_path):
+    # a Jaccard similarity of about 0.9
+    excerpts = {1: TEXTS[0], 2: TEXTS[0] + ' today', 3: TEXTS[2]}
+    assert partition(run(tmp_path, excerpts, threshold=0.99)) == [[1], [2], [3]]
+    assert partition(run(tmp_path, excerpts, threshold=0.8)) == partition(fresh_run(tmp_path, excerpts, 0.8))
+    assert partition(run(tmp_path, excerpts, threshold=0.8)) == [[1, 2], [3]]
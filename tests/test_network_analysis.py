@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+
+from src.analysis.network_analysis import load_graph
+
+
+def test_weighted_parallel_edges_keep_the_last_edge():
+    edges_df = pd.DataFrame({
+        'source': ['a', 'b', 'a', 'c', 'a', 'b'],
+        'target': ['x', 'x', 'x', 'a', 'x', 'x'],
+        'edge_type': ['post', 'comment', 'comment', 'reply', None, 'post'],
+        'label': ['first', 'b', None, 'c', 'last', None],
+    })
+    DG = load_graph(edges_df, edge_attributes=['edge_type', 'label'], weighted=True)
+
+    # the nodes and edges in the order they first appear, as without weights
+    assert list(DG.nodes) == ['a', 'x', 'b', 'c']
+    assert list(DG.edges) == [('a', 'x'), ('b', 'x'), ('c', 'a')]
+    a_x = DG.edges['a', 'x']
+    assert a_x['weight'] == 3 and a_x['label'] == 'last' and (a_x['edge_type'] is None or np.isnan(a_x['edge_type']))
+    assert DG.edges['b', 'x']['weight'] == 2 and DG.edges['b', 'x']['edge_type'] == 'post'
+    assert DG.edges['c', 'a'] == {'edge_type': 'reply', 'label': 'c', 'weight': 1}
+
+    unweighted = load_graph(edges_df, edge_attributes=['edge_type', 'label'])
+    assert list(unweighted.nodes) == list(DG.nodes) and list(unweighted.edges) == list(DG.edges)
+    assert {(u, v): w for u, v, w in load_graph(edges_df, weighted=True).edges(data='weight')} == \
+        {('a', 'x'): 3, ('b', 'x'): 2, ('c', 'a'): 1}
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.pipeline.network_prep import join_positions
+
+
+def merged_positions(left_keys, right_keys, left_mask=None, right_mask=None):
+    """ What join_positions should return, from pd.merge of the unfiltered columns """
+    left = pd.DataFrame({'key': left_keys, 'left_idx': np.arange(len(left_keys))})
+    right = pd.DataFrame({'key': right_keys, 'right_idx': np.arange(len(right_keys))})
+    merged = pd.merge(left, right, on='key')
+    merged['position'] = np.arange(len(merged))
+    if left_mask is not None:
+        merged = merged[np.asarray(left_mask)[merged['left_idx']]]
+    if right_mask is not None:
+        merged = merged[np.asarray(right_mask)[merged['right_idx']]]
+    return merged['left_idx'].to_numpy(), merged['right_idx'].to_numpy(), merged['position'].to_numpy()
+
+
+def random_keys(rng, count, kind):
+    keys = rng.integers(0, 40, count)
+    if kind == 'int':
+        return pd.Series(keys)
+    if kind == 'float':
+        return pd.Series(np.where(rng.random(count) < 0.1, np.nan, keys.astype(float)))
+    return pd.Series([None if k < 4 else f'u{k}' for k in keys], dtype=object)
+
+
+@pytest.mark.parametrize('kind', ['int', 'float', 'str'])
+@pytest.mark.parametrize('masked', [None, 'left', 'right', 'both'])
+def test_matches_merge(kind, masked):
+    rng = np.random.default_rng(0)
+    left_keys, right_keys = random_keys(rng, 300, kind), random_keys(rng, 200, kind)
+    left_mask = rng.random(300) < 0.7 if masked in ('left', 'both') else None
+    right_mask = rng.random(200) < 0.5 if masked in ('right', 'both') else None
+
+    expected = merged_positions(left_keys, right_keys, left_mask, right_mask)
+    for got, want in zip(join_positions(left_keys, right_keys, left_mask, right_mask), expected):
+        np.testing.assert_array_equal(got, want)
+
+
+def test_no_matches():
+    left_idx, right_idx, positions = join_positions(pd.Series([1, 2]), pd.Series([3, 4, 5]))
+    assert len(left_idx) == len(right_idx) == len(positions) == 0
@@ -0,0 +1,65 @@
+import importlib
+
+import pytest
+
+from src.pipeline.crawler import TiaDataMunger
+from src.pipeline.orchestrator import ContentHasher, Pipeline, Stage, tia_pipeline
+
+
+def allocate(output_file, megabytes):
+    block = bytearray(megabytes * 2 ** 20)
+    with open(output_file, 'w') as f:
+        f.write(str(len(block)))
+
+
+def test_stages_report_their_own_peak_rss(tmp_path):
+    large, small = str(tmp_path / 'large'), str(tmp_path / 'small')
+    pipeline = Pipeline([Stage('large', allocate, outputs=[large], params={'output_file': large, 'megabytes': 300}),
+                         Stage('small', allocate, inputs=[large], outputs=[small],
+                               params={'output_file': small, 'megabytes': 1})],
+                        str(tmp_path / 'cache.json'), workers=1)
+
+    stages = pipeline.run().stages
+    assert stages['large']['peak_rss_mb'] > 300
+    assert stages['small']['peak_rss_mb'] < stages['large']['peak_rss_mb'] - 250
+
+
+def test_fingerprint_covers_the_package(tmp_path, monkeypatch):
+    package = tmp_path / 'stage_package'
+    (package / '__pycache__').mkdir(parents=True)
+    (package / '__init__.py').write_text('')
+    (package / 'stage.py').write_text('from stage_package.helpers import helper\n\n\ndef run():\n    helper()\n')
+    (package / 'helpers.py').write_text('def helper():\n    pass\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    stage = Stage('stage', importlib.import_module('stage_package.stage').run)
+    fingerprint = stage.fingerprint(ContentHasher())
+
+    (package / '__pycache__' / 'helpers.cpython.pyc').write_bytes(b'compiled')
+    assert stage.fingerprint(ContentHasher()) == fingerprint
+
+    (package / 'helpers.py').write_text('def helper():\n    return 1\n')
+    assert stage.fingerprint(ContentHasher()) != fingerprint
+
+
+def test_crawl_stage_crawls_new_posts(stub_api, tmp_path):
+    data_dir = str(tmp_path)
+    pipeline = tia_pipeline(data_dir, crawl_posts=True, workers=1, base_url=stub_api.base_url)
+    pipeline.run(['crawl'])
+    assert len(TiaDataMunger(data_dir + '/raw/posts/').get_all_post_ids()) == 30
+
+    post = stub_api.add_post()
+    stub_api.requests.clear()
+    pipeline.run(['crawl'])
+    assert TiaDataMunger(data_dir + '/raw/posts/').get_all_post_ids() == list(range(1, 32))
+    assert stub_api.requested(f'/posts/{post["id"]}/') == [(f'/posts/{post["id"]}/comments', 1)]
+
+
+@pytest.mark.parametrize('collapse_duplicates', [False, True])
+def test_collapse_duplicates_is_opt_in(tmp_path, collapse_duplicates):
+    data_dir = str(tmp_path)
+    pipeline = tia_pipeline(data_dir, collapse_duplicates=collapse_duplicates)
+    groups_file = data_dir + '/staging/duplicate_groups.csv' if collapse_duplicates else None
+
+    for name in ['network_prep', 'text_cluster']:
+        assert pipeline.stages[name].params['groups_file'] == groups_file
+        assert ('near_duplicates' in pipeline.dependencies[name]) == collapse_duplicates
@@ -0,0 +1,39 @@
+import json
+import os
+
+from src.pipeline.crawler import crawl
+from src.pipeline.raw_store import RawStore, list_pages, load_page, pack_directory
+
+
+def pages_by_name(directory):
+    return {page.name: load_page(page) for page in list_pages(directory)}
+
+
+def test_loose_file_written_after_packing(tmp_path):
+    directory = str(tmp_path)
+    with open(f'{directory}/7_1', 'w') as f:
+        json.dump({'version': 1}, f)
+    pack_directory(directory)
+    assert not os.path.exists(f'{directory}/7_1')
+
+    with open(f'{directory}/7_1', 'w') as f:
+        json.dump({'version': 2}, f)
+    assert pages_by_name(directory) == {'7_1': {'version': 2}}
+
+    # and the store wins again once the page is written to it after the file
+    with RawStore(directory) as store:
+        store.write_page('7_1', {'version': 3})
+    assert pages_by_name(directory) == {'7_1': {'version': 3}}
+
+
+def test_crawl_after_pack(stub_api, tmp_path):
+    raw_dir = str(tmp_path / 'raw')
+    crawl(requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url, posts=True)
+    pack_directory(raw_dir + '/comments')
+
+    stub_api.add_comment_page(1)
+    crawl(requests_per_second=1000, raw_dir=raw_dir, base_url=stub_api.base_url, posts=True)
+    pages = pages_by_name(raw_dir + '/comments')
+    assert [pages[f'1_{page}'] for page in range(1, 5)] == [stub_api.response('/posts/1/comments', page)
+                                                           for page in range(1, 5)]
+    assert pages['2_1'] == stub_api.response('/posts/2/comments', 1)
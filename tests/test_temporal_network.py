@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.analysis.sparse_centrality import compute_centralities
+from src.analysis.temporal_network import CENTRALITIES, window_bounds, windowed_centralities
+
+TOL = 1e-10
+
+
+@pytest.fixture(scope='module')
+def edges_df():
+    rng = np.random.default_rng(0)
+    count = 1500
+    dates = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 182 * 24, count), unit='h')
+    # nothing dated in april, so that it is an empty window
+    dates = dates[dates.month != 4]
+    edges_df = pd.DataFrame({'source': rng.integers(0, 40, len(dates)), 'target': rng.integers(0, 60, len(dates)),
+                             'date_gmt': dates.strftime('%Y-%m-%dT%H:%M:%S')})
+    # undated edges are left out of every window
+    return pd.concat([edges_df, pd.DataFrame({'source': [1], 'target': [2], 'date_gmt': [None]})], ignore_index=True)
+
+
+def expected_windows(edges_df, window, step):
+    """ The centralities of every window computed from scratch on the edges dated within it """
+    dates = pd.to_datetime(edges_df['date_gmt'], format='ISO8601')
+    starts, ends = window_bounds(dates.dropna(), window=window, step=step)
+    frames = []
+    for start, end in zip(starts, ends):
+        window_df = edges_df[(dates >= start) & (dates < end)]
+        if len(window_df):
+            frame = compute_centralities(window_df, include_pagerank=True, tol=TOL)
+            frames.append(frame.melt(id_vars='label', var_name='centrality').assign(window_start=start, window_end=end))
+    return pd.concat(frames, ignore_index=True), starts
+
+
+def compare(windows_df, expected_df):
+    key = ['window_start', 'window_end', 'label', 'centrality']
+    windows_df = windows_df.astype({'label': str, 'centrality': str}).sort_values(key, ignore_index=True)
+    expected_df = expected_df.sort_values(key, ignore_index=True)
+    pd.testing.assert_frame_equal(windows_df[key], expected_df[key], check_dtype=False)
+    np.testing.assert_allclose(windows_df['value'], expected_df['value'], atol=1e-08)
+
+
+@pytest.mark.parametrize('window, step', [(1, 1), (3, 1), (2, 2), (3, 2)])
+@pytest.mark.parametrize('workers', [1, 3])
+def test_windows_match_centralities_of_their_edges(edges_df, window, step, workers):
+    windows_df = windowed_centralities(edges_df, window=window, step=step, workers=workers, include_pagerank=True,
+                                       tol=TOL)
+    expected_df, starts = expected_windows(edges_df, window, step)
+    compare(windows_df, expected_df)
+    assert set(windows_df['centrality']) == set(CENTRALITIES)
+
+    if window == 1:
+        # the empty april window has no rows, and the windows after it are still there
+        assert pd.Timestamp('2020-04-01') in starts
+        assert pd.Timestamp('2020-04-01') not in set(windows_df['window_start'])
+        assert pd.Timestamp('2020-05-01') in set(windows_df['window_start'])
+
+
+def test_no_dated_edges():
+    edges_df = pd.DataFrame({'source': [1, 2], 'target': [2, 3], 'date_gmt': [None, 'not a date']})
+    assert windowed_centralities(edges_df).empty
@@ -0,0 +1,247 @@
+import os
+import pickle
+import random
+import string
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+from nltk import word_tokenize
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from src.analysis import text_cluster
+from src.analysis.text_cluster import TFIDF_PARAMETERS, TextPreprocessor, tokenize_texts, vectorize_texts
+
+# the nltk stopwords corpus is not needed to check that tokens are filtered the same way
+STOP_WORDS = ('the', 'and', 'is', 'if', 'after', 'were', 'while')
+
+TEXTS = [
+    "I cannot believe it's gonna rain, we gotta go. Gimme the keys; lemme drive!",
+    "You wanna know? I wanna... CANNOT say, gotta run",
+    "wannabe cannotation gonnae lemmesee: no contraction splits inside words",
+    "Prices rose 12.5% in 2023 -- (or so) they said \"today\" & 'tomorrow'",
+    "  tabs\tand\nnewlines   between\r\nwords wanna\n",
+    "",
+]
+
+
+def reference_tokens(preprocessor, text):
+    # the punctuation-stripped text has no sentence boundaries for punkt to find, so tokenizing it as one line is
+    # what word_tokenize does, without needing the punkt data
+    tokens = word_tokenize(text.translate(str.maketrans('', '', string.punctuation)), preserve_line=True)
+    return [preprocessor.stemmer.stem(t) for t in tokens] if preprocessor.stem else tokens
+
+
+@pytest.mark.parametrize('stem', [True, False])
+@pytest.mark.parametrize('text', TEXTS)
+def test_regex_matches_word_tokenize(text, stem):
+    preprocessor = TextPreprocessor(stem=stem, tokenizer=TextPreprocessor.Tokenizer.REGEX)
+    assert preprocessor(text) == reference_tokens(preprocessor, text)
+
+
+def corpus(count, seed=0):
+    words = ("the market rallied after rates were cut while traders cannot agree if growth is gonna last and "
+             "companies keep hiring engineers wanna buy homes").split()
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(0, 25))) + rng.choice(['.', '!', '']) for _ in
+            range(count)]
+
+
+def test_parallel_tokenization_matches_serial():
+    texts = corpus(500)
+    preprocessor = TextPreprocessor(tokenizer=TextPreprocessor.Tokenizer.REGEX)
+    serial = tokenize_texts(texts, preprocessor, STOP_WORDS, workers=1, chunk_size=64)
+    assert tokenize_texts(texts, preprocessor, STOP_WORDS, workers=2, chunk_size=64) == serial
+    assert len(serial) == len(texts)
+
+
+def test_vectorize_matches_tfidf_vectorizer():
+    texts = corpus(2500)
+    preprocessor = TextPreprocessor(tokenizer=TextPreprocessor.Tokenizer.REGEX)
+    vectorizer, matrix = vectorize_texts(texts, preprocessor, workers=1, stop_words=STOP_WORDS)
+    parallel_vectorizer, parallel_matrix = vectorize_texts(texts, preprocessor, workers=2, stop_words=STOP_WORDS)
+    assert parallel_vectorizer.vocabulary_ == vectorizer.vocabulary_
+    assert (parallel_matrix != matrix).nnz == 0
+
+    with warnings.catch_warnings():
+        # the stop words are compared against stemmed tokens on purpose, as the pipeline always has
+        warnings.simplefilter('ignore', UserWarning)
+        reference = TfidfVectorizer(tokenizer=preprocessor, stop_words=list(STOP_WORDS), token_pattern=None,
+                                    **TFIDF_PARAMETERS)
+        reference_matrix = reference.fit_transform(texts)
+    assert vectorizer.vocabulary_ == reference.vocabulary_
+    np.testing.assert_allclose(matrix.toarray(), reference_matrix.toarray())
+
+
+TOPICS = [
+    "startup raised funding round investors valuation series seed venture capital".split(),
+    "ride hailing drivers fares passengers cars motorbikes traffic city".split(),
+    "smartphone battery camera screen launch chip android price".split(),
+]
+
+
+def topic_corpus(count, topics=TOPICS, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(topics[i % len(topics)]) for _ in range(12)) for i in range(count)]
+
+
+@pytest.fixture
+def english_stop_words(monkeypatch):
+    # the clustering functions read the nltk stopwords corpus, which need not be downloaded to test them
+    monkeypatch.setattr(text_cluster, 'english_stop_words', lambda: STOP_WORDS)
+
+
+def regex_preprocessor():
+    return TextPreprocessor(tokenizer=TextPreprocessor.Tokenizer.REGEX)
+
+
+def cluster_labels(clustering, count):
+    labels = np.empty(count, dtype=np.int64)
+    for label, indices in clustering.items():
+        labels[indices] = label
+    return labels
+
+
+def test_artifact_reproduces_fitted_labels(english_stop_words, tmp_path):
+    texts = topic_corpus(300)
+    artifact_file = str(tmp_path / 'model.pkl')
+    clustering = text_cluster.cluster_texts(texts, 3, preprocessor=regex_preprocessor(), artifact_file=artifact_file)
+
+    assigner = text_cluster.ClusterAssigner.load(artifact_file)
+    np.testing.assert_array_equal(assigner.assign(texts), cluster_labels(clustering, len(texts)))
+    labels, drift = assigner.assign_with_drift(texts)
+    np.testing.assert_array_equal(labels, cluster_labels(clustering, len(texts)))
+    assert drift == pytest.approx(0, abs=1e-9)
+
+
+def test_artifact_version_mismatch(english_stop_words, tmp_path):
+    artifact_file = str(tmp_path / 'model.pkl')
+    text_cluster.cluster_texts(topic_corpus(90), 3, preprocessor=regex_preprocessor(), artifact_file=artifact_file)
+    with open(artifact_file, 'rb') as f:
+        artifact = pickle.load(f)
+    artifact['version'] = text_cluster.ARTIFACT_VERSION + 1
+    with open(artifact_file, 'wb') as f:
+        pickle.dump(artifact, f)
+
+    with pytest.raises(ValueError, match='version'):
+        text_cluster.ClusterAssigner.load(artifact_file)
+
+
+def test_refit_on_drift(english_stop_words, tmp_path):
+    artifact_file = str(tmp_path / 'model.pkl')
+    corpus = topic_corpus(300)
+    reads = []
+
+    def read_all_texts():
+        reads.append(len(corpus))
+        return corpus
+
+    # the first call fits the model, as there is none yet
+    labels = text_cluster.assign_or_refit(corpus[:30], artifact_file, read_all_texts, preprocessor=regex_preprocessor())
+    assert reads == [300] and len(labels) == 30
+
+    # texts like the fitted ones are labelled by the saved model
+    text_cluster.assign_or_refit(topic_corpus(30, seed=1), artifact_file, read_all_texts, drift_threshold=0.25,
+                                 preprocessor=regex_preprocessor())
+    assert reads == [300]
+
+    # texts of a new topic have none of the fitted vocabulary, and refit the model once they are in the corpus
+    new_topic = "football match goal striker league season coach stadium".split()
+    drifted = topic_corpus(60, topics=[new_topic], seed=2)
+    _, drift = text_cluster.ClusterAssigner.load(artifact_file).assign_with_drift(drifted)
+    assert drift > 0.25
+    corpus = corpus + drifted
+    text_cluster.assign_or_refit(drifted, artifact_file, read_all_texts, drift_threshold=drift + 0.01,
+                                 preprocessor=regex_preprocessor())
+    assert reads == [300]
+    labels = text_cluster.assign_or_refit(drifted, artifact_file, read_all_texts, drift_threshold=0.25,
+                                          preprocessor=regex_preprocessor())
+    assert reads == [300, 360] and len(labels) == 60
+    assert 'striker' in text_cluster.ClusterAssigner.load(artifact_file).vectorizer.vocabulary_
+
+
+def test_vectorize_cache(monkeypatch, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    texts = topic_corpus(200)
+    vectorizer, matrix = vectorize_texts(texts, regex_preprocessor(), stop_words=STOP_WORDS, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+
+    def tokenize_texts(*args, **kwargs):
+        raise AssertionError('the cached vectorization was not used')
+
+    # the same texts, preprocessor and stop words are loaded from the cache without tokenizing them
+    with monkeypatch.context() as patch:
+        patch.setattr(text_cluster, 'tokenize_texts', tokenize_texts)
+        cached_vectorizer, cached_matrix = vectorize_texts(texts, regex_preprocessor(), stop_words=STOP_WORDS,
+                                                           cache_dir=cache_dir)
+    assert cached_vectorizer.vocabulary_ == vectorizer.vocabulary_
+    assert (cached_matrix != matrix).nnz == 0
+
+    # changing a text, the stop words or the preprocessor vectorizes again, into a cache entry of its own
+    changed = [texts[0] + ' again'] + texts[1:]
+    for args in [(changed, regex_preprocessor(), STOP_WORDS), (texts, regex_preprocessor(), STOP_WORDS[1:]),
+                 (texts, TextPreprocessor(stem=False, tokenizer=TextPreprocessor.Tokenizer.REGEX), STOP_WORDS)]:
+        entries = len(os.listdir(cache_dir))
+        expected = vectorize_texts(args[0], args[1], stop_words=args[2])[1]
+        assert (vectorize_texts(args[0], args[1], stop_words=args[2], cache_dir=cache_dir)[1] != expected).nnz == 0
+        assert len(os.listdir(cache_dir)) == entries + 2
+
+
+class RecordingExecutor(ProcessPoolExecutor):
+    """ Process pool recording the arguments of every task submitted to it """
+    submitted = []
+
+    def submit(self, function, *args, **kwargs):
+        self.submitted.append(args)
+        return super().submit(function, *args, **kwargs)
+
+
+def test_sweep_workers_load_cached_matrix(english_stop_words, monkeypatch, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    texts = topic_corpus(300)
+    serial = text_cluster.sweep_cluster_counts(texts, [2, 3, 4], preprocessor=regex_preprocessor(),
+                                               cache_dir=cache_dir)
+    monkeypatch.setattr(text_cluster, 'ProcessPoolExecutor', RecordingExecutor)
+    monkeypatch.setattr(RecordingExecutor, 'submitted', [])
+    # the texts are not tokenized again, the vectorization of the serial sweep is in the cache
+    monkeypatch.setattr(text_cluster, 'tokenize_texts', None)
+    parallel = text_cluster.sweep_cluster_counts(texts, [2, 3, 4], preprocessor=regex_preprocessor(), workers=2,
+                                                 cache_dir=cache_dir)
+
+    # every worker is sent the name of the cached matrix, not the matrix
+    matrix_file = text_cluster.tfidf_cache_files(cache_dir, texts, regex_preprocessor(), STOP_WORDS)[0]
+    assert [args[:2] for args in RecordingExecutor.submitted] == [(matrix_file, clusters) for clusters in [2, 3, 4]]
+    for serial_result, parallel_result in zip(serial, parallel):
+        assert parallel_result['clusters'] == serial_result['clusters']
+        assert parallel_result['inertia'] == pytest.approx(serial_result['inertia'])
+        assert parallel_result['silhouette'] == pytest.approx(serial_result['silhouette'])
+
+
+def test_streaming_tfidf_matches_tfidf_vectorizer(english_stop_words):
+    texts = corpus(2000) + topic_corpus(500)
+    preprocessor = regex_preprocessor()
+    streaming = text_cluster.StreamingTfidf(preprocessor, **TFIDF_PARAMETERS)
+    for start in range(0, len(texts), 300):
+        streaming.partial_fit(texts[start:start + 300])
+    matrix = streaming.transform(texts)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        reference = TfidfVectorizer(tokenizer=preprocessor, stop_words=list(STOP_WORDS), token_pattern=None,
+                                    **TFIDF_PARAMETERS)
+        reference_matrix = reference.fit_transform(texts)
+
+    # the feature every token of the corpus is hashed to, none shared by two tokens
+    tokens = sorted({token for document in tokenize_texts(texts, preprocessor, STOP_WORDS) for token in document})
+    features = dict(zip(tokens, streaming.hasher.transform([[token] for token in tokens]).indices))
+    assert len(set(features.values())) == len(tokens)
+
+    # the tokens kept are exactly the vocabulary, with the same idf, the pruned ones get no weight
+    idf = {token: streaming.idf[feature] for token, feature in features.items()}
+    assert {token for token, weight in idf.items() if weight} == set(reference.vocabulary_)
+    assert 0 < len(reference.vocabulary_) < len(tokens)
+    np.testing.assert_allclose([idf[token] for token in reference.get_feature_names_out()], reference.idf_)
+    np.testing.assert_allclose(matrix[:, [features[token] for token in reference.get_feature_names_out()]].toarray(),
+                               reference_matrix.toarray())
+    assert matrix.count_nonzero() == reference_matrix.count_nonzero()